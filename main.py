@@ -1,9 +1,11 @@
 from rec.models.als import CFRecommender
 from rec.models.bridges import Bridges
 from rec.models.reranker import Reranker
+from rec.models.cache import cache_size_for_memory
 import logging
 import colorlog
-from rec.evaluator.evaluator import Evaluation
+from rec.evaluator.evaluator import Evaluation, default_workers
+from rec.evaluator.results import ResultsStore
 from rec.utils.popularity import PopularityScore
 import threadpoolctl
 import os
@@ -16,6 +18,17 @@ def beep(n=1, type='Blow'):
         os.system(f'afplay /System/Library/Sounds/{type}.aiff')
 
 
+# The most forked evaluation workers, every worker gradually copies the Python objects of the models and the
+# test data (see default_workers). Raise it on machines with memory to spare
+MAX_WORKERS = 4
+
+
+# Memory for the cached candidate lists of the reranker, the cache holds as many entries as fit in it
+# (cache_size_for_memory), about 400k users and items with the top 100 candidates in 1GiB
+CACHE_MEMORY = 1 << 30
+K_MAX = 100
+
+
 # Initialize the models
 
 if __name__ == '__main__':
@@ -50,49 +63,53 @@ if __name__ == '__main__':
         logger.addHandler(stream_handler)
         logger.info("Calculating popularity scores...")
         P = PopularityScore(logger=logger)
-        P.load_data('./data/cf/train', nested=True, limit=1, type='viewing')
-        P.calculate_popularity_scores(1000) # 1000 to consider all data
+        P.load_data('./data/cf/train', nested=True, limit=1, type='viewing', days=1000)
+        # 1000 to consider all data, the scores are float32 arrays by item code instead of dicts
+        popularity = P.calculate_popularity_windows([1000])
 
         PS= PopularityScore()
         PS.load_data('./data/bridges/train', nested=True, limit=1, type='sessions')
-        PS.calculate_popularity_scores_sessions()
+        popularity = popularity.join(PS.calculate_session_popularity_array())
 
         logger.info("Fitting CF model...")
-        CFR = CFRecommender(factors=1, use_gpu=False, use_cg=False, iterations=1, logger=logger)
+        # Lean mode fits the same models without keeping the raw data and the intermediate frames
+        CFR = CFRecommender(factors=1, use_gpu=False, use_cg=False, iterations=1, logger=logger, lean=True)
         CFR.load_data('./data/cf/train', nested=True, limit=1)
         CFR.preprocess()
         CFR.fit()
 
         logger.info("Fitting Bridges model...")
-        B = Bridges(method='frequencyScoreNormalizedLog2', logger=logger)
-        B.fit(path='./data/bridges/train', nested=True, limit=1)
+        B = Bridges(method='frequencyScoreNormalizedLog2', logger=logger, lean=True)
+        B.fit(path='./data/bridges/train', nested=True, limit=1, streaming=True)
 
         logger.info("Fitting Reranker model...")
-        R = Reranker(B, CFR, logger=logger)
+        R = Reranker(B, CFR, logger=logger, cache_size=cache_size_for_memory(CACHE_MEMORY, K_MAX), K_max=K_MAX)
 
         # beep(1, 'Blow') # I NEED TO BE REMOVED IF YOU WANNA RUN ME :)
         ## FIRST:
         # slack.send_message("Models are trained, starting the evaluation...") # I ALSO NEED TO BE REMOVED, UNLESS YOU ARE ON A MAC AND WANT A SLACK NOTIFICATION WHEN THE SCRIPT IS DONE :)
         experiment_id = 'final_full'
         out_path = './data/evaluations/'
-        E = Evaluation(sample=True, sample_size=10000, out_path=out_path, logger=logger, popularity_scores=P.popularity_scores, session_popularity_scores=PS.popularity_scores, slack=slack)
-        R = Reranker(B, CFR, logger=logger)
+        # Finished cases are kept here, so rerunning the script after a crash skips them
+        store = ResultsStore(out_path + 'results.sqlite')
+        E = Evaluation(sample=True, sample_size=10000, out_path=out_path, logger=logger, popularity=popularity, popularity_window=1000, slack=slack, store=store)
+        R = Reranker(B, CFR, logger=logger, cache_size=cache_size_for_memory(CACHE_MEMORY, K_MAX), K_max=K_MAX)
         E.setup(CFR, B, R, path='./data/testdata/test_dataset_filtered_cf_bridges.csv')
         # E.prepare_reranker_evaluations(["bridges"],['frequencyScoreNormalizedLog2'], [0.1], [20], [3, 10])
         E.prepare_reranker_evaluations(["reranker", "bridges", "cf"],['frequencyScore','frequencyScoreNormalizedLog2'], [0.1, 0.3, 0.5, 0.7, 0.9], [20, 50, 100], [1, 3, 5, 10, 20])
-        E.evaluate_reranker(experiment_id)
+        E.evaluate_reranker(experiment_id, grid=True, workers=default_workers(MAX_WORKERS))
 
         ## THEN (for days parameter):
         logger.info("Fitting Bridges model...")
-        B = Bridges(method='frequencyScoreNormalizedLog2', logger=logger)
-        B.fit(path='./data/bridges/train-short', nested=True, limit=-1)
+        B = Bridges(method='frequencyScoreNormalizedLog2', logger=logger, lean=True)
+        B.fit(path='./data/bridges/train-short', nested=True, limit=-1, streaming=True)
 
         logger.info("Fitting Reranker model...")
-        R = Reranker(B, CFR, logger=logger)
-        E = Evaluation(sample=True, sample_size=1000000, out_path=out_path, logger=logger, popularity_scores=P.popularity_scores, session_popularity_scores=PS.popularity_scores, slack=slack)
+        R = Reranker(B, CFR, logger=logger, cache_size=cache_size_for_memory(CACHE_MEMORY, K_MAX), K_max=K_MAX)
+        E = Evaluation(sample=True, sample_size=1000000, out_path=out_path, logger=logger, popularity=popularity, popularity_window=1000, slack=slack, store=store)
         E.setup(CFR, B, R, path='./data/testdata/test_dataset_filtered_cf_bridges.csv')
         E.prepare_reranker_evaluations(["reranker", "bridges"],['frequencyScore','frequencyScoreNormalizedLog2'], [0.1, 0.3, 0.5, 0.7, 0.9], [20, 50, 100], [1, 3, 5, 10, 20])    
-        E.evaluate_reranker(experiment_id + "_short")
+        E.evaluate_reranker(experiment_id + "_short", grid=True, workers=default_workers(MAX_WORKERS))
         
         # beep(5, 'Blow') # I ALSO NEED TO BE REMOVED, UNLESS YOU ARE ON A MAC AND WANT A AUDIO NOTIFICATION WHEN THE SCRIPT IS DONE :)
     except Exception:
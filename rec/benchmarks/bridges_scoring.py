@@ -0,0 +1,78 @@
+"""
+Compares the single pass SegmentScorer against the pandas scoring steps of Bridges.
+
+Usage:
+    python -m rec.benchmarks.bridges_scoring --pairs 5000000 --items 50000
+"""
+import argparse
+import logging
+import time
+
+import numpy as np
+import pandas as pd
+
+from rec.models.bridges import Bridges, SCORE_METHODS
+from rec.models.scoring import SegmentScorer
+
+
+def transitions(pairs, items, seed=42):
+    # Aggregated (itemId, nextItemId, count) table with power-law popularity, like the output of aggregate_counts
+    rng = np.random.default_rng(seed)
+    popularity = 1 / np.arange(1, items + 1) ** 1.1
+    popularity /= popularity.sum()
+    source = rng.choice(items, pairs, p=popularity)
+    target = rng.choice(items, pairs, p=popularity)
+    data = pd.DataFrame({
+        'itemId': source.astype(str),
+        'nextItemId': target.astype(str),
+        'count': rng.zipf(1.8, pairs).astype(np.int64),
+    })
+    data = data[data['itemId'] != data['nextItemId']]
+    return data.groupby(['itemId', 'nextItemId']).agg(count=('count', 'sum')).reset_index()
+
+
+def pandas_scores(data):
+    bridges = Bridges(logger=logging.getLogger(__name__))
+    bridges.data = data.copy()
+    bridges.calculate_frequency_score()
+    bridges.log_transformation()
+    bridges.linear_normalization()
+    bridges.log_normalization()
+    bridges.rank_and_score()
+    return bridges.data
+
+
+def best_of(repeat, fn, *args):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pairs', type=int, default=2_000_000)
+    parser.add_argument('--items', type=int, default=20_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    data = transitions(args.pairs, args.items)
+    print(f"{len(data)} transitions over {data['itemId'].nunique()} source items")
+
+    pandas_time, expected = best_of(args.repeat, pandas_scores, data)
+    scorer = SegmentScorer()
+    segment_time, result = best_of(args.repeat, scorer.score, data, SCORE_METHODS)
+    for method in SCORE_METHODS:
+        np.testing.assert_array_equal(expected[method].to_numpy(), result[method].to_numpy(), err_msg=method)
+    print(f"pandas (all methods):   {pandas_time:.3f}s")
+    print(f"segments (all methods): {segment_time:.3f}s ({pandas_time / segment_time:.1f}x), results equal")
+
+    for method in ['frequencyScore', 'frequencyScoreNormalizedLog2']:
+        method_time, _ = best_of(args.repeat, scorer.score, data, [method])
+        print(f"segments ({method}): {method_time:.3f}s ({pandas_time / method_time:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Recall and throughput of the IVF index of CFRecommender against exact scoring with model.recommend.
+
+Uses a saved CF model (--cf) or a synthetic one with clustered item factors. For every n_probe it reports
+recall@K (the share of the exact top K that the index returns) and queries per second at K = 20, 50 and 100,
+both for one user per call (recommend_scores) and for batches (recommend_batch).
+
+Usage:
+    python -m rec.benchmarks.cf_ann --items 200000 --factors 64 --probes 4 8 16 32
+    python -m rec.benchmarks.cf_ann --cf ./models/cf
+"""
+import argparse
+import logging
+import time
+
+import numpy as np
+import scipy.sparse
+import threadpoolctl
+
+from rec.models.als import CFRecommender
+
+
+def synthetic_model(users, items, factors, clusters=100, seen=20, seed=42):
+    # CFRecommender with clustered factors (items of a genre point the same way) and a random watch history
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, factors)).astype(np.float32)
+    item_factors = centers[rng.integers(clusters, size=items)] + 0.5 * rng.normal(size=(items, factors)).astype(np.float32)
+    user_factors = centers[rng.integers(clusters, size=users)] + 0.5 * rng.normal(size=(users, factors)).astype(np.float32)
+
+    cf = CFRecommender(factors=factors, logger=logging.getLogger(__name__))
+    cf.model.item_factors = item_factors
+    cf.model.user_factors = user_factors
+    rows = np.repeat(np.arange(users), seen)
+    cf.uim = scipy.sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, rng.integers(items, size=len(rows)))),
+                                     shape=(users, items))
+    cf._set_vocabulary(np.arange(users), np.arange(items))
+    return cf
+
+
+def per_user(cf, users, K):
+    start = time.perf_counter()
+    results = [cf.recommend_scores(user, N=K)[0] for user in users]
+    return results, len(users) / (time.perf_counter() - start)
+
+
+def batched(cf, users, K):
+    start = time.perf_counter()
+    items, _, _ = cf.recommend_batch(users, N=K, normalize=False)
+    return list(items), len(users) / (time.perf_counter() - start)
+
+
+def recall(expected, results):
+    hits = sum(len(np.intersect1d(exact, found[found >= 0])) for exact, found in zip(expected, results))
+    return hits / sum(len(exact) for exact in expected)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cf', default=None, help='Directory of a CF model saved with CFRecommender.save')
+    parser.add_argument('--users', type=int, default=20_000)
+    parser.add_argument('--items', type=int, default=100_000)
+    parser.add_argument('--factors', type=int, default=64)
+    parser.add_argument('--queries', type=int, default=1_000)
+    parser.add_argument('--lists', type=int, default=None, help='Number of IVF lists, defaults to sqrt(items)')
+    parser.add_argument('--probes', type=int, nargs='+', default=[2, 4, 8, 16, 32])
+    parser.add_argument('--K', type=int, nargs='+', default=[20, 50, 100])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    cf = CFRecommender.load(args.cf, logger=logging.getLogger(__name__)) if args.cf else \
+        synthetic_model(args.users, args.items, args.factors)
+    # One thread, so the per query numbers do not depend on the BLAS thread pool
+    threadpoolctl.threadpool_limits(1, 'blas')
+    users = np.random.default_rng(args.seed).choice(np.asarray(cf.user_index, dtype=object), args.queries, replace=False)
+    print(f"{cf.uim.shape[1]} items, {cf.model.item_factors.shape[1]} factors, {len(users)} queries")
+
+    start = time.perf_counter()
+    cf.build_ann_index(n_lists=args.lists)
+    print(f"IVF index with {cf.ann.n_lists} lists built in {time.perf_counter() - start:.2f}s")
+
+    for K in args.K:
+        ann = cf.ann
+        cf.remove_ann_index()
+        expected, exact_qps = per_user(cf, users, K)
+        _, exact_batch_qps = batched(cf, users, K)
+        cf.ann = ann
+        print(f"K={K}: exact {exact_qps:.0f} q/s, exact batched {exact_batch_qps:.0f} q/s")
+        for n_probe in args.probes:
+            cf.ann.n_probe = n_probe
+            results, qps = per_user(cf, users, K)
+            batch_results, batch_qps = batched(cf, users, K)
+            print(f"  n_probe={n_probe:<4} recall@{K} {recall(expected, results):.3f} ({recall(expected, batch_results):.3f} batched), "
+                  f"{qps:.0f} q/s ({qps / exact_qps:.1f}x), batched {batch_qps:.0f} q/s ({batch_qps / exact_batch_qps:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
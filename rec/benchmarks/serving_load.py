@@ -0,0 +1,134 @@
+"""
+Load test of the recommendation service with a local stand-in client.
+
+Starts rec.serving.server on the saved models in a subprocess (or uses --url), then sends GET /recommend
+requests for random known users and items over keep-alive connections, and reports the throughput, the
+client side p50/p99 latency and the server side latency and batch size percentiles from /stats.
+
+Usage:
+    python -m rec.benchmarks.serving_load --cf ./models/cf --bridges ./models/bridges --requests 50000 --rate 5000
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from urllib.parse import urlencode, urlsplit
+
+import numpy as np
+
+from rec.utils.data import read_ids
+
+
+async def request(reader, writer, host, path):
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+    await writer.drain()
+    head = await reader.readuntil(b'\r\n\r\n')
+    status = int(head.split(b' ', 2)[1])
+    length = 0
+    for line in head.decode('latin-1').split('\r\n'):
+        if line.lower().startswith('content-length:'):
+            length = int(line.split(':', 1)[1])
+    body = await reader.readexactly(length)
+    return status, body
+
+
+async def client(host, port, paths, interval, latencies, statuses):
+    # One keep-alive connection sending its share of the requests, paced to interval seconds apart when set
+    reader, writer = await asyncio.open_connection(host, port)
+    loop = asyncio.get_running_loop()
+    next_time = loop.time()
+    for path in paths:
+        if interval:
+            delay = next_time - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            next_time += interval
+        start = time.perf_counter()
+        status, _ = await request(reader, writer, host, path)
+        latencies.append(time.perf_counter() - start)
+        statuses[status] = statuses.get(status, 0) + 1
+    writer.close()
+
+
+async def wait_until_ready(host, port, process, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise TimeoutError(f"Server on {host}:{port} did not start within {timeout}s")
+
+
+async def run(args, host, port, process):
+    await wait_until_ready(host, port, process)
+    rng = np.random.default_rng(args.seed)
+    users = np.asarray(read_ids(os.path.join(args.cf, 'users.arrow'), mmap=False), dtype=object)
+    items = np.asarray(read_ids(os.path.join(args.bridges, 'index', 'items.arrow'), mmap=False), dtype=object)
+    paths = [f"/recommend?{urlencode({'user_id': user, 'item_id': item, 'N': args.N})}"
+             for user, item in zip(rng.choice(users, args.requests), rng.choice(items, args.requests))]
+
+    # Warm up the connections and the model pages before measuring
+    await asyncio.gather(*[client(host, port, paths[i:args.warmup:args.concurrency], None, [], {})
+                           for i in range(min(args.concurrency, args.warmup))])
+
+    latencies, statuses = [], {}
+    interval = args.concurrency / args.rate if args.rate else None
+    start = time.perf_counter()
+    await asyncio.gather(*[client(host, port, paths[i::args.concurrency], interval, latencies, statuses)
+                           for i in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+
+    reader, writer = await asyncio.open_connection(host, port)
+    _, body = await request(reader, writer, host, '/stats')
+    writer.close()
+    stats = json.loads(body)
+
+    latencies = np.array(latencies) * 1000
+    print(f"{len(latencies)} requests in {elapsed:.2f}s ({len(latencies) / elapsed:.0f} req/s), status counts {statuses}")
+    print(f"client latency: p50 {np.percentile(latencies, 50):.2f}ms, p99 {np.percentile(latencies, 99):.2f}ms, "
+          f"max {latencies.max():.2f}ms")
+    print(f"server latency: p50 <= {stats['latency_p50'] * 1000:.2f}ms, p99 <= {stats['latency_p99'] * 1000:.2f}ms")
+    print(f"batch size: p50 <= {stats['batch_size_p50']}, p99 <= {stats['batch_size_p99']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cf', required=True, help='Directory of a CF model saved with CFRecommender.save')
+    parser.add_argument('--bridges', required=True, help='Directory of a Bridges model saved with Bridges.save')
+    parser.add_argument('--url', default=None, help='Use a running server instead of starting one')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--requests', type=int, default=20_000)
+    parser.add_argument('--warmup', type=int, default=1_000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--rate', type=float, default=None, help='Target requests per second, as fast as possible if unset')
+    parser.add_argument('--N', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--server-args', default='', help='Extra arguments for rec.serving.server')
+    args = parser.parse_args()
+
+    process = None
+    if args.url:
+        url = urlsplit(args.url)
+        host, port = url.hostname, url.port
+    else:
+        host, port = '127.0.0.1', args.port
+        process = subprocess.Popen([sys.executable, '-m', 'rec.serving.server', '--cf', args.cf, '--bridges', args.bridges,
+                                    '--host', host, '--port', str(port)] + args.server_args.split())
+    try:
+        asyncio.run(run(args, host, port, process))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+"""
+End to end benchmark on synthetic data (see rec.benchmarks.synthetic).
+
+Times CFRecommender.fit, Bridges.fit and the popularity scores, the per call latency of
+CFRecommender.recommend_standard and Reranker.recommend, and the throughput of Evaluation.evaluate_reranker.
+Every stage records its wall and CPU time and the resident memory after it and at its peak, and --metrics
+adds the timers and counters the models record in METRICS. The results are
+written as JSON together with the parameters and the versions they ran with, and --compare prints the
+ratios against an earlier results file, so a change can be measured at a given scale.
+
+Usage:
+    python -m rec.benchmarks.suite --users 100000 --items 20000 --out results.json
+    python -m rec.benchmarks.suite --data ./data/synthetic --out after.json --compare before.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import threadpoolctl
+
+from rec.benchmarks.synthetic import generate
+from rec.evaluator.evaluator import Evaluation
+from rec.models.als import CFRecommender
+from rec.models.bridges import Bridges
+from rec.models.reranker import Reranker
+from rec.utils.metrics import METRICS, MemorySampler, peak_rss, rss
+from rec.utils.popularity import PopularityScore
+
+
+class Benchmark:
+    def __init__(self, logger=None):
+        self.logger = logger
+        self.results = {}
+
+    @contextmanager
+    def stage(self, name, **extra):
+        """
+        Measures the block as one stage. Values set on the yielded dict (like throughput) are stored with it.
+        """
+        result = dict(extra)
+        sampler = MemorySampler()
+        sampler.start()
+        start_rss = rss()
+        start, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield result
+        finally:
+            result['seconds'] = time.perf_counter() - start
+            result['cpu_seconds'] = time.process_time() - start_cpu
+            result['peak_rss_mb'] = sampler.stop() / 2 ** 20
+            result['rss_mb'] = rss() / 2 ** 20
+            result['rss_delta_mb'] = result['rss_mb'] - start_rss / 2 ** 20
+            self.results[name] = result
+            self.logger.info(f"{name}: {result['seconds']:.3f}s, peak {result['peak_rss_mb']:.0f}MB")
+
+    def latency(self, name, fn, calls):
+        """
+        Times fn(*args) for every args in calls, one call at a time.
+        """
+        timings = np.empty(len(calls))
+        with self.stage(name, calls=len(calls)) as result:
+            for i, args in enumerate(calls):
+                start = time.perf_counter()
+                fn(*args)
+                timings[i] = time.perf_counter() - start
+        result.update({f'p{q}_ms': float(np.percentile(timings, q)) * 1000 for q in (50, 90, 99)})
+        result['mean_ms'] = float(timings.mean()) * 1000
+        result['calls_per_second'] = len(calls) / timings.sum()
+        return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    import implicit
+    import pyarrow
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'pyarrow': pyarrow.__version__,
+        'implicit': implicit.__version__,
+        'blas': [{'api': pool['internal_api'], 'threads': pool['num_threads']} for pool in threadpoolctl.threadpool_info()],
+    }
+
+
+def run(args, paths, logger, model_logger):
+    bench = Benchmark(logger)
+    rng = np.random.default_rng(args.seed)
+
+    with bench.stage('popularity_viewing'):
+        P = PopularityScore(logger=model_logger)
+        P.load_data(paths['cf'], nested=True, type='viewing', days=args.popularity_days)
+        popularity = P.calculate_popularity_windows([args.popularity_days])
+    with bench.stage('popularity_sessions'):
+        PS = PopularityScore(logger=model_logger)
+        PS.load_data(paths['bridges'], nested=True, type='sessions')
+        popularity = popularity.join(PS.calculate_session_popularity_array())
+
+    with bench.stage('cf_load'):
+        CFR = CFRecommender(factors=args.factors, iterations=args.iterations, logger=model_logger, lean=args.lean)
+        CFR.load_data(paths['cf'], nested=True)
+        CFR.preprocess()
+    with bench.stage('cf_fit', users=int(CFR.sessions['userId'].nunique()), items=int(CFR.sessions['itemId'].nunique())):
+        CFR.fit()
+
+    with bench.stage('bridges_fit') as result:
+        B = Bridges(method=args.method, logger=model_logger, lean=args.lean)
+        B.fit(paths['bridges'], nested=True, streaming=True)
+        result['items'] = len(B.model.items)
+
+    R = Reranker(B, CFR, logger=model_logger)
+    test = pd.read_csv(paths['test']).dropna()
+    requests = rng.choice(len(test), min(args.requests, len(test)), replace=False)
+    users = test['profile_id'].to_numpy()[requests]
+    items = test['item_id'].to_numpy()[requests].astype(np.int64).astype(str)
+
+    bench.latency('cf_recommend_standard', CFR.recommend_standard, [(user, args.N) for user in users])
+    bench.latency('reranker_recommend', lambda user, item: R.recommend(user, item, N=args.N, w1=0.5, w2=0.5, K=args.K),
+                  list(zip(users, items)))
+
+    with tempfile.TemporaryDirectory() as out_path:
+        E = Evaluation(sample=True, sample_size=args.test_cases, out_path=out_path + '/', logger=model_logger,
+                       popularity=popularity, popularity_window=args.popularity_days)
+        E.progress = False
+        E.setup(CFR, B, R, paths['test'])
+        E.prepare_reranker_evaluations(['reranker'], [args.method], args.w1s, [args.K], [args.N])
+        cases = len(E.evaluation_cases)
+        for name, grid in [('evaluate_reranker', False), ('evaluate_reranker_grid', True)]:
+            with bench.stage(name, cases=cases, test_cases=len(E.users)) as result:
+                E.evaluate_reranker(name, grid=grid)
+            result['recommendations_per_second'] = cases * len(E.users) / result['seconds']
+    return bench.results
+
+
+def compare(results, baseline):
+    print(f"{'stage':<28}{'metric':<28}{'baseline':>12}{'current':>12}{'ratio':>8}")
+    for stage, metrics in results.items():
+        for metric in ('seconds', 'p50_ms', 'p99_ms', 'calls_per_second', 'recommendations_per_second', 'peak_rss_mb'):
+            if metric in metrics and metric in baseline.get(stage, {}):
+                before, after = baseline[stage][metric], metrics[metric]
+                print(f"{stage:<28}{metric:<28}{before:>12.3f}{after:>12.3f}{after / before if before else float('nan'):>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data', default=None, help='Use an existing synthetic data set instead of generating one')
+    parser.add_argument('--out', default='benchmark.json', help='JSON results file')
+    parser.add_argument('--compare', default=None, help='Earlier results file to compare with')
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--items', type=int, default=2_000)
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--views', type=int, default=50_000, help='Viewing rows per day')
+    parser.add_argument('--transitions', type=int, default=20_000, help='Session transitions per day')
+    parser.add_argument('--test-cases', type=int, default=2_000)
+    parser.add_argument('--requests', type=int, default=1_000, help='Calls timed one at a time for the latencies')
+    parser.add_argument('--factors', type=int, default=20)
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--method', default='frequencyScoreNormalizedLog2')
+    parser.add_argument('--popularity-days', type=int, default=30)
+    parser.add_argument('--K', type=int, default=20)
+    parser.add_argument('--N', type=int, default=5)
+    parser.add_argument('--w1s', type=float, nargs='+', default=[0.25, 0.5, 0.75])
+    parser.add_argument('--blas-threads', type=int, default=None, help='Limit the BLAS threads, unlimited if unset')
+    parser.add_argument('--lean', action='store_true', help='Fit the models in lean mode')
+    parser.add_argument('--metrics', action='store_true', help='Record the stage timers and counters of the models (METRICS)')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logger = logging.getLogger(__name__)
+    # The models rename the logger they are given, the stages keep logging under this module
+    model_logger = logging.getLogger()
+    if args.metrics:
+        METRICS.enable()
+    if args.blas_threads:
+        threadpoolctl.threadpool_limits(args.blas_threads, 'blas')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.data:
+            paths = {'cf': os.path.join(args.data, 'cf', 'train'), 'bridges': os.path.join(args.data, 'bridges', 'train'),
+                     'test': os.path.join(args.data, 'testdata', 'test.csv')}
+            generation = None
+        else:
+            start = time.perf_counter()
+            paths = generate(tmp, args.users, args.items, args.days, args.views, args.transitions,
+                             max(args.test_cases, args.requests), seed=args.seed)
+            generation = time.perf_counter() - start
+        results = run(args, paths, logger, model_logger)
+
+    report = {
+        'created': pd.Timestamp.now(tz='UTC').isoformat(),
+        'environment': environment(),
+        'parameters': vars(args),
+        'generation_seconds': generation,
+        'peak_rss_mb': peak_rss() / 2 ** 20,
+        'results': results,
+        'metrics': METRICS.to_dict() if args.metrics else None,
+    }
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+    logger.info(f"Results written to {args.out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Synthetic training and test data in the layout and schemas the models read, for benchmarks without the
+private data under ./data.
+
+Writes one parquet partition per day (date=YYYY-MM-DD/part-0.parquet) of viewing data under cf/train
+(profileId, itemId, durationSec, firstStart, contentType) and of aggregated session transitions under
+bridges/train (itemId, nextItemId, count), and a test set CSV under testdata/test.csv (profile_id, item_id,
+next_item_id, measure_date) with the item IDs written as floats, like the exported test data. Item
+popularity follows a power law, and next items are mostly drawn near the previous item in the catalog, so
+Bridges has transitions to find.
+
+Usage:
+    python -m rec.benchmarks.synthetic --out ./data/synthetic --users 100000 --items 20000 --days 7
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+CONTENT_TYPES = ['SERIES', 'MOVIE', 'SPORT']
+
+
+def popularity(items, alpha):
+    # Power-law popularity of items by rank
+    weights = 1 / np.arange(1, items + 1) ** alpha
+    return weights / weights.sum()
+
+
+def next_items(rng, items, p, locality=0.7, spread=20):
+    # Next items: usually a neighbour of the item in the catalog, otherwise a popular item
+    nearby = (items + rng.integers(1, spread + 1, len(items))) % len(p)
+    return np.where(rng.random(len(items)) < locality, nearby, rng.choice(len(p), len(items), p=p))
+
+
+def generate(out, users=10_000, items=2_000, days=7, views=50_000, transitions=20_000, test_cases=10_000,
+             alpha=1.1, start='2024-01-01', seed=42):
+    """
+    Writes a synthetic data set under out.
+
+    Parameters:
+    - users (int), items (int): The number of profiles and the catalog size.
+    - days (int): The number of daily partitions of training data, the test set is the day after.
+    - views (int): Viewing rows per day.
+    - transitions (int): Aggregated session transitions per day.
+    - test_cases (int): Rows of the test set.
+    - alpha (float): Exponent of the power-law item popularity.
+
+    Returns:
+    - paths (dict): The cf, bridges and test paths, in the form the loaders take them.
+    """
+    rng = np.random.default_rng(seed)
+    p = popularity(items, alpha)
+    item_ids = np.arange(100_000, 100_000 + items).astype(str)
+    profile_ids = np.array([f"profile_{i}" for i in range(users)], dtype=object)
+    content_types = np.array(CONTENT_TYPES)[rng.integers(len(CONTENT_TYPES), size=items)]
+    # Heavy users watch much more than the others
+    activity = popularity(users, 0.8)
+    paths = {'cf': os.path.join(out, 'cf', 'train'), 'bridges': os.path.join(out, 'bridges', 'train'),
+             'test': os.path.join(out, 'testdata', 'test.csv')}
+
+    for day in pd.date_range(start, periods=days):
+        partition = f"date={day.date()}"
+        watched = rng.choice(items, views, p=p)
+        viewing = pd.DataFrame({
+            'profileId': profile_ids[rng.choice(users, views, p=activity)],
+            'itemId': item_ids[watched],
+            'durationSec': rng.lognormal(7, 1, views).astype(np.int64) + 1,
+            'firstStart': day + pd.to_timedelta(rng.integers(0, 86_400, views), unit='s'),
+            'contentType': content_types[watched],
+        })
+        os.makedirs(os.path.join(paths['cf'], partition), exist_ok=True)
+        viewing.to_parquet(os.path.join(paths['cf'], partition, 'part-0.parquet'), index=False)
+
+        source = rng.choice(items, transitions, p=p)
+        sessions = pd.DataFrame({'itemId': source, 'nextItemId': next_items(rng, source, p),
+                                 'count': rng.zipf(1.8, transitions).astype(np.int64)})
+        # One row per pair and day, like the daily aggregation of the session data
+        sessions = sessions.groupby(['itemId', 'nextItemId'], as_index=False)['count'].sum()
+        sessions['itemId'] = item_ids[sessions['itemId']]
+        sessions['nextItemId'] = item_ids[sessions['nextItemId']]
+        os.makedirs(os.path.join(paths['bridges'], partition), exist_ok=True)
+        sessions.to_parquet(os.path.join(paths['bridges'], partition, 'part-0.parquet'), index=False)
+
+    watched = rng.choice(items, test_cases, p=p)
+    test = pd.DataFrame({
+        'profile_id': profile_ids[rng.choice(users, test_cases, p=activity)],
+        'item_id': item_ids[watched].astype(float),
+        'next_item_id': item_ids[next_items(rng, watched, p)].astype(float),
+        'measure_date': str((pd.Timestamp(start) + pd.Timedelta(days=days)).date()),
+    })
+    os.makedirs(os.path.dirname(paths['test']), exist_ok=True)
+    test.to_csv(paths['test'], index=False)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', required=True)
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--items', type=int, default=2_000)
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--views', type=int, default=50_000, help='Viewing rows per day')
+    parser.add_argument('--transitions', type=int, default=20_000, help='Session transitions per day')
+    parser.add_argument('--test-cases', type=int, default=10_000)
+    parser.add_argument('--alpha', type=float, default=1.1)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    paths = generate(args.out, args.users, args.items, args.days, args.views, args.transitions, args.test_cases,
+                     args.alpha, seed=args.seed)
+    for name, path in paths.items():
+        print(f"{name}: {path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,62 @@
 import pandas as pd
+import numpy as np
 import logging
+import multiprocessing
 import os
+import threadpoolctl
 from tqdm import tqdm
 from typing import List
 from rec.models.reranker import Reranker
+from rec.models.batch_reranker import candidate_counts, rerank_batch
+from rec.evaluator.metrics import RankingAccumulator
+from rec.evaluator.results import RESULT_COLUMNS, fingerprint
+from rec.utils.data import cached_parquet, sample_rows
+from rec.utils.metrics import METRICS
 from rec.types.types import EvaluationCase, RecommendedItem, Recommendation
 
+# The evaluation that forked worker processes run their shards on, inherited from the parent without pickling
+_EVALUATION = None
+
+
+def default_workers(max_workers=4):
+    """
+    The number of evaluation workers to use by default, at most max_workers. Forked workers start out sharing
+    the memory of the parent, but the pages of Python objects (the dicts and lists of the models, the test
+    users) are copied as soon as a worker touches their reference counts, so every worker gradually costs
+    memory as well as a core. The default of 4 keeps a full size run within the memory of a laptop, and the
+    rank phase is mostly gathers over the candidate arrays, which stop scaling once memory bandwidth is
+    saturated, so more workers mostly cost memory. Machines with more memory can raise it.
+    """
+    return max(1, min(max_workers, os.cpu_count() or 1))
+
+
+def _init_worker(workers):
+    # Every worker evaluates its own shard, so BLAS/OpenMP threads would only compete for the same cores.
+    # The limit is set again in the worker, threadpoolctl limits of the parent are not inherited by every library
+    threadpoolctl.threadpool_limits(1)
+    _EVALUATION.progress = False
+    # Every worker fills its own candidate cache, together they are as large as the cache of the parent
+    if _EVALUATION.R is not None and _EVALUATION.R.cache is not None:
+        _EVALUATION.R.cache.resize(max(1, _EVALUATION.R.cache_size // workers))
+
+
+def _evaluate_shard(task):
+    model, method, K, cases, start, end = task
+    if model != "cf" and method != _EVALUATION.Bridges.method:
+        _EVALUATION.Bridges.change_method(method)
+    return _EVALUATION._accumulate(model, method, K, cases, start, end)
+
+
 class Evaluation:
-    def __init__(self, sample=False, sample_size=10000, out_path='./data/evaluations', logger=None, popularity_scores=None, session_popularity_scores=None, slack=None):
+    def __init__(self, sample=False, sample_size=10000, out_path='./data/evaluations', logger=None, popularity_scores=None, session_popularity_scores=None, slack=None,
+                 popularity=None, popularity_window=None, store=None):
         self.sample = sample
         self.slack = slack
+        # ResultsStore the results are also written to, cases it already has results for are skipped
+        self.store = store
+        self.fingerprint = None
+        # (experiment_id, CSV row) of the results not written yet, see _flush_results
+        self.pending_rows = []
         self.sample_size = sample_size
         self.logger = logger
         self.logger.name = "evaluator"
@@ -18,26 +65,41 @@ class Evaluation:
         self.item_id_key = 'item_id'
         self.next_item_id_key = 'next_item_id'
         self.measure_date_key = 'measure_date'
-        self.data = {}
+        # The test set as typed columns, one entry per test case
+        self.users = np.empty(0, dtype=object)
+        self.items = np.empty(0, dtype=np.int64)
+        self.next_items = np.empty(0, dtype=np.int64)
+        self.item_strings = np.empty(0, dtype=object)
         self.popularity_scores = popularity_scores
         self.session_popularity_scores = session_popularity_scores
+        # PopularityArrays with the session scores and the count and duration scores of popularity_window days,
+        # used instead of the popularity dicts when set
+        self.popularity_arrays = popularity
+        self.popularity_window = popularity_window
         self.CF = None
         self.Bridges = None
         self.R = None
 
         self.missing_recommendations = 0
+        self.progress = True
 
+    @METRICS.timed('evaluator_seconds', phase='load')
     def load_data(self, path):
-        df = pd.read_csv(path)
-        df.dropna(inplace=True)
-        # We have to do some major changes to ensure that there is no floatingpoint .0s
-        df['item_id'] = df[self.item_id_key].astype(int)
-        df['next_item_id'] = df[self.next_item_id_key].astype(int)
-        df['next_item_id'] = df['next_item_id'].astype(str) 
-        if self.sample:
-            df = df.sample(n=self.sample_size, random_state=42)
-        # Convert the sampled DataFrame to a list of dictionaries
-        self.data = df.to_dict(orient='records')
+        """
+        Loads the test set as typed columns. The CSV is converted once to a Parquet cache with integer item
+        IDs (see cached_parquet), and the sample is a seeded selection of row indices, picking the same rows
+        as DataFrame.sample(n=sample_size, random_state=42) did on the CSV.
+        """
+        # The item IDs are written as floats (12.0) in the CSV, so they are stored as integers
+        cache = cached_parquet(path, [self.profile_id_key, self.item_id_key, self.next_item_id_key],
+                               int_columns=[self.item_id_key, self.next_item_id_key], logger=self.logger)
+        table = sample_rows(cache, self.sample_size if self.sample else None, seed=42)
+        self.users = table[self.profile_id_key].to_numpy(zero_copy_only=False)
+        self.items = table[self.item_id_key].to_numpy()
+        self.next_items = table[self.next_item_id_key].to_numpy()
+        # The models look items up by string ID
+        self.item_strings = self.items.astype(str).astype(object)
+        self.logger.debug(f"Loaded {len(self.users)} test cases from {cache}")
 
     def setup(self, CF, Bridges, Reranker, path):
         # We always load the data first
@@ -83,51 +145,152 @@ class Evaluation:
     def _store_recs(self, model, method, w1, w2, K, N, map, accuracy, avgctr, \
                     missing_bridge_count, missing_cf_count, not_enough_bridge_count,\
                     not_enough_cf_count, experiement_id, avg_popularity_score, avg_count_popularity_score, avg_session_popularity_score, coverage):
-        file_path = f"{self.out_path}{experiement_id}.csv"
+        row = f"{model},{method},{w1},{w2},{K},{N},{map},{accuracy},{avgctr},{missing_bridge_count},{missing_cf_count},{not_enough_bridge_count},{not_enough_cf_count},{avg_popularity_score},{avg_count_popularity_score},{avg_session_popularity_score},{coverage}\n"
+        if self.store is None:
+            self._write_rows(experiement_id, [row])
+            return
+        values = [map, accuracy, avgctr, missing_bridge_count, missing_cf_count, not_enough_bridge_count, not_enough_cf_count,
+                  avg_popularity_score, avg_count_popularity_score, avg_session_popularity_score, coverage]
+        self.store.add(experiement_id, self.fingerprint, (model, method, w1, w2, K, N), dict(zip(RESULT_COLUMNS, values)))
+        self.pending_rows.append((experiement_id, row))
+
+    def _write_rows(self, experiment_id, rows):
+        file_path = f"{self.out_path}{experiment_id}.csv"
         if not os.path.exists(file_path):
             with open(file_path, 'a+') as f:
                 f.write("model,method,w1,w2,K,N,MAP,avgmrr,avgctr,missing_bridges,missing_cf,not_enough_bridges,not_enough_cf,averege_duration_popularity_scores,averege_count_popularity_scores,avg_session_popularity_score,coverage\n")
-                f.write(f"{model},{method},{w1},{w2},{K},{N},{map},{accuracy},{avgctr},{missing_bridge_count},{missing_cf_count},{not_enough_bridge_count},{not_enough_cf_count},{avg_popularity_score},{avg_count_popularity_score},{avg_session_popularity_score},{coverage}\n")
-        else:
-            with open(file_path, 'a+') as f:
-                f.write(f"{model},{method},{w1},{w2},{K},{N},{map},{accuracy},{avgctr},{missing_bridge_count},{missing_cf_count},{not_enough_bridge_count},{not_enough_cf_count},{avg_popularity_score},{avg_count_popularity_score},{avg_session_popularity_score},{coverage}\n")
+        with open(file_path, 'a+') as f:
+            f.writelines(rows)
+
+    def _flush_results(self):
+        """
+        Commits the buffered results to the store and only then appends their CSV rows, after every case and
+        every group. A run that is killed (skipping any finally) can then not leave CSV rows of cases the store
+        does not have, which the rerun would evaluate and write again. Rows the store has but the CSV missed,
+        if the kill falls between the two writes, are still in ResultsStore.read.
+        """
+        if self.store is not None:
+            self.store.flush()
+        rows, self.pending_rows = self.pending_rows, []
+        for experiment_id in dict.fromkeys(experiment_id for experiment_id, _ in rows):
+            self._write_rows(experiment_id, [row for row_experiment_id, row in rows if row_experiment_id == experiment_id])
 
     def click_through_rate(self, actual_clicks, recommendations: List[RecommendedItem]):
         return len(set(actual_clicks) & set(recommendations) / len(set(actual_clicks)))
 
-    def evaluate_reranker(self, experiment_id):
+    def evaluate_reranker(self, experiment_id, grid=False, workers=None):
+        """
+        Evaluates every prepared case and stores one row per case. With a results store, the cases that already
+        have results for experiment_id and the current models and data are skipped.
+
+        Parameters:
+        - experiment_id (str): The name of the results file.
+        - grid (bool): Evaluate all cases of a (model, method, K) group in one scan of the test data.
+        - workers (int): Split the test data into shards evaluated by this many forked processes (see
+          default_workers). The workers inherit the models and test data without pickling, but each one copies
+          the pages of the Python objects it touches, and the Reranker candidate cache is split between them.
+          The merged results are identical to a serial run.
+        """
+        cases = self._pending_cases(experiment_id)
+        try:
+            if grid or (workers and workers > 1):
+                groups = self._group_cases(cases) if grid else [((case.model, case.method, case.K), [case]) for case in cases]
+                return self._evaluate_groups(groups, experiment_id, workers)
+            self._evaluate_cases(cases, experiment_id)
+        finally:
+            self._flush_results()
+
+    def _pending_cases(self, experiment_id):
+        # The prepared cases without results in the store for this experiment and these models and data
+        if self.store is None:
+            return self.evaluation_cases
+        self.fingerprint = self.data_fingerprint()
+        cases = self.store.pending_cases(experiment_id, self.fingerprint, self.evaluation_cases)
+        if len(cases) < len(self.evaluation_cases):
+            self.logger.info(f"Resuming {experiment_id}: {len(self.evaluation_cases) - len(cases)} of {len(self.evaluation_cases)} cases already have results")
+        return cases
+
+    def data_fingerprint(self):
+        """
+        Fingerprint of what the results depend on besides the case: the CF hyperparameters, user-item matrix
+        and factors, the Bridges parameters and transitions, the test cases and the popularity scores. CF is
+        fitted with a fixed random_state, so refitting the same model on the same data after a crash gives the
+        same factors and resumes, while any other refit starts a new fingerprint.
+        """
+        index = self.Bridges.model
+        bridges = [index.indptr] + [np.asarray(index.next_items[method]) for method in self.Bridges.methods] + \
+            [np.asarray(index.scores[method]) for method in self.Bridges.methods]
+        return fingerprint(
+            [self.CF.model.factors, self.CF.model.iterations, self.CF.model.regularization, self.CF.model.alpha],
+            self.CF.uim, np.asarray(self.CF.item_index, dtype=object),
+            [np.asarray(self.CF.model.user_factors), np.asarray(self.CF.model.item_factors)],
+            [self.Bridges.minScore, self.Bridges.maxScore, self.Bridges.bridgeThresholds, self.Bridges.max_k],
+            np.asarray(index.items, dtype=object), bridges,
+            [np.asarray(self.users, dtype=object), self.items, self.next_items],
+            [self.popularity_window, self._catalog_size()],
+            self._popularity_parts(),
+        )
+
+    def _popularity_parts(self):
+        # The popularity scores as they are given, arrays or the dicts of the original evaluation
+        if self.popularity_arrays is not None:
+            return [np.asarray(self.popularity_arrays.items, dtype=object)] + \
+                [self.popularity_arrays.scores[name] for name in sorted(self.popularity_arrays.scores)]
+        return [self.popularity_scores, self.session_popularity_scores]
+
+    def _evaluate_cases(self, cases, experiment_id):
         self.logger.debug("Starting evaluation...")
+        # The codes only depend on the models and the test data, so every case uses the same ones
+        self._prepare_codes()
         # Bridges can be different based on the method, so we need to fit the model for each method
-        for case in self.evaluation_cases:
+        for case in cases:
             if case.model != "cf" and case.method != self.Bridges.method:
                 self.logger.debug("Changing method...")
+                # The reranker reads the method from Bridges, and its candidate cache is invalidated by the change
                 self.Bridges.change_method(case.method)
-                # Refit reranker with new method.
-                self.R = Reranker(self.Bridges, self.CF, logger=self.logger)
             self.logger.debug(f"Model: {case.model}, Method: {case.method}, w1: {case.w1}, w2: {case.w2}, K: {case.K}, N: {case.N}")
             self._evaluate_reranker(case.method, case.w1, case.w2, case.K, case.N, experiment_id, case.model)
+            self._flush_results()
+
+    def evaluate_windows(self, experiment_id, windows, grid=False, workers=None):
+        """
+        Evaluates the prepared cases once per Bridges history window, with the window length as one more sweep
+        dimension. The window models are built from the partition aggregates of the Bridges model (see
+        Bridges.fit_partitions and Bridges.window), so no window reads the session data again. The results of
+        a window are stored under experiment_id suffixed with the window, like final_full_7d or final_full_all.
+
+        Parameters:
+        - windows (List[int]): Window lengths in days, None for every partition.
+        """
+        Bridges, R = self.Bridges, self.R
+        try:
+            for days in windows:
+                self.logger.info(f"Evaluating the {days if days is not None else 'full'} day Bridges window...")
+                self.Bridges = Bridges.window(days)
+                self.R = Reranker(self.Bridges, self.CF, logger=R.logger, cache_size=R.cache_size, K_max=R.K_max, vocabulary=R.vocabulary)
+                self.evaluate_reranker(f"{experiment_id}_{days}d" if days is not None else f"{experiment_id}_all", grid, workers)
+        finally:
+            self.Bridges, self.R = Bridges, R
+
+    def _reset_counters(self):
+        self.missing_recommendations = 0
+        self.R.reset_counters()
     
     def _evaluate_reranker(self, method, w1, w2, K, N, experiment_id, model):
-        ctrs = []
-        mrrs = []
         # Reset metrics:
-        self.missing_recommendations = 0
-        self.R.missing_bridge_count = 0
-        self.R.missing_cf_count = 0
-        self.R.not_enough_bridge_count = 0
-        self.R.not_enough_cf_count = 0
-        # Train a new instance of our model
-        i = 0
-        recommendations = {}
-        with tqdm(total=len(self.data), desc='Processing recommendations') as pbar:
-            for i, case in enumerate(self.data):
+        self._reset_counters()
+        metrics = RankingAccumulator(1)
+        rows, rankings = [], []
+        with METRICS.timer('evaluator_seconds', phase='rank'), \
+                tqdm(total=len(self.users), desc='Processing recommendations', disable=not self.progress) as pbar:
+            for i, (user, item) in enumerate(zip(self.users, self.item_strings)):
                 # get recs from the reranker
                 if model == "reranker":
-                    recs = self.R.recommend(case[self.profile_id_key], str(case[self.item_id_key]), N=N, w1=w1, w2=w2, K=K)
+                    recs = self.R.recommend(user, item, N=N, w1=w1, w2=w2, K=K)
                 elif model == "cf":
-                    recs = self.CF.recommend_standard(case[self.profile_id_key], N=N)
+                    recs = self.CF.recommend_standard(user, N=N)
                 elif model == "bridges":
-                    recs = self.Bridges.recommend_standard(case[self.item_id_key], N=N)
+                    recs = self.Bridges.recommend_standard(item, N=N)
                 else:
                     self.logger.error("Model not found.")
                     continue
@@ -135,104 +298,226 @@ class Evaluation:
                     self.missing_recommendations += 1
                     continue   
 
-                # transform recommended items to string
-                try:
-                    recommended_items = [str(rec.item_id) for rec in recs.items]
-                except Exception as e:
-                    self.logger.error(e)
-                    continue
-
-                ctr_score = 1 if str(int(case[self.next_item_id_key])) in recommended_items else 0
-                ctrs.append(ctr_score)
-
-                # Calculate MRR score
-                try:
-                    rank = recommended_items.index(str(int(case[self.next_item_id_key]))) + 1
-                    mrr_score = 1 / rank
-                except ValueError:
-                    mrr_score = 0
-                mrrs.append(mrr_score)
-
-                # Add the actual and recommended items to the recommendations dictionary
-                p = recommendations.get(case[self.profile_id_key], None)
-                if not p:
-                    recommendations[case[self.profile_id_key]] = {'actual': [], 'recommended': []} 
-                recommendations[case[self.profile_id_key]]['actual'].append(case[self.next_item_id_key])
-                recommendations[case[self.profile_id_key]]['recommended'].extend(recommended_items)
+                rows.append(i)
+                rankings.append(self._encode_items(recs.items, N))
 
                 # Update the progress bar every 10,000 iterations
                 if (i + 1) % 10000 == 0:
+                    metrics.add([rankings], self.target_codes[rows], self.user_codes[rows])
+                    rows, rankings = [], []
                     pbar.update(10000)
+        if rows:
+            metrics.add([rankings], self.target_codes[rows], self.user_codes[rows])
 
-        # Calculate precision for each user
-        recommended_for_popularity = []
-        precision_scores = {}
-        for user_id, user_data in recommendations.items():
-            actual_next_items = set(user_data['actual'])
-            recommended_items = set(user_data['recommended'])
-            
-            # Calculate the number of correct recommendations
-            correct_recommendations = len(actual_next_items.intersection(recommended_items))
-            recommended_for_popularity.extend(recommended_items)
-            # Calculate precision for this user
-            precision = correct_recommendations / len(recommended_items) if recommended_items else 0
-            
-            precision_scores[user_id] = precision
-
-        # Calculate Mean Average Precision (MAP)
-        mean_avg_precision = sum(precision_scores.values()) / len(precision_scores) if precision_scores else 0
-        
-        # Calculate average popularity score, general average popularity score and general duration popularity score
-        avg_popularity_score = None
-        avg_count_popularity_score = None
-        avg_session_popularity_score = None
-        if self.popularity_scores is not None and self.session_popularity_scores is not None:
-            # get all popularity scores for the recommended items
-            duration_popularity = []
-            count_popularity = []
-            session_count_popularity = []
-            
-            for item in recommended_for_popularity:
-                session_popularity_score = self.session_popularity_scores.get(item, None)
+        with METRICS.timer('evaluator_seconds', phase='metrics'):
+            result, _ = metrics.result(0, N, self.popularity, self._catalog_size())
+        self._report(model, method, w1, w2, K, N, experiment_id, result)
+
+    @METRICS.timed('evaluator_seconds', phase='prepare_codes')
+    def _prepare_codes(self):
+        """
+        Gives every item the models can recommend and every test user an integer code, so rankings and metrics
+        are integer arrays. Items and users are coded in the vocabularies the models share, so the codes of
+        their recommendations are the codes used here. Also builds the popularity scores as arrays indexed by
+        item code.
+        """
+        self.vocabulary = self.R.vocabulary if self.R is not None else self.CF.vocabulary
+        # Building the code maps gives every item the models can recommend a code before the arrays are sized
+        self.CF.item_map, self.Bridges.model.code_map
+        self.target_codes = self.vocabulary.add(self.next_items)
+        self.user_vocabulary = self.CF.user_vocabulary
+        self.user_codes = self.user_vocabulary.add(self.users)
+
+        self.popularity = None
+        if self.popularity_arrays is not None:
+            if self.popularity_arrays.vocabulary is not self.vocabulary:
+                raise ValueError("The popularity arrays must code their items in the vocabulary of the models")
+            codes = self.popularity_arrays.code_map.to_local(np.arange(len(self.vocabulary)))
+            self.popularity = {
+                'duration': self.popularity_arrays.lookup(f'duration_{self.popularity_window}d', codes),
+                'count': self.popularity_arrays.lookup(f'count_{self.popularity_window}d', codes),
+                'session': self.popularity_arrays.lookup('session', codes),
+            }
+        elif self.popularity_scores is not None and self.session_popularity_scores is not None:
+            self.popularity = {key: np.full(len(self.vocabulary), np.nan) for key in ['duration', 'count', 'session']}
+            for code, item in enumerate(self.vocabulary.keys):
                 viewing_popularity_scores = self.popularity_scores.get(item, None)
-                # For GAPS and GDPS
                 if viewing_popularity_scores:
-                    duration_popularity.append(viewing_popularity_scores['duration_score'])
-                    count_popularity.append(viewing_popularity_scores['count_score'])
-                # For APS
-                if session_popularity_score:
-                    session_count_popularity.append(session_popularity_score)
-            # calculate the average popularity score
-            # avg_popularity_score = sum(popularity_scores) / len(popularity_scores) if popularity_scores else 0
-            avg_popularity_score = sum(duration_popularity) / len(duration_popularity) if duration_popularity else 0
-            avg_count_popularity_score = sum(count_popularity) / len(count_popularity) if count_popularity else 0
-            avg_session_popularity_score = sum(session_count_popularity) / len(session_count_popularity) if session_count_popularity else 0
-
-        avg_ctr = sum(ctrs) / len(ctrs) if ctrs else 0                
-        average_mrr = sum(mrrs) / len(mrrs) if mrrs else 0
-
-        # Coverage:
-        # Calculate the number of unique items recommended
-        unique_items = len(set(recommended_for_popularity))
-        items_count = len(self.popularity_scores)
-        coverage = unique_items / items_count if unique_items else 0
-
-        self._store_recs(model, method, w1, w2, K, N, mean_avg_precision, average_mrr, avg_ctr, self.R.missing_bridge_count, self.R.missing_cf_count, self.R.not_enough_bridge_count, \
-                         self.R.not_enough_cf_count, experiment_id, avg_popularity_score, avg_count_popularity_score, avg_session_popularity_score, coverage)
+                    self.popularity['duration'][code] = viewing_popularity_scores['duration_score']
+                    self.popularity['count'][code] = viewing_popularity_scores['count_score']
+                session_popularity_score = self.session_popularity_scores.get(item, None)
+                if session_popularity_score is not None:
+                    self.popularity['session'][code] = session_popularity_score
+
+    def _catalog_size(self):
+        if self.popularity_arrays is not None:
+            return self.popularity_arrays.catalog_size(f'duration_{self.popularity_window}d')
+        return len(self.popularity_scores) if self.popularity_scores is not None else None
+
+    def _encode_items(self, items, N):
+        # Item codes of a recommendation list, padded with -1 to N items
+        codes = [rec.code for rec in items[:N]]
+        return codes + [-1] * (N - len(codes))
+
+    @METRICS.timed('evaluator_seconds', phase='report')
+    def _report(self, model, method, w1, w2, K, N, experiment_id, result):
+        self._store_recs(model, method, w1, w2, K, N, result['map'], result['mrr'], result['ctr'], self.R.missing_bridge_count, self.R.missing_cf_count, self.R.not_enough_bridge_count, \
+                         self.R.not_enough_cf_count, experiment_id, result['avg_popularity_score'], result['avg_count_popularity_score'], result['avg_session_popularity_score'], result['coverage'])
         self.logger.info(f"Missing recommendations: {self.missing_recommendations}")
-        self.logger.info(f"Average CTR: {avg_ctr}")
-        self.logger.info(f"Average MRR: {average_mrr}")
-        self.logger.info(f"Mean Average Precision: {mean_avg_precision}")
-        self.logger.info(f"Average Duration Popularity Score: {avg_popularity_score}")
-        self.logger.info(f"Average Count Popularity Score: {avg_count_popularity_score}")
-        self.logger.info(f"Coverage: {coverage}")
+        self.logger.info(f"Average CTR: {result['ctr']}")
+        self.logger.info(f"Average MRR: {result['mrr']}")
+        self.logger.info(f"Mean Average Precision: {result['map']}")
+        self.logger.info(f"Average Duration Popularity Score: {result['avg_popularity_score']}")
+        self.logger.info(f"Average Count Popularity Score: {result['avg_count_popularity_score']}")
+        self.logger.info(f"Coverage: {result['coverage']}")
         self.logger.info(f"Rerank info: missing_bridges:{self.R.missing_bridge_count}, missing_cf:{self.R.missing_cf_count}, missing_enough_bridges:{self.R.not_enough_bridge_count}, missing_enough_cf:{self.R.not_enough_cf_count}")
         if self.slack:
             self.slack.send_results(
             f"{model},{method},{w1},{w2},{K},{N}",
-            avg_ctr=avg_ctr,
-            mean_avg_precision=mean_avg_precision,
-            avg_popularity_score=avg_popularity_score,
-            avg_count_popularity_score=avg_count_popularity_score,
-            coverage=coverage
-        )
\ No newline at end of file
+            avg_ctr=result['ctr'],
+            mean_avg_precision=result['map'],
+            avg_popularity_score=result['avg_popularity_score'],
+            avg_count_popularity_score=result['avg_count_popularity_score'],
+            coverage=result['coverage']
+        )
+
+    def _group_cases(self, cases=None):
+        # Cases that only differ in w1/w2 and N share their candidates. The cf and bridges models do not use K,
+        # so all their cases for a method are one group.
+        groups = {}
+        for case in self.evaluation_cases if cases is None else cases:
+            key = (case.model, case.method, case.K if case.model == "reranker" else None)
+            groups.setdefault(key, []).append(case)
+        return list(groups.items())
+
+    def _evaluate_groups(self, groups, experiment_id, workers=None):
+        """
+        Evaluates every group of cases in one scan of the test data per group. For the reranker the candidates
+        of a row are fetched once, ranked for every w1 in the group, and every N is taken from the same ranking.
+        Writes the same rows as the per case evaluation.
+        """
+        global _EVALUATION
+        self.logger.debug("Starting grid evaluation...")
+        self._prepare_codes()
+        pool = None
+        if workers and workers > 1:
+            # Forked workers see this evaluation, its models and test data without pickling them
+            _EVALUATION = self
+            # Fork while the other threads are idle: pending notifications are sent first, and the BLAS and
+            # OpenMP pools are limited to the calling thread, so the workers do not inherit a lock or a thread
+            # pool held by a thread that does not exist in them
+            if self.slack:
+                self.slack.flush(timeout=30)
+            with threadpoolctl.threadpool_limits(1):
+                pool = multiprocessing.get_context('fork').Pool(workers, initializer=_init_worker, initargs=(workers,))
+        try:
+            for (model, method, K), cases in groups:
+                if model != "cf" and method != self.Bridges.method:
+                    self.logger.debug("Changing method...")
+                    self.Bridges.change_method(method)
+                self.logger.debug(f"Model: {model}, Method: {method}, K: {K}, cases: {len(cases)}")
+                # The metrics of forked workers stay in the workers, the rank phase covers all of them
+                with METRICS.timer('evaluator_seconds', phase='rank'):
+                    if pool is None:
+                        metrics, counters = self._accumulate(model, method, K, cases, 0, len(self.users))
+                    else:
+                        bounds = np.linspace(0, len(self.users), workers + 1).astype(int)
+                        shards = pool.map(_evaluate_shard, [(model, method, K, cases, start, end) for start, end in zip(bounds[:-1], bounds[1:])])
+                        metrics, counters = self._merge_shards(shards)
+                self._report_group(cases, metrics, counters, experiment_id)
+                self._flush_results()
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+                _EVALUATION = None
+
+    def _weights(self, cases):
+        return sorted({(case.w1, case.w2) for case in cases})
+
+    def _accumulate(self, model, method, K, cases, start, end):
+        """
+        Evaluates the cases of one group on the test rows [start, end).
+
+        Returns:
+        - metrics (RankingAccumulator): The rankings of every weight in the group, cut at the largest N.
+        - counters (Tuple[int]): The Reranker missing_bridge, missing_cf, not_enough_bridge and not_enough_cf counts.
+        """
+        self._reset_counters()
+        weights = self._weights(cases)
+        metrics = RankingAccumulator(len(weights))
+        ranked = 0
+        for rows, rankings, counts in self._rank_rows(model, K, weights, max(case.N for case in cases), start, end):
+            metrics.add(rankings, self.target_codes[rows], self.user_codes[rows], counts)
+            ranked += len(rows)
+        metrics.missing_recommendations = (end - start) - ranked
+        counters = (self.R.missing_bridge_count, self.R.missing_cf_count, self.R.not_enough_bridge_count, self.R.not_enough_cf_count)
+        return metrics, counters
+
+    def _merge_shards(self, shards):
+        # Shards cover consecutive rows and are merged in order
+        metrics, counters = shards[0]
+        for shard_metrics, shard_counters in shards[1:]:
+            metrics.merge(shard_metrics)
+            counters = tuple(a + b for a, b in zip(counters, shard_counters))
+        return metrics, counters
+
+    def _report_group(self, cases, metrics, counters, experiment_id):
+        self.R.missing_bridge_count, self.R.missing_cf_count, self.R.not_enough_bridge_count, self.R.not_enough_cf_count = counters
+        weights = self._weights(cases)
+        for case in cases:
+            with METRICS.timer('evaluator_seconds', phase='metrics'):
+                result, self.missing_recommendations = metrics.result(weights.index((case.w1, case.w2)), case.N, self.popularity, self._catalog_size())
+            self._report(case.model, case.method, case.w1, case.w2, case.K, case.N, experiment_id, result)
+
+    def _rank_rows(self, model, K, weights, N, start, end, chunk_size=10000):
+        """
+        Ranks the test rows [start, end) in chunks, yielding (rows, rankings, counts) per chunk: the indices of
+        the rows that got recommendations, their (weights, rows, N) item codes and their number of unique
+        reranker candidates (None for the cf and bridges models).
+        """
+        with tqdm(total=end - start, desc='Processing recommendations', disable=not self.progress) as pbar:
+            for chunk_start in range(start, end, chunk_size):
+                chunk_end = min(chunk_start + chunk_size, end)
+                if model == "reranker":
+                    yield self._rank_reranker_rows(chunk_start, chunk_end, K, weights, N)
+                else:
+                    rows, rankings = [], []
+                    for i in range(chunk_start, chunk_end):
+                        if model == "cf":
+                            recs = self.CF.recommend_standard(self.users[i], N=N)
+                        elif model == "bridges":
+                            recs = self.Bridges.recommend_standard(self.item_strings[i], N=N)
+                        else:
+                            self.logger.error("Model not found.")
+                            continue
+                        if recs is None:
+                            continue
+                        rows.append(i)
+                        rankings.append(self._encode_items(recs.items, N))
+                    yield np.array(rows, dtype=np.int64), [np.array(rankings, dtype=np.int32).reshape(len(rows), N)] * len(weights), None
+                pbar.update(chunk_end - chunk_start)
+
+    def _rank_reranker_rows(self, start, end, K, weights, N):
+        rows = []
+        cf_items, cf_scores, bridge_items, bridge_scores = [], [], [], []
+        for i in range(start, end):
+            cf_recs, bridges = self.R._get_recs(self.users[i], self.item_strings[i], N, K)
+            if cf_recs is None:
+                continue
+            rows.append(i)
+            cf_items.append(self._encode_items(cf_recs.items, K))
+            cf_scores.append([rec.score for rec in cf_recs.items])
+            bridge_items.append(self._encode_items(bridges.items, K))
+            bridge_scores.append([rec.score for rec in bridges.items])
+
+        rows = np.array(rows, dtype=np.int64)
+        if not len(rows):
+            return rows, [np.empty((0, N), dtype=np.int32)] * len(weights), np.empty(0, dtype=np.int64)
+        cf_items = np.array(cf_items)
+        bridge_items = np.array(bridge_items)
+        w1 = np.array([weight[0] for weight in weights])
+        w2 = np.array([weight[1] for weight in weights])
+        items, _, _ = rerank_batch(cf_items, np.array(cf_scores, dtype=np.float32), bridge_items,
+                                   np.array(bridge_scores), N, w1, w2)
+        return rows, list(items), candidate_counts(cf_items, bridge_items)
@@ -0,0 +1,153 @@
+import math
+
+import numpy as np
+
+# Vectorized evaluation metrics over a (rows, N) matrix of recommended item codes, one row per test case,
+# padded with -1 where fewer than N items were recommended. Sums use math.fsum, so the results do not depend
+# on the order (or the sharding) of the rows.
+
+
+def hits(recommendations, targets):
+    # Whether the next item is among the recommended items of each row
+    return (recommendations == targets[:, None]).any(axis=1)
+
+
+def reciprocal_ranks(recommendations, targets):
+    # 1 / rank of the next item in each row, 0 when it was not recommended
+    match = recommendations == targets[:, None]
+    return np.where(match.any(axis=1), 1 / (match.argmax(axis=1) + 1), 0.0)
+
+
+def user_recommendations(recommendations, users):
+    """
+    Returns the unique (user, item) pairs of the recommendations as two aligned arrays, sorted by user.
+    """
+    n_items = int(recommendations.max()) + 1 if recommendations.size else 1
+    valid = recommendations >= 0
+    keys = np.unique(np.broadcast_to(users[:, None], recommendations.shape)[valid].astype(np.int64) * n_items +
+                     recommendations[valid])
+    return keys // n_items, keys % n_items
+
+
+def user_precision(recommendations, targets, users):
+    """
+    Precision of each user with at least one row: the number of distinct next items the user was recommended
+    anywhere, divided by the number of distinct items recommended to the user (0 when nothing was).
+
+    Returns:
+    - precision (np.ndarray): One value per distinct user code, in ascending user code order.
+    """
+    rec_users, rec_items = user_recommendations(recommendations, users)
+    n_items = int(max(rec_items.max() if len(rec_items) else 0, targets.max() if len(targets) else 0)) + 1
+    rec_keys = rec_users * n_items + rec_items
+    known = targets >= 0
+    target_keys = np.unique(users[known].astype(np.int64) * n_items + targets[known])
+    correct_users = target_keys[np.isin(target_keys, rec_keys)] // n_items
+
+    present = np.unique(users)
+    n_users = int(present.max()) + 1 if len(present) else 0
+    recommended = np.bincount(rec_users, minlength=n_users)[present]
+    correct = np.bincount(correct_users, minlength=n_users)[present]
+    return np.where(recommended > 0, correct / np.maximum(recommended, 1), 0.0)
+
+
+def mean(values):
+    return math.fsum(values) / len(values) if len(values) else 0
+
+
+def popularity_mean(items, popularity, skip_zero=False):
+    """
+    Average popularity of the recommended items. popularity is indexed by item code and NaN for items
+    without a score, which are skipped (as are zero scores with skip_zero).
+    """
+    values = popularity[items]
+    keep = ~np.isnan(values)
+    if skip_zero:
+        keep &= values != 0
+    return mean(values[keep].tolist())
+
+
+def coverage(items, n_items):
+    # Share of the catalog (of n_items) that was recommended at least once
+    unique_items = len(np.unique(items))
+    return unique_items / n_items if unique_items else 0
+
+
+def evaluate(recommendations, targets, users, popularity=None, n_items=None):
+    """
+    Computes every metric the evaluator stores for one case.
+
+    Parameters:
+    - recommendations (np.ndarray): (rows, N) recommended item codes, -1 for padding.
+    - targets (np.ndarray): (rows,) item code of the next item, -1 when it has no code.
+    - users (np.ndarray): (rows,) user code of each row.
+    - popularity (Dict[str, np.ndarray]): 'duration', 'count' and 'session' popularity by item code, or None.
+    - n_items (int): The number of items in the catalog, for coverage.
+
+    Returns:
+    - result (Dict[str, float]): The metrics, keyed like the columns of the results file.
+    """
+    rec_users, rec_items = user_recommendations(recommendations, users)
+    result = {
+        'map': mean(user_precision(recommendations, targets, users).tolist()),
+        'mrr': mean(reciprocal_ranks(recommendations, targets).tolist()),
+        'ctr': int(hits(recommendations, targets).sum()) / len(targets) if len(targets) else 0,
+        'avg_popularity_score': None,
+        'avg_count_popularity_score': None,
+        'avg_session_popularity_score': None,
+        'coverage': coverage(rec_items, n_items) if n_items is not None else None,
+    }
+    if popularity is not None:
+        result['avg_popularity_score'] = popularity_mean(rec_items, popularity['duration'])
+        result['avg_count_popularity_score'] = popularity_mean(rec_items, popularity['count'])
+        result['avg_session_popularity_score'] = popularity_mean(rec_items, popularity['session'], skip_zero=True)
+    return result
+
+
+class RankingAccumulator:
+    """
+    Collects the rankings of a group of cases as integer matrices: for every weight the top max(N) item codes
+    of each row, plus the target and user code of the row and the number of candidates it had. The result of a
+    case (weight, N) is computed from the first N columns of the rows that had more than N candidates.
+    """
+    def __init__(self, n_weights):
+        self.rankings = [[] for _ in range(n_weights)]
+        self.targets = []
+        self.users = []
+        self.counts = []
+        self.missing_recommendations = 0
+
+    def add(self, rankings, targets, users, counts=None):
+        # counts of None means every row is valid for every N, as for the cf and bridges models
+        if counts is None:
+            counts = np.full(len(targets), np.iinfo(np.int64).max)
+        for w, ranking in enumerate(rankings):
+            self.rankings[w].append(np.asarray(ranking, dtype=np.int32))
+        self.targets.append(np.asarray(targets, dtype=np.int32))
+        self.users.append(np.asarray(users, dtype=np.int32))
+        self.counts.append(np.asarray(counts, dtype=np.int64))
+
+    def merge(self, other):
+        # Appends the rows of an accumulator that covered the test rows after this one
+        for w, rankings in enumerate(other.rankings):
+            self.rankings[w].extend(rankings)
+        self.targets.extend(other.targets)
+        self.users.extend(other.users)
+        self.counts.extend(other.counts)
+        self.missing_recommendations += other.missing_recommendations
+        return self
+
+    def result(self, w, N, popularity=None, n_items=None):
+        """
+        Returns the metrics of weight w cut at N, and the number of rows without recommendations.
+        """
+        width = max([ranking.shape[1] for ranking in self.rankings[w]] + [N])
+        rankings = [np.pad(ranking, ((0, 0), (0, width - ranking.shape[1])), constant_values=-1) for ranking in self.rankings[w]]
+        rankings = np.concatenate(rankings) if rankings else np.empty((0, width), dtype=np.int32)
+        targets = np.concatenate(self.targets) if self.targets else np.empty(0, dtype=np.int32)
+        users = np.concatenate(self.users) if self.users else np.empty(0, dtype=np.int32)
+        counts = np.concatenate(self.counts) if self.counts else np.empty(0, dtype=np.int64)
+        # The reranker returns None unless it has more than N unique candidates
+        valid = counts > N
+        missing = self.missing_recommendations + int((~valid).sum())
+        return evaluate(rankings[valid, :N], targets[valid], users[valid], popularity, n_items), missing
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+# The metric columns of a result, in the order of the results CSV
+RESULT_COLUMNS = ['MAP', 'avgmrr', 'avgctr', 'missing_bridges', 'missing_cf', 'not_enough_bridges', 'not_enough_cf',
+                  'averege_duration_popularity_scores', 'averege_count_popularity_scores', 'avg_session_popularity_score', 'coverage']
+CASE_COLUMNS = ['model', 'method', 'w1', 'w2', 'K', 'N']
+
+
+def fingerprint(*parts):
+    """
+    Short hash of the models and data an evaluation ran on. Arrays (and sparse matrices) are hashed by their
+    contents, everything else by its JSON form, so the fingerprint only changes when the inputs do.
+    """
+    digest = hashlib.sha1()
+    for part in parts:
+        if hasattr(part, 'indptr'):
+            part = [part.shape, part.indptr, part.indices, part.data]
+        for value in part if isinstance(part, (list, tuple)) else [part]:
+            if isinstance(value, np.ndarray):
+                digest.update(str((value.dtype, value.shape)).encode())
+                digest.update(np.ascontiguousarray(value).data if value.dtype != object else value.astype(str).tobytes())
+            else:
+                digest.update(json.dumps(value, default=str, sort_keys=True).encode())
+    return digest.hexdigest()[:16]
+
+
+class ResultsStore:
+    """
+    SQLite store of evaluation results, one row per (experiment, fingerprint, case). Rows are buffered and
+    written batch_size at a time in one transaction, and an evaluation can ask which of its cases already
+    have results for its experiment and fingerprint, so a rerun after a crash only evaluates the rest.
+
+    Parameters:
+    - path (str): The SQLite file, created if it does not exist.
+    - batch_size (int): The number of buffered rows that triggers a write.
+    """
+    def __init__(self, path, batch_size=20):
+        self.path = path
+        self.batch_size = batch_size
+        self.pending = []
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        # WAL lets the notebook read while a sweep writes
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        metrics = ', '.join(f'{column} REAL' for column in RESULT_COLUMNS)
+        self.connection.execute(f"""
+            CREATE TABLE IF NOT EXISTS results (
+                experiment_id TEXT NOT NULL, fingerprint TEXT NOT NULL,
+                model TEXT NOT NULL, method TEXT NOT NULL, w1 REAL NOT NULL, w2 REAL NOT NULL, K INTEGER NOT NULL, N INTEGER NOT NULL,
+                {metrics}, created REAL,
+                PRIMARY KEY (experiment_id, fingerprint, model, method, w1, w2, K, N)
+            )""")
+        self.connection.commit()
+
+    def add(self, experiment_id, fingerprint, case, result):
+        """
+        Buffers the result of one case.
+
+        Parameters:
+        - case (EvaluationCase or Tuple): The (model, method, w1, w2, K, N) of the result.
+        - result (dict): The value of every column in RESULT_COLUMNS.
+        """
+        values = [None if result[column] is None else float(result[column]) for column in RESULT_COLUMNS]
+        self.pending.append((experiment_id, fingerprint, *self._key(case), *values, time.time()))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        columns = ['experiment_id', 'fingerprint'] + CASE_COLUMNS + RESULT_COLUMNS + ['created']
+        with self.connection:
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO results ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", self.pending)
+        self.pending = []
+
+    def completed(self, experiment_id, fingerprint):
+        # The (model, method, w1, w2, K, N) of every case with a stored result
+        self.flush()
+        rows = self.connection.execute(f"SELECT {', '.join(CASE_COLUMNS)} FROM results WHERE experiment_id = ? AND fingerprint = ?",
+                                       (experiment_id, fingerprint))
+        return {self._key(row) for row in rows}
+
+    def pending_cases(self, experiment_id, fingerprint, cases):
+        completed = self.completed(experiment_id, fingerprint)
+        return [case for case in cases if self._key(case) not in completed]
+
+    def read(self, experiment_id=None, fingerprint=None):
+        """
+        Loads the stored results as a DataFrame with the columns of the results CSV, optionally of one
+        experiment and fingerprint.
+        """
+        self.flush()
+        query, params = "SELECT * FROM results", []
+        filters = [(column, value) for column, value in [('experiment_id', experiment_id), ('fingerprint', fingerprint)] if value is not None]
+        if filters:
+            query += " WHERE " + " AND ".join(f"{column} = ?" for column, _ in filters)
+            params = [value for _, value in filters]
+        return pd.read_sql_query(query + " ORDER BY created", self.connection, params=params)
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def _key(self, case):
+        model, method, w1, w2, K, N = (case.model, case.method, case.w1, case.w2, case.K, case.N) if hasattr(case, 'model') else case
+        return model, method, float(w1), float(w2), int(K), int(N)
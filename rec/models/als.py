@@ -1,17 +1,21 @@
-import pyarrow.parquet as pq
-import glob
-
 import pandas as pd
 import numpy as np
-from scipy.sparse import coo_matrix
+from scipy.sparse import coo_matrix, csr_matrix, vstack
 import logging
+import json
+import os
 from implicit.als import AlternatingLeastSquares
 from implicit.nearest_neighbours import bm25_weight
+from rec.models.ann import IVFIndex
 from rec.types.types import Recommendation, RecommendedItem
+from rec.utils.data import CF_COLUMNS, load_table, read_ids, release_arrow_memory, to_pandas, write_ids
+from rec.utils.metrics import METRICS
+from rec.utils.vocabulary import ITEMS, USERS, CodeMap
 import threadpoolctl
 
 class CFRecommender:
-    def __init__(self, factors=20, use_gpu=False, use_cg=False, iterations=10, logger=None):
+    def __init__(self, factors=20, use_gpu=False, use_cg=False, iterations=10, logger=None, lean=False, vocabulary=None,
+                 user_vocabulary=None, random_state=42):
 
         threadpoolctl.threadpool_limits(12, "blas")
 
@@ -21,116 +25,413 @@ class CFRecommender:
             factors=factors,
             use_gpu=use_gpu,
             use_cg=use_cg,
-            iterations=iterations
+            iterations=iterations,
+            # A fixed seed makes a refit on the same data give the same factors, see Evaluation.data_fingerprint
+            random_state=random_state
         )
+        # Bumped on every fit, so caches built on this model know when they are stale
+        self.version = 0
+        # Optional approximate retrieval, see build_ann_index
+        self.ann = None
+        # Users whose factors were folded in since the last fit, see fold_in
+        self.folded_in = pd.Index([])
+        # Lean mode reads the IDs as categoricals and drops the raw data and the sessions once they are used,
+        # the fitted model is the same
+        self.lean = lean
+        self.data = None
+        self.sessions = None
+        # The shared vocabularies user IDs are looked up in and recommended items are coded in
+        self.vocabulary = vocabulary if vocabulary is not None else ITEMS
+        self.user_vocabulary = user_vocabulary if user_vocabulary is not None else USERS
+        self._item_map = None
+        self._user_map = None
 
+    @METRICS.timed('cf_fit_seconds', memory=True, stage='load')
     def load_data(self, path, nested=False, limit=-1):
-        i = 0
-        if nested:
-            dfs = []
-            for file in glob.glob(path + "/**/*.parquet", recursive=True):
-                if i > limit and limit != -1:
-                    break
-                df = pq.read_table(file).to_pandas()
-                self.logger.debug("Loaded file: " + file + " with shape: " + str(df.shape))
-                dfs.append(df)
-                i += 1
-            self.data = pd.concat(dfs, ignore_index=True)
-        else:
-            self.data = pq.read_table(path).to_pandas()
+        if not self.lean:
+            table = load_table(path, columns=CF_COLUMNS, nested=nested, limit=limit, logger=self.logger)
+            self.data = to_pandas(table)
+            return
+        table = load_table(path, columns=CF_COLUMNS, nested=nested, limit=limit, logger=self.logger,
+                           dictionary_columns=['profileId', 'itemId'])
+        self.data = to_pandas(table)
+        release_arrow_memory()
 
     def _bm25(self, uim, K1=3.0, B=1.0):
 
         return bm25_weight(uim, K1=K1, B=B)
 
+    @METRICS.timed('cf_fit_seconds', memory=True, stage='preprocess')
     def preprocess(self):
+        if self.lean:
+            self.sessions = self._preprocess_categorical()
+            self.data = None
+            return
         self.sessions = self.data[["profileId", "itemId", "durationSec"]] \
             .rename(index=str, columns={'profileId': 'userId', 'durationSec': 'score'}) \
             .groupby(["userId", "itemId"]).sum() \
             .reset_index()
 
+    def _preprocess_categorical(self):
+        # The sessions of categorical IDs, only grouping the (user, item) pairs that occur
+        sessions = self.data[["profileId", "itemId", "durationSec"]] \
+            .rename(columns={'profileId': 'userId', 'durationSec': 'score'}) \
+            .groupby(["userId", "itemId"], observed=True).sum() \
+            .reset_index()
+        for key in ['userId', 'itemId']:
+            # Sorted categories give the users and items the codes of the default mode
+            categories = sessions[key].cat.remove_unused_categories().cat.categories
+            sessions[key] = sessions[key].cat.set_categories(categories.sort_values())
+        # The user-item matrix is float32, so the scores are too
+        sessions['score'] = sessions['score'].astype(np.float32)
+        return sessions
+
+    @METRICS.timed('cf_fit_seconds', memory=True, stage='total')
     def fit(self, K1=1.2, B=0.75):
         # set types for user and item IDs
         self.sessions['userId'] = self.sessions['userId'].astype("category")
         self.sessions['itemId'] = self.sessions['itemId'].astype("category")
 
-        # Dicts of item/usery IDX to ID
-        self.items = dict(enumerate(self.sessions['itemId'].cat.categories))
-        self.users = dict(enumerate(self.sessions['userId'].cat.categories))
-
-        # Reverse dicts of user/item mappings
-        self.items_rev = {val: key for key, val in self.items.items()}
-        self.users_rev = {val: key for key, val in self.users.items()}
+        self._set_vocabulary(self.sessions['userId'].cat.categories, self.sessions['itemId'].cat.categories)
         # Build Item-User interaction matrix
-        self.uim = coo_matrix(
-            (self.sessions['score'].astype(np.float32),
-             (self.sessions['userId'].cat.codes,
-              self.sessions['itemId'].cat.codes))
-        ).tocsr()
+        with METRICS.timer('cf_fit_seconds', stage='matrix'):
+            self.uim = coo_matrix(
+                (self.sessions['score'].astype(np.float32),
+                 (self.sessions['userId'].cat.codes,
+                  self.sessions['itemId'].cat.codes))
+            ).tocsr()
+        if self.lean:
+            self.sessions = None
 
         # Fit model
     
         self._bm25(self.uim, K1, B)
-        self.model.fit(self.uim, show_progress=True)
+        with METRICS.timer('cf_fit_seconds', stage='als'):
+            self.model.fit(self.uim, show_progress=True)
+        self.folded_in = pd.Index([])
+        self.version += 1
+        if self.ann is not None:
+            self.build_ann_index(self.ann.n_lists, self.ann.n_probe)
+
+    def build_ann_index(self, n_lists=None, n_probe=8, iterations=10):
+        """
+        Builds an IVF index over the item factors, after which recommend_scores, recommend_standard and
+        recommend_batch only score the items of the n_probe lists closest to the user instead of the whole
+        catalog. The index is rebuilt on fit, call remove_ann_index to go back to exact scoring.
+
+        Parameters:
+        - n_lists (int): The number of k-means lists, defaults to sqrt(n_items).
+        - n_probe (int): The number of lists scanned per user, higher is slower with a higher recall.
+        """
+        self.ann = IVFIndex(n_lists=n_lists, n_probe=n_probe, iterations=iterations).fit(self.model.item_factors)
+        self.version += 1
+        return self.ann
+
+    def remove_ann_index(self):
+        self.ann = None
+        self.version += 1
+
+    def fold_in(self, data):
+        """
+        Adds new viewing rows without refitting: new users are appended to the vocabulary and the user-item
+        matrix, the rows of known users get the new durations added, and the factors of only these users are
+        solved against the fixed item factors (AlternatingLeastSquares.partial_fit_users). Rows of items the
+        model does not know are skipped, those need a refit.
+
+        Parameters:
+        - data (pd.DataFrame): Viewing rows with the CF_COLUMNS (profileId, itemId, durationSec).
+
+        Returns:
+        - users (pd.Index): The IDs of the users that were folded in.
+        """
+        sessions = data[["profileId", "itemId", "durationSec"]] \
+            .rename(index=str, columns={'profileId': 'userId', 'durationSec': 'score'}) \
+            .groupby(["userId", "itemId"]).sum() \
+            .reset_index()
+        items = self.item_map.codes(sessions['itemId'].to_numpy())
+        if (items < 0).any():
+            self.logger.debug(f"Skipping {(items < 0).sum()} user-item pairs of items that are not in the model")
+            sessions, items = sessions[items >= 0], items[items >= 0]
+        if len(sessions) == 0:
+            return pd.Index([])
+
+        users = pd.Index(pd.unique(sessions['userId']))
+        new_users = users[self.user_index.get_indexer(users) < 0]
+        if len(new_users):
+            self.user_index = self.user_index.append(new_users)
+            self._user_map = None
+        rows = self.user_map.codes(sessions['userId'].to_numpy())
+        shape = (len(self.user_index), self.uim.shape[1])
+        delta = coo_matrix((sessions['score'].astype(np.float32), (rows, items)), shape=shape).tocsr()
+        uim = self.uim if self.uim.shape == shape else vstack([self.uim, csr_matrix((shape[0] - self.uim.shape[0], shape[1]), dtype=self.uim.dtype)])
+        self.uim = (uim + delta).tocsr()
+
+        codes = self.user_map.codes(users.to_numpy())
+        # Factors loaded with mmap are read-only, and implicit needs both writable to solve the users
+        if not np.asarray(self.model.user_factors).flags.writeable:
+            self.model.user_factors = np.array(self.model.user_factors)
+        if not np.asarray(self.model.item_factors).flags.writeable:
+            self.model.item_factors = np.array(self.model.item_factors)
+        self.model.partial_fit_users(codes, self.uim[codes])
+        self.folded_in = self.folded_in.append(users).unique()
+        self.version += 1
+        self.logger.debug(f"Folded in {len(users)} users, {len(new_users)} of them new")
+        return users
+
+    def drift_report(self, reference, user_ids=None, N=20, batch_size=10000):
+        """
+        Compares the factors of folded in users with the factors of a reference model, normally a full refit
+        on the same data. ALS factors of separate fits are not comparable directly, so the comparison is on the
+        scores the factors give the items both models know.
+
+        Parameters:
+        - reference (CFRecommender): The model to compare with.
+        - user_ids (array-like): The users to compare, by default the users folded in since the last fit.
+        - N (int): The length of the top lists that are compared.
+
+        Returns:
+        - report (Dict[str, float]): The number of users compared (and missing from the reference), the mean and
+          10th percentile correlation of their item scores, and the mean overlap of their top N items.
+
+        Raises:
+        - ValueError: If the two models share no items.
+        """
+        user_ids = self.folded_in if user_ids is None else pd.Index(user_ids)
+        reference_users = reference.user_codes(user_ids)
+        users = self.user_codes(user_ids)
+        found = (users >= 0) & (reference_users >= 0)
+        users, reference_users = users[found], reference_users[found]
+
+        common = self.item_index.intersection(reference.item_index)
+        if not len(common):
+            raise ValueError("The model and the reference have no items in common, their scores cannot be compared")
+        items = self.item_index.get_indexer(common)
+        reference_items = reference.item_index.get_indexer(common)
+        item_factors = np.asarray(self.model.item_factors)[items]
+        reference_item_factors = np.asarray(reference.model.item_factors)[reference_items]
+        N = min(N, len(common))
+
+        correlations, overlaps = [], []
+        for start in range(0, len(users), batch_size):
+            scores = np.asarray(self.model.user_factors)[users[start:start + batch_size]] @ item_factors.T
+            reference_scores = np.asarray(reference.model.user_factors)[reference_users[start:start + batch_size]] @ reference_item_factors.T
+            centered = scores - scores.mean(axis=1, keepdims=True)
+            reference_centered = reference_scores - reference_scores.mean(axis=1, keepdims=True)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                correlations.append((centered * reference_centered).sum(axis=1) /
+                                    np.sqrt((centered ** 2).sum(axis=1) * (reference_centered ** 2).sum(axis=1)))
+            top = np.argpartition(-scores, N - 1, axis=1)[:, :N]
+            reference_top = np.argpartition(-reference_scores, N - 1, axis=1)[:, :N]
+            overlaps.append((top[:, :, None] == reference_top[:, None, :]).any(axis=2).sum(axis=1) / N)
+        correlations = np.concatenate(correlations) if correlations else np.empty(0)
+        overlaps = np.concatenate(overlaps) if overlaps else np.empty(0)
+        report = {
+            'users': int(found.sum()),
+            'missing_users': int((~found).sum()),
+            'score_correlation_mean': float(np.nanmean(correlations)) if len(correlations) else None,
+            'score_correlation_p10': float(np.nanpercentile(correlations, 10)) if len(correlations) else None,
+            f'top_{N}_overlap_mean': float(overlaps.mean()) if len(overlaps) else None,
+        }
+        self.logger.info(f"Fold-in drift: {report}")
+        return report
+
+    def _set_vocabulary(self, users, items):
+        # The user and item IDs by code, the rows and columns of the user-item matrix. IDs are looked up through
+        # the shared vocabularies, with the code maps built on the first lookup
+        self.user_index = pd.Index(users)
+        self.item_index = pd.Index(items)
+        self._user_map = None
+        self._item_map = None
+
+    @property
+    def user_map(self):
+        # Maps the rows of the user-item matrix to the shared user vocabulary and back
+        if self._user_map is None:
+            self._user_map = CodeMap(self.user_vocabulary, self.user_index.to_numpy())
+        return self._user_map
+
+    @property
+    def item_map(self):
+        # Maps the columns of the user-item matrix to the shared item vocabulary and back
+        if self._item_map is None:
+            self._item_map = CodeMap(self.vocabulary, self.item_index.to_numpy())
+        return self._item_map
+
+    def save(self, path):
+        """
+        Saves the fitted model to a directory: the user and item factors and the CSR arrays of the user-item
+        matrix as .npy files, the user and item vocabularies as Arrow files, and the parameters as json.
+        """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'user_factors.npy'), np.asarray(self.model.user_factors))
+        np.save(os.path.join(path, 'item_factors.npy'), np.asarray(self.model.item_factors))
+        np.save(os.path.join(path, 'uim_data.npy'), self.uim.data)
+        np.save(os.path.join(path, 'uim_indices.npy'), self.uim.indices)
+        np.save(os.path.join(path, 'uim_indptr.npy'), self.uim.indptr)
+        write_ids(os.path.join(path, 'users.arrow'), self.user_index)
+        write_ids(os.path.join(path, 'items.arrow'), self.item_index)
+        with open(os.path.join(path, 'cf.json'), 'w') as f:
+            json.dump({
+                'factors': self.model.factors,
+                'iterations': self.model.iterations,
+                'regularization': self.model.regularization,
+                'alpha': self.model.alpha,
+                'random_state': self.model.random_state,
+                'uim_shape': list(self.uim.shape),
+            }, f)
+
+    @classmethod
+    def load(cls, path, mmap=True, logger=None, vocabulary=None, user_vocabulary=None):
+        """
+        Loads a model saved with save. With mmap the factors and the user-item matrix are memory mapped
+        read-only, so loading is fast and processes loading the same files share their pages. The user and item
+        IDs stay in their (memory mapped) Arrow columns, see read_ids, and are only added to the shared
+        vocabularies on the first lookup.
+        """
+        mmap_mode = 'r' if mmap else None
+        with open(os.path.join(path, 'cf.json')) as f:
+            params = json.load(f)
+        cf = cls(factors=params['factors'], iterations=params['iterations'], logger=logger, vocabulary=vocabulary,
+                 user_vocabulary=user_vocabulary, random_state=params.get('random_state'))
+        cf.model.regularization = params['regularization']
+        cf.model.alpha = params['alpha']
+        cf.model.user_factors = np.load(os.path.join(path, 'user_factors.npy'), mmap_mode=mmap_mode)
+        cf.model.item_factors = np.load(os.path.join(path, 'item_factors.npy'), mmap_mode=mmap_mode)
+        cf.uim = csr_matrix((np.load(os.path.join(path, 'uim_data.npy'), mmap_mode=mmap_mode),
+                             np.load(os.path.join(path, 'uim_indices.npy'), mmap_mode=mmap_mode),
+                             np.load(os.path.join(path, 'uim_indptr.npy'), mmap_mode=mmap_mode)),
+                            shape=tuple(params['uim_shape']), copy=False)
+        cf._set_vocabulary(read_ids(os.path.join(path, 'users.arrow'), mmap), read_ids(os.path.join(path, 'items.arrow'), mmap))
+        cf.version += 1
+        return cf
 
     def recommend(self, user_id, N=5):
-        u = self.users_rev.get(user_id, None)
-        try:    
-            i = self.uim[self.users_rev[user_id]]
-        except Exception as e:
-            self.logger.error(e)
-            i = None
+        u = self.user_code(user_id)
         if u is None:
             self.logger.error("User not found")
             return None
-        if i is None:
-            self.logger.error("Item not found")
-            return None
-        return self.model.recommend(u, self.uim[self.users_rev[user_id]], N=N)
+        i = self.uim[u]
+        return self.model.recommend(u, i, N=N)
     
     def recommend_items(self, user_id, N=5):
-        u = self.users_rev.get(user_id, None)
-        try:    
-            i = self.uim[self.users_rev[user_id]]
-        except Exception as e:
-            self.logger.error(e)
-            i = None
+        u = self.user_code(user_id)
         if u is None:
             self.logger.error("User not found")
             return None
-        if i is None:
-            self.logger.error("Item not found")
-            return None
+        i = self.uim[u]
         
         try:
-            recs = self.model.recommend(u, self.uim[self.users_rev[user_id]], N=N)[0]
-            return [self.items.get(rec) for rec in recs]
+            recs = self.model.recommend(u, i, N=N)[0]
+            return list(self.item_ids(recs))
         except Exception as e:
             self.logger.error(e)
             return None
         
     def recommend_standard(self, user_id, N=5) -> Recommendation:
-        recommendation = Recommendation(user_id, None, {}, [], [])
-        u = self.users_rev.get(user_id, None)
-        try:    
-            i = self.uim[self.users_rev[user_id]]
-        except Exception as e:
-            self.logger.error(e)
-            i = None
+        recs = self.recommend_scores(user_id, N=N)
+        if recs is None:
+            return None
+        return self.to_recommendation(user_id, recs[0], recs[1])
+
+    def recommend_scores(self, user_id, N=5):
+        """
+        Returns the item codes and raw (unnormalized) scores of the top N items for a user, or None if the
+        user is not in the model.
+        """
+        u = self.user_code(user_id)
         if u is None:
             self.logger.error("User not found")
             return None
-        if i is None:
-            self.logger.error("Item not found")
-            return None
-        
+        i = self.uim[u]
+
         try:
-            recs = self.model.recommend(u, self.uim[self.users_rev[user_id]], N=N)
-            items, scores = recs[0], recs[1]
-            scores_np = np.array(scores)
-            scores = (scores_np - scores_np.min()) / (scores_np.max() - scores_np.min())
-            recommendation.items = [RecommendedItem(self.items.get(items[i]), scores[i], "CF") for i in range(len(items))]
-            return recommendation
+            if self.ann is not None:
+                return self.ann.search(self.model.user_factors[u], N, exclude=i.indices)
+            return self.model.recommend(u, i, N=N)
         except Exception as e:
             self.logger.error(e)
-            return None
\ No newline at end of file
+            return None
+
+    def to_recommendation(self, user_id, items, scores) -> Recommendation:
+        # Min-max normalizes the raw scores of a top N list into a Recommendation
+        recommendation = Recommendation(user_id, None, {}, [], [])
+        scores_np = np.array(scores)
+        scores = (scores_np - scores_np.min()) / (scores_np.max() - scores_np.min())
+        ids = self.item_ids(items)
+        codes = self.item_map.to_shared(items)
+        recommendation.items = [RecommendedItem(ids[i], scores[i], "CF", int(codes[i])) for i in range(len(items))]
+        return recommendation
+
+    def user_code(self, user_id):
+        # The row of a user in the user-item matrix, None for unknown users
+        code = self.user_map.code(user_id)
+        return code if code >= 0 else None
+
+    def user_codes(self, user_ids):
+        # Maps user IDs to their row in the user-item matrix, -1 for unknown users
+        return self.user_map.codes(np.asarray(user_ids, dtype=object))
+
+    def item_ids(self, item_codes):
+        # Maps item codes back to item IDs, padded (-1) codes become None
+        item_codes = np.asarray(item_codes)
+        # take only converts the IDs it returns, the index can be a memory mapped Arrow column
+        ids = self.item_index.take(np.where(item_codes < 0, 0, item_codes).ravel()).to_numpy(dtype=object).reshape(item_codes.shape)
+        ids[item_codes < 0] = None
+        return ids
+
+    def recommend_batch(self, user_ids, N=5, batch_size=None, normalize=True):
+        """
+        Recommends N items for many users at once.
+
+        Parameters:
+        - user_ids (array-like): The user IDs to recommend for.
+        - N (int): The number of items per user.
+        - batch_size (int): The number of users scored per matrix product, by default sized to keep the
+          (batch_size, n_items) score matrix around 256MB.
+        - normalize (bool): Min-max normalize the scores per user, as recommend_standard does.
+
+        Returns:
+        - item_codes (np.ndarray): (n_users, N) int32 item codes, -1 where there is no recommendation.
+        - scores (np.ndarray): (n_users, N) float32 scores, NaN where there is no recommendation.
+        - found (np.ndarray): (n_users,) bool mask, False for users that are not in the model.
+        """
+        codes = self.user_codes(user_ids)
+        found = codes >= 0
+        item_codes = np.full((len(codes), N), -1, dtype=np.int32)
+        scores = np.full((len(codes), N), np.nan, dtype=np.float32)
+
+        rows = np.flatnonzero(found)
+        if batch_size is None:
+            batch_size = max(1, 2 ** 26 // self.uim.shape[1])
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            ids, batch_scores = self._topk(codes[batch], N)
+            item_codes[batch, :ids.shape[1]] = ids
+            scores[batch, :ids.shape[1]] = batch_scores
+
+        if normalize:
+            low = np.nanmin(scores, axis=1, keepdims=True, initial=np.inf, where=~np.isnan(scores))
+            high = np.nanmax(scores, axis=1, keepdims=True, initial=-np.inf, where=~np.isnan(scores))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                scores = (scores - low) / (high - low)
+        return item_codes, scores, found
+
+    def _topk(self, users, N):
+        if self.ann is not None:
+            return self.ann.search_batch(self.model.user_factors[users], N, liked=self.uim[users])
+        # One matrix product for the whole batch, items the users already watched are filtered like model.recommend does
+        scores = np.asarray(self.model.user_factors[users]) @ np.asarray(self.model.item_factors).T
+        liked = self.uim[users]
+        scores[np.repeat(np.arange(len(users)), np.diff(liked.indptr)), liked.indices] = -np.inf
+
+        N = min(N, scores.shape[1])
+        top = np.argpartition(-scores, N - 1, axis=1)[:, :N] if N < scores.shape[1] else np.tile(np.arange(N), (len(users), 1))
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        ids = np.take_along_axis(top, order, axis=1).astype(np.int32)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        # Users that have watched almost everything get fewer than N items
+        missing = np.isneginf(top_scores)
+        ids[missing] = -1
+        top_scores[missing] = np.nan
+        return ids, top_scores
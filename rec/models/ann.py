@@ -0,0 +1,137 @@
+import numpy as np
+
+
+class IVFIndex:
+    """
+    Inverted file index for approximate top-K inner product search over the item factors of a CF model.
+
+    The items are clustered with k-means into n_lists lists. A query scores the centroids, and only the items
+    of the n_probe best lists are scored exactly, so a query costs about n_probe / n_lists of an exact scoring.
+    More probes give a higher recall for a lower throughput, n_probe = n_lists is exact.
+    """
+    def __init__(self, n_lists=None, n_probe=8, iterations=10, seed=0):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.iterations = iterations
+        self.seed = seed
+
+    def fit(self, item_factors):
+        item_factors = np.asarray(item_factors, dtype=np.float32)
+        n_items = len(item_factors)
+        n_lists = self.n_lists or max(1, int(np.sqrt(n_items)))
+        n_lists = min(n_lists, n_items)
+        rng = np.random.default_rng(self.seed)
+
+        centroids = item_factors[rng.choice(n_items, n_lists, replace=False)].copy()
+        for _ in range(self.iterations):
+            assignment = self._assign(item_factors, centroids)
+            counts = np.bincount(assignment, minlength=n_lists)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, item_factors)
+            empty = counts == 0
+            centroids[~empty] = sums[~empty] / counts[~empty, None]
+            # Empty lists restart from random items
+            centroids[empty] = item_factors[rng.choice(n_items, empty.sum(), replace=False)]
+        assignment = self._assign(item_factors, centroids)
+
+        # The items of each list are stored contiguously, with their factors in the same order
+        self.item_codes = np.argsort(assignment, kind='stable').astype(np.int32)
+        self.vectors = item_factors[self.item_codes]
+        self.list_indptr = np.r_[0, np.cumsum(np.bincount(assignment, minlength=n_lists))]
+        # List and position of each item code, to find excluded items among the candidates
+        self.lists = assignment
+        self.positions = np.empty(n_items, dtype=np.int64)
+        self.positions[self.item_codes] = np.arange(n_items)
+        self.centroids = centroids
+        self.n_lists = n_lists
+        return self
+
+    def _assign(self, vectors, centroids, batch_size=65536):
+        # Nearest centroid by euclidean distance, ||c||^2 - 2 x.c is enough to compare
+        norms = (centroids ** 2).sum(axis=1)
+        assignment = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), batch_size):
+            distances = norms[None, :] - 2 * vectors[start:start + batch_size] @ centroids.T
+            assignment[start:start + batch_size] = distances.argmin(axis=1)
+        return assignment
+
+    def probe(self, user_factors, n_probe=None):
+        # The n_probe lists with the highest centroid score for each query, (queries, n_probe)
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        scores = user_factors @ self.centroids.T
+        if n_probe == self.n_lists:
+            return np.broadcast_to(np.arange(self.n_lists), scores.shape)
+        return np.argpartition(-scores, n_probe - 1, axis=1)[:, :n_probe]
+
+    def search(self, user_factor, N, exclude=None, n_probe=None):
+        """
+        Approximate top N items for one user factor vector.
+
+        Parameters:
+        - user_factor (np.ndarray): (factors,) user vector.
+        - N (int): The number of items to return.
+        - exclude (np.ndarray): Item codes to leave out, like the items the user already watched.
+        - n_probe (int): The number of lists to scan, defaults to the n_probe of the index.
+
+        Returns:
+        - items (np.ndarray): Up to N item codes, by descending score.
+        - scores (np.ndarray): Their inner product scores.
+        """
+        user_factor = np.asarray(user_factor, dtype=np.float32)
+        lists = self.probe(user_factor[None, :], n_probe)[0]
+        return self._search_lists(user_factor, lists, N, exclude)
+
+    def search_batch(self, user_factors, N, liked=None, n_probe=None):
+        """
+        Approximate top N items for a batch of users, in the format of CFRecommender._topk.
+
+        Parameters:
+        - user_factors (np.ndarray): (B, factors) user vectors.
+        - liked (scipy.sparse.csr_matrix): (B, n_items) rows of the user-item matrix, whose items are left out.
+
+        Returns:
+        - ids (np.ndarray): (B, N) int32 item codes, -1 where fewer than N items were found.
+        - scores (np.ndarray): (B, N) float32 scores, NaN where fewer than N items were found.
+        """
+        user_factors = np.asarray(user_factors, dtype=np.float32)
+        ids = np.full((len(user_factors), N), -1, dtype=np.int32)
+        scores = np.full((len(user_factors), N), np.nan, dtype=np.float32)
+        lists = self.probe(user_factors, n_probe)
+        for row in range(len(user_factors)):
+            exclude = liked.indices[liked.indptr[row]:liked.indptr[row + 1]] if liked is not None else None
+            row_ids, row_scores = self._search_lists(user_factors[row], lists[row], N, exclude)
+            ids[row, :len(row_ids)] = row_ids
+            scores[row, :len(row_scores)] = row_scores
+        return ids, scores
+
+    def _search_lists(self, user_factor, lists, N, exclude):
+        lists = np.asarray(lists)
+        starts = self.list_indptr[lists]
+        lengths = self.list_indptr[lists + 1] - starts
+        offsets = np.r_[0, np.cumsum(lengths)[:-1]]
+        if lengths.sum() == len(self.vectors):
+            # Every list is probed, the candidates are all items in stored order
+            lists, starts, offsets = np.arange(self.n_lists), self.list_indptr[:-1], self.list_indptr[:-1]
+            positions = slice(None)
+        else:
+            # Positions of the items of the probed lists, concatenated without a python loop
+            positions = np.arange(lengths.sum()) + np.repeat(starts - offsets, lengths)
+        candidates = self.item_codes[positions]
+        scores = self.vectors[positions] @ user_factor
+        if exclude is not None and len(exclude):
+            # Candidate index of each excluded item whose list was probed. The offset of a list is usually
+            # negative (its items move to the front of the candidates), so probed lists are kept in a mask
+            list_offset = np.zeros(self.n_lists, dtype=np.int64)
+            list_offset[lists] = offsets - starts
+            list_probed = np.zeros(self.n_lists, dtype=bool)
+            list_probed[lists] = True
+            exclude_lists = self.lists[exclude]
+            probed = list_probed[exclude_lists]
+            scores[list_offset[exclude_lists[probed]] + self.positions[exclude][probed]] = -np.inf
+        N = min(N, len(scores))
+        if N == 0:
+            return candidates[:0], scores[:0]
+        top = np.argpartition(-scores, N - 1)[:N] if N < len(scores) else np.arange(N)
+        top = top[np.argsort(-scores[top], kind='stable')]
+        top = top[~np.isneginf(scores[top])]
+        return candidates[top], scores[top]
@@ -0,0 +1,87 @@
+import numpy as np
+
+
+def softmax(scores, present):
+    # Row-wise softmax over the present candidates, absent candidates get a score of 0
+    exp_scores = np.where(present, np.exp(np.where(present, scores, 0)), 0)
+    return exp_scores / np.sum(exp_scores, axis=1, keepdims=True)
+
+
+def rerank_batch(cf_items, cf_scores, bridge_items, bridge_scores, N, w1, w2=None):
+    """
+    Vectorized version of Reranker._rerank for many requests at once.
+
+    Both candidate lists are softmax normalized per request. CF candidates are weighted by w1 and get w2 times
+    their Bridges score added when Bridges also recommends them, the remaining Bridges candidates are weighted
+    by w2. The merged candidates (CF first, then Bridges, like _rerank) are sorted by score with ties kept in
+    merge order, and the top N are returned, so the results are identical to Reranker.recommend.
+
+    Parameters:
+    - cf_items (np.ndarray): (B, K) CF item codes, -1 for padding.
+    - cf_scores (np.ndarray): (B, K) min-max normalized CF scores.
+    - bridge_items (np.ndarray): (B, K) Bridges item codes in the same code space as cf_items, -1 for padding.
+    - bridge_scores (np.ndarray): (B, K) Bridges scores.
+    - N (int): The number of items to return per request.
+    - w1 (float or np.ndarray): The CF weight, or a vector of W weights that are all scored in one pass.
+    - w2 (float or np.ndarray): The Bridges weight(s), defaults to 1 - w1.
+
+    Returns:
+    - items (np.ndarray): (B, N) item codes, (W, B, N) when w1 is a vector.
+    - scores (np.ndarray): (B, N) scores, (W, B, N) when w1 is a vector.
+    - valid (np.ndarray): (B,) bool, False where _rerank returns None (no more than N unique candidates).
+    """
+    scalar = np.ndim(w1) == 0
+    w1 = np.atleast_1d(np.asarray(w1, dtype=np.float64))
+    w2 = 1 - w1 if w2 is None else np.broadcast_to(np.asarray(w2, dtype=np.float64), w1.shape)
+
+    cf_present = cf_items >= 0
+    bridge_present = bridge_items >= 0
+    # CF scores are float32, Bridges scores are python floats in _rerank, the dtypes are kept to match its arithmetic
+    cf_soft = softmax(cf_scores.astype(np.float32, copy=False), cf_present)
+    bridge_soft = softmax(bridge_scores.astype(np.float64), bridge_present)
+
+    # (B, K, K) matches between the CF and Bridges candidates of a request
+    matches = (cf_items[:, :, None] == bridge_items[:, None, :]) & cf_present[:, :, None]
+    cf_overlap = matches.any(axis=2)
+    bridge_overlap = matches.any(axis=1)
+    bridge_for_cf = np.where(matches, bridge_soft[:, None, :], 0).sum(axis=2)
+
+    w1 = w1[:, None, None]
+    w2 = w2[:, None, None]
+    cf_weighted = (cf_soft[None] * w1.astype(np.float32)).astype(np.float64)
+    cf_weighted = np.where(cf_overlap[None], cf_weighted + w2 * bridge_for_cf[None], cf_weighted)
+    cf_weighted = np.where(cf_present[None], cf_weighted, -np.inf)
+    bridge_weighted = np.where((bridge_present & ~bridge_overlap)[None], bridge_soft[None] * w2, -np.inf)
+
+    merged_items = np.concatenate([cf_items, bridge_items], axis=1)
+    merged_scores = np.concatenate([cf_weighted, bridge_weighted], axis=2)
+    valid = candidate_counts(cf_items, bridge_items) > N
+
+    top = _top_n(merged_scores.reshape(-1, merged_scores.shape[2]), N).reshape(merged_scores.shape[0], merged_scores.shape[1], -1)
+    items = np.take_along_axis(np.broadcast_to(merged_items[None], merged_scores.shape), top, axis=2)
+    scores = np.take_along_axis(merged_scores, top, axis=2)
+    if scalar:
+        return items[0], scores[0], valid
+    return items, scores, valid
+
+
+def candidate_counts(cf_items, bridge_items):
+    # The number of unique candidates of each request once the CF and Bridges lists are merged
+    matches = (cf_items[:, :, None] == bridge_items[:, None, :]) & (cf_items >= 0)[:, :, None]
+    return (cf_items >= 0).sum(axis=1) + ((bridge_items >= 0) & ~matches.any(axis=1)).sum(axis=1)
+
+
+def _top_n(scores, N):
+    # Indices of the N highest scores per row, in descending order with ties in column order (a stable sort)
+    N = min(N, scores.shape[1])
+    if N == scores.shape[1]:
+        return np.argsort(-scores, axis=1, kind='stable')
+    top = np.argpartition(-scores, N - 1, axis=1)[:, :N]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    top = np.take_along_axis(top, np.lexsort((top, -top_scores), axis=1), axis=1)
+    # Rows with a tie across the cut-off might have picked the later of the tied columns, those get a full stable sort
+    threshold = np.take_along_axis(scores, top[:, -1:], axis=1)
+    ties = np.flatnonzero((scores >= threshold).sum(axis=1) > N)
+    if len(ties):
+        top[ties] = np.argsort(-scores[ties], axis=1, kind='stable')[:, :N]
+    return top
@@ -1,44 +1,103 @@
-import pyarrow.parquet as pq
-import glob
 import pandas as pd
 import numpy as np
 import logging
+import json
+import os
+from datetime import timedelta
 from rec.types.types import Recommendation, RecommendedItem
+from rec.models.scoring import SegmentScorer
+from rec.models.transitions import TransitionIndex
+from rec.utils.data import BRIDGES_COLUMNS, iter_batches, load_table, partition_date, release_arrow_memory, to_pandas
+from rec.utils.metrics import METRICS
+from rec.utils.vocabulary import ITEMS
+
+SCORE_METHODS = ['frequencyScore', 'frequencyScoreNormalized', 'frequencyScoreNormalizedLog2', 'frequencyScoreNormalizedLog10',
+                 'rankScaledScoreLin', 'rankScaledScoreLog']
 
 class Bridges():
-    def __init__(self, minScore=0.1, maxScore=1.0, bridgeThresholds=2, method='frequencyScoreNormalized', logger=None):
+    def __init__(self, minScore=0.1, maxScore=1.0, bridgeThresholds=2, method='frequencyScoreNormalized', max_k=None, methods=None, logger=None,
+                 lean=False, vocabulary=None):
         self.logger = logger
         self.logger.name = "bridges"
         self.method = method
         self.minScore = minScore
         self.maxScore = maxScore
         self.bridgeThresholds = bridgeThresholds
+        # Max number of transitions stored per source item, None stores all of them
+        self.max_k = max_k
+        # Score methods that are computed and indexed, None computes all of them
+        self.methods = SCORE_METHODS if methods is None else list(methods)
+        if method not in self.methods:
+            raise ValueError(f"Method {method} is not one of the fitted methods {self.methods}")
         self.model = None
         self.data = None
+        # Lean mode always streams the counts and drops the scored transitions once they are indexed, the
+        # index is the same
+        self.lean = lean
+        # Per partition (itemId, nextItemId) -> count aggregates, kept by fit_partitions for update
+        self.partitions = {}
+        # The number of scored transitions every item is the source or target of, kept up to date by update
+        # for the vocabulary of the index
+        self.item_transitions = None
+        # The item vocabulary the index looks item IDs up in and codes its recommendations in
+        self.vocabulary = vocabulary if vocabulary is not None else ITEMS
+        # Bumped whenever the index or method changes, so caches built on this model know when they are stale
+        self.version = 0
 
+    @METRICS.timed('bridges_fit_seconds', memory=True, stage='load')
     def load_data(self, path, nested=False, limit=-1):
-        i = 0
-        if nested:
-            dfs = []
-            for file in glob.glob(path + "/**/*.parquet", recursive=True):
-                if i > limit and limit != -1:
-                    break
-                df = pq.read_table(file).to_pandas()
-                # print("Loaded file: " + file + " with shape: " + str(df.shape))
-                dfs.append(df)
-                i += 1
-            self.data = pd.concat(dfs, ignore_index=True)
-        else:
-            self.data = pq.read_table(path).to_pandas()
+        table = load_table(path, columns=BRIDGES_COLUMNS, nested=nested, limit=limit, logger=self.logger)
+        self.data = to_pandas(table)
+
+    @METRICS.timed('bridges_fit_seconds', memory=True, stage='load')
+    def load_counts_streaming(self, path, nested=False, limit=-1, batch_size=1_000_000):
+        """
+        Loads the session data one record batch at a time, dropping self-links and folding the counts
+        into a running aggregate keyed by (itemId, nextItemId). Peak memory follows the number of distinct
+        pairs rather than the raw session volume. Leaves the same table in self.data as
+        remove_self_links followed by aggregate_counts.
+        """
+        self.logger.debug("Streaming and aggregating counts...")
+        self.data = self.aggregate_partition(path, nested, limit, batch_size).reset_index()
+
+    def aggregate_partition(self, path, nested=False, limit=-1, batch_size=1_000_000):
+        # The self-link free (itemId, nextItemId) -> count aggregate of the session data in path
+        counts = None
+        pending = []
+        pending_rows = 0
+        for batch in iter_batches(path, columns=BRIDGES_COLUMNS, nested=nested, limit=limit, batch_size=batch_size):
+            df = batch.to_pandas()
+            df = df[df['itemId'] != df['nextItemId']]
+            part = df.groupby(['itemId', 'nextItemId']).agg(count=('count', 'sum'))
+            pending.append(part)
+            pending_rows += len(part)
+            # Only fold the pending parts in once they are as large as the running aggregate, keeping the merges amortized
+            if counts is None or pending_rows >= len(counts):
+                counts = self._merge_counts(counts, pending)
+                pending = []
+                pending_rows = 0
+        if pending:
+            counts = self._merge_counts(counts, pending)
+        if counts is None:
+            raise ValueError(f"No session data found in {path}")
+        return counts
+
+    def _merge_counts(self, counts, parts):
+        if counts is not None:
+            parts = [counts] + parts
+        return pd.concat(parts).groupby(level=['itemId', 'nextItemId']).agg(count=('count', 'sum'))
 
+    @METRICS.timed('bridges_fit_seconds', stage='remove_self_links')
     def remove_self_links(self):
         self.logger.debug("Removing self-links...")
         self.data = self.data[self.data['itemId'] != self.data['nextItemId']]
 
+    @METRICS.timed('bridges_fit_seconds', stage='aggregate_counts')
     def aggregate_counts(self):
         self.logger.debug("Aggregating counts...")
         self.data = self.data.groupby(['itemId', 'nextItemId']).agg(count=('count', 'sum')).reset_index()
 
+    @METRICS.timed('bridges_fit_seconds', stage='calculate_frequency_score')
     def calculate_frequency_score(self):
         self.logger.debug("Calculating frequency score...")
         self.data['sumCount'] = self.data.groupby('itemId')['count'].transform('sum')
@@ -48,6 +107,7 @@ class Bridges():
         self.data = self.data[self.data['numItems'] >= self.bridgeThresholds]
         self.data['frequencyScore'] = self.data['count'] / self.data['sumCount']
 
+    @METRICS.timed('bridges_fit_seconds', stage='log_transformation')
     def log_transformation(self):
         self.logger.debug("Performing log transformation...")
         self.data['log2TransformedCount'] = np.log2(self.data['count'] + 1)
@@ -57,10 +117,12 @@ class Bridges():
         self.data['minLog10Score'] = self.data.groupby('itemId')['log10TransformedCount'].transform('min')
         self.data['maxLog10Score'] = self.data.groupby('itemId')['log10TransformedCount'].transform('max')
 
+    @METRICS.timed('bridges_fit_seconds', stage='linear_normalization')
     def linear_normalization(self):
         self.logger.debug("Performing linear normalization...")
         self.data['frequencyScoreNormalized'] = self.minScore + (self.data['count'] / self.data['maxCount']) * (self.maxScore - self.minScore)
 
+    @METRICS.timed('bridges_fit_seconds', stage='log_normalization')
     def log_normalization(self):
         self.logger.debug("Performing log normalization...")
         self.data['frequencyScoreNormalizedLog2'] = ((self.data['log2TransformedCount'] - self.data['minLog2Score']) / 
@@ -70,6 +132,7 @@ class Bridges():
                                                       (self.data['maxLog10Score'] - self.data['minLog10Score']) * 
                                                       (self.maxScore - self.minScore)) + self.minScore
 
+    @METRICS.timed('bridges_fit_seconds', stage='rank_and_score')
     def rank_and_score(self):
         self.logger.debug("Ranking and scoring...")
         self.data['rank'] = self.data.groupby('itemId')['frequencyScore'].rank(method='first', ascending=False)
@@ -79,31 +142,220 @@ class Bridges():
         self.data['rankScaledScoreLog'] = (self.minScore * 
                                            np.exp((self.data['numItems'] - self.data['rank']) * 
                                                   np.log(self.maxScore / self.minScore) / (self.data['numItems'] - 1)))
-    def set_data_to_dict(self):
-        self.model = {}
-        for row in self.data.to_dict(orient='records'):
-            if row['itemId'] not in self.model:
-                self.model[row['itemId']] = []
-            self.model[row['itemId']].append((row['nextItemId'], row[self.method]))
-        for key in self.model:
-            self.model[key] = sorted(self.model[key], key=lambda x: x[1], reverse=True)
-
-    def change_method(self, method):     
-        self.method = method
-        self.set_data_to_dict()
-        
-    def fit(self, path, nested=False, limit=-1):
-        self.load_data(path, nested, limit)
-        self.remove_self_links()
-        self.aggregate_counts()
-        self.calculate_frequency_score()
-        self.log_transformation()
-        self.linear_normalization()
-        self.log_normalization()
-        self.rank_and_score()
-        self.set_data_to_dict()
+    @METRICS.timed('bridges_fit_seconds', memory=True, stage='score')
+    def score(self):
+        self.logger.debug("Scoring transitions...")
+        self.data = SegmentScorer(self.minScore, self.maxScore, self.bridgeThresholds).score(self.data, self.methods)
+
+    @METRICS.timed('bridges_fit_seconds', memory=True, stage='build_index')
+    def build_index(self):
+        self.logger.debug("Building transition index...")
+        # Every fitted method is indexed, so changing method does not require a rebuild
+        self.model = TransitionIndex.from_frame(self.data, self.methods, max_k=self.max_k, vocabulary=self.vocabulary)
+        self.version += 1
+
+    def change_method(self, method):
+        if method not in self.methods:
+            raise ValueError(f"Method {method} is not one of the fitted methods {self.methods}")
+        if method != self.method:
+            self.method = method
+            self.version += 1
+
+    @METRICS.timed('bridges_fit_seconds', memory=True, stage='total')
+    def fit(self, path, nested=False, limit=-1, streaming=False, batch_size=1_000_000, engine='segments'):
+        if streaming or self.lean:
+            self.load_counts_streaming(path, nested, limit, batch_size)
+            if self.lean:
+                release_arrow_memory()
+        else:
+            self.load_data(path, nested, limit)
+            self.remove_self_links()
+            self.aggregate_counts()
+        if engine == 'segments':
+            self.score()
+        elif engine == 'pandas':
+            self.calculate_frequency_score()
+            self.log_transformation()
+            self.linear_normalization()
+            self.log_normalization()
+            self.rank_and_score()
+        else:
+            raise ValueError("Engine must be either 'segments' or 'pandas'")
+        self.build_index()
+        if self.lean:
+            self.data = None
+        self.logger.debug("Model fitting completed.")
+
+    def fit_partitions(self, path, batch_size=1_000_000):
+        """
+        Fits the model like fit(path, nested=True), but aggregates every partition directory of path (like
+        date=2024-01-01) separately and keeps the aggregates, so later days can be added and old days
+        expired with update instead of refitting.
+        """
+        self.partitions = {}
+        self.data = None
+        partitions = sorted(entry.name for entry in os.scandir(path) if entry.is_dir())
+        if not partitions:
+            raise ValueError(f"No partition directories found in {path}")
+        for partition in partitions:
+            self.partitions[partition] = self.aggregate_partition(os.path.join(path, partition), nested=True, batch_size=batch_size)
+        self._fit_partials()
+
+    def _fit_partials(self):
+        # Sums the stored partition aggregates and scores the result
+        self.data = self._merge_counts(None, list(self.partitions.values())).reset_index()
+        self.score()
+        self.build_index()
+        self.item_transitions = self._item_transitions(self.data)
+        if self.lean:
+            self.data = None
         self.logger.debug("Model fitting completed.")
 
+    def window_partitions(self, days=None, latest=None):
+        """
+        Returns the keys of the stored date=YYYY-MM-DD partitions in the last days days up to latest (the
+        newest partition by default), so days=7 is the seven newest days. None returns every partition up to latest.
+        """
+        dates = {key: partition_date(key) for key in self.partitions}
+        if not dates:
+            raise ValueError("No partitions are stored, fit the model with fit_partitions first")
+        latest = latest or max(dates.values())
+        start = latest - timedelta(days) if days is not None else None
+        return sorted(key for key, day in dates.items() if day <= latest and (start is None or day > start))
+
+    def window(self, days=None, latest=None):
+        """
+        Builds a model on a shorter history window from the stored partition aggregates, by summing the
+        aggregates of the window and scoring the sum, without reading the session data again. The result is
+        equal to fitting a model on the partition directories of the window.
+
+        Returns:
+        - bridges (Bridges): A new model with the same parameters, it shares the partition aggregates and can be
+          updated like a model fitted with fit_partitions.
+        """
+        keys = self.window_partitions(days, latest)
+        if not keys:
+            raise ValueError(f"No partitions in the {days} day window")
+        bridges = Bridges(minScore=self.minScore, maxScore=self.maxScore, bridgeThresholds=self.bridgeThresholds, method=self.method,
+                          max_k=self.max_k, methods=self.methods, logger=self.logger, lean=self.lean, vocabulary=self.vocabulary)
+        bridges.partitions = {key: self.partitions[key] for key in keys}
+        bridges._fit_partials()
+        return bridges
+
+    def windows(self, windows, latest=None):
+        # One model per window length, like {7: Bridges, 30: Bridges, None: Bridges}
+        return {days: self.window(days, latest) for days in windows}
+
+    def update(self, path=None, partition=None, expire=(), batch_size=1_000_000):
+        """
+        Applies one day of session data and/or expires old days, with the same result as refitting on the
+        partitions that are left.
+
+        Only the source items that occur in the changed partitions are touched: their counts are summed from
+        the stored partition aggregates by binary search, the changes are applied, and their rows are rescored
+        and spliced into the transition index (TransitionIndex.splice). Every score is normalized per source
+        item, so the cost of reading, aggregating, scoring and sorting follows all transitions of the touched
+        items, not only the new pairs, and popular items are touched by almost every day. The index arrays are
+        also copied once per update, a linear memory copy of the whole index. The scored table of
+        fit_partitions (self.data) is not kept up to date and is dropped.
+
+        Parameters:
+        - path (str): A partition directory (or parquet file) with the new session data, None only expires.
+        - partition (str): The key the partition is stored under, defaults to the directory name of path.
+          A partition that is already stored is replaced.
+        - expire (List[str]): Keys of stored partitions to remove, like the days that left the window.
+        """
+        if not self.partitions:
+            raise ValueError("update needs the partition aggregates, fit the model with fit_partitions first")
+        for key in expire:
+            if key not in self.partitions:
+                raise ValueError(f"Partition {key} is not stored, stored partitions are {sorted(self.partitions)}")
+        deltas = []
+        partitions = dict(self.partitions)
+        if path is not None:
+            partition = partition or os.path.basename(os.path.normpath(path))
+            part = self.aggregate_partition(path, nested=os.path.isdir(path), batch_size=batch_size)
+            if partition in partitions:
+                expire = list(expire) + [partition]
+            deltas.append(part.assign(partitions=1))
+        for key in expire:
+            removed = partitions.pop(key)
+            deltas.append(removed.assign(count=-removed['count'], partitions=-1))
+        if path is not None:
+            partitions[partition] = part
+        if not deltas:
+            return
+
+        sources = np.sort(pd.unique(np.concatenate([delta.index.get_level_values('itemId').to_numpy() for delta in deltas])))
+        self.logger.debug(f"Updating {len(sources)} source items...")
+        # partitions is the number of partitions a pair occurs in, the pair is dropped when the last one expires
+        old = self._source_counts(self.partitions.values(), sources)
+        new = pd.concat([old] + deltas).groupby(level=['itemId', 'nextItemId']).sum()
+        new = new[new['partitions'] > 0]
+        self.partitions = partitions
+
+        new = SegmentScorer(self.minScore, self.maxScore, self.bridgeThresholds).score(new.reset_index()[['itemId', 'nextItemId', 'count']], self.methods)
+        # The old rows that were scored, scoring drops the items with fewer than bridgeThresholds transitions
+        sizes = np.bincount(old.index.codes[0])[old.index.codes[0]]
+        old = old[sizes >= self.bridgeThresholds].reset_index()
+        transitions = self.item_transitions.add(self._item_transitions(new), fill_value=0) \
+            .sub(self._item_transitions(old), fill_value=0)
+        self.item_transitions = transitions[transitions > 0].astype(np.int64).sort_index()
+        self.model = self.model.splice(self.item_transitions.index.to_numpy(), sources, new, max_k=self.max_k)
+        self.data = None
+        self.version += 1
+
+    def _item_transitions(self, data):
+        # The number of transitions of a scored table every item is the source or target of
+        return pd.concat([data['itemId'], data['nextItemId']]).value_counts().sort_index()
+
+    def _source_counts(self, partitions, sources):
+        # The summed (itemId, nextItemId) -> count, partitions rows of the sorted source items over partition
+        # aggregates. The aggregates are sorted by itemId, so the rows of each source are found by binary search.
+        parts = []
+        for part in partitions:
+            index = part.index
+            codes = index.levels[0].get_indexer(sources)
+            codes = codes[codes >= 0]
+            keys = index.codes[0]
+            start, end = keys.searchsorted(codes, 'left'), keys.searchsorted(codes, 'right')
+            lengths = end - start
+            offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+            parts.append(part.iloc[np.arange(lengths.sum()) + np.repeat(start - offsets, lengths)].assign(partitions=1))
+        return pd.concat(parts).groupby(level=['itemId', 'nextItemId']).sum()
+
+    def save(self, path):
+        """
+        Saves the fitted model to a directory: the transition index (see TransitionIndex.save) and the
+        model parameters. The scored transition table in self.data is not saved.
+        """
+        os.makedirs(path, exist_ok=True)
+        self.model.save(os.path.join(path, 'index'))
+        with open(os.path.join(path, 'bridges.json'), 'w') as f:
+            json.dump({
+                'method': self.method,
+                'methods': self.methods,
+                'minScore': self.minScore,
+                'maxScore': self.maxScore,
+                'bridgeThresholds': self.bridgeThresholds,
+                'max_k': self.max_k,
+            }, f)
+
+    @classmethod
+    def load(cls, path, mmap=True, logger=None, vocabulary=None):
+        """
+        Loads a model saved with save. With mmap the index arrays and the Arrow column of the item IDs are
+        memory mapped read-only, so loading is fast and processes loading the same files share their pages.
+        Nothing is built per item until the first lookup (see TransitionIndex.code_map).
+        """
+        with open(os.path.join(path, 'bridges.json')) as f:
+            params = json.load(f)
+        bridges = cls(minScore=params['minScore'], maxScore=params['maxScore'], bridgeThresholds=params['bridgeThresholds'],
+                      method=params['method'], max_k=params['max_k'], methods=params['methods'], logger=logger, vocabulary=vocabulary)
+        bridges.model = TransitionIndex.load(os.path.join(path, 'index'), mmap, bridges.vocabulary)
+        bridges.version += 1
+        return bridges
+
     def recommend(self, itemId):
         result = self.model[self.model['itemId'] == str(itemId)].sort_values('frequencyScore', ascending=False)
         if result.empty:
@@ -119,16 +371,19 @@ class Bridges():
             return result[['itemId', 'nextItemId', method]]
         
     def has_item(self, itemId):
-        return str(itemId) in self.model.keys()
+        return self.model.has_item(itemId)
         
     def recommend_standard(self, itemId, N=-1) -> Recommendation:
-        recs = Recommendation(item_id=itemId, user_id=None, items_map={}, items=[], item_ids=[])
-        result = self.model.get(str(itemId), None)
-        if not result:
+        result = self.model.top(itemId, self.method, N)
+        if result is None:
             return None
-        else:
-            for row in result[:N]:
-                r = RecommendedItem(row[0], row[1], "BR")
-                recs.items_map[r.item_id] = r
-                recs.items.append(r)
-            return recs
\ No newline at end of file
+        return self.to_recommendation(itemId, result[0], result[1])
+
+    def to_recommendation(self, itemId, next_items, scores) -> Recommendation:
+        recs = Recommendation(item_id=itemId, user_id=None, items_map={}, items=[], item_ids=[])
+        codes = self.model.code_map.to_shared(next_items).tolist()
+        for next_item, code, score in zip(self.model.items[next_items], codes, scores.tolist()):
+            r = RecommendedItem(next_item, score, "BR", code)
+            recs.items_map[code] = r
+            recs.items.append(r)
+        return recs
@@ -0,0 +1,119 @@
+from collections import OrderedDict
+
+# Bytes of one cached candidate list besides its codes and scores: the key (a 36 character user ID), the
+# OrderedDict entry, the tuples and the two ndarray headers, measured with tracemalloc
+ENTRY_OVERHEAD = 512
+
+
+def cache_size_for_memory(memory, K_max=100):
+    """
+    The max_size of a CandidateCache that keeps both of its caches within memory bytes. An entry holds K_max
+    int32 codes and float32 scores, 8 * K_max bytes plus ENTRY_OVERHEAD. Bridges entries view the arrays of the
+    index and hold only the overhead, so the bound is an upper bound for them.
+    """
+    return max(1, int(memory // (2 * (ENTRY_OVERHEAD + 8 * K_max))))
+
+
+class LRUCache:
+    """
+    Bounded mapping that evicts the least recently used entry, and counts its hits, misses and evictions.
+    """
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key, default)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+        return entry
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0,
+        }
+
+
+class CandidateCache:
+    """
+    Caches the CF top-K_max list of each user and the Bridges top-K_max list of each item, and serves any
+    K <= K_max by slicing. The raw CF scores are cached, so slicing gives the same min-max normalized scores
+    as CF.recommend_standard(user_id, N=K). Each cache is cleared when its model is refit or changes method.
+    """
+    def __init__(self, CF, Bridges, max_size=100000, K_max=100):
+        self.CF = CF
+        self.Bridges = Bridges
+        self.K_max = K_max
+        self.cf_cache = LRUCache(max_size)
+        self.bridges_cache = LRUCache(max_size)
+        self.cf_version = CF.version
+        self.bridges_version = Bridges.version
+
+    def cf(self, user_id, K):
+        if self.CF.version != self.cf_version:
+            self.cf_cache.clear()
+            self.cf_version = self.CF.version
+        entry = self.cf_cache.get(user_id)
+        if entry is None or (entry[0] < K and entry[1] is not None):
+            # Cached lists are only ever extended, a larger K than K_max is fetched and stored as is
+            fetched = max(K, self.K_max)
+            entry = (fetched, self.CF.recommend_scores(user_id, N=fetched))
+            self.cf_cache.put(user_id, entry)
+        if entry[1] is None:
+            return None
+        items, scores = entry[1]
+        return self.CF.to_recommendation(user_id, items[:K], scores[:K])
+
+    def bridges(self, item_id, K):
+        if self.Bridges.version != self.bridges_version:
+            self.bridges_cache.clear()
+            self.bridges_version = self.Bridges.version
+        entry = self.bridges_cache.get(item_id)
+        if entry is None or (entry[0] < K and entry[1] is not None):
+            fetched = max(K, self.K_max)
+            entry = (fetched, self.Bridges.model.top(item_id, self.Bridges.method, fetched))
+            self.bridges_cache.put(item_id, entry)
+        if entry[1] is None:
+            return None
+        next_items, scores = entry[1]
+        return self.Bridges.to_recommendation(item_id, next_items[:K], scores[:K])
+
+    def resize(self, max_size):
+        # Both caches evict down to max_size entries on their next insert
+        self.cf_cache.max_size = max_size
+        self.bridges_cache.max_size = max_size
+
+    def clear(self):
+        self.cf_cache.clear()
+        self.bridges_cache.clear()
+
+    def stats(self):
+        return {'cf': self.cf_cache.stats(), 'bridges': self.bridges_cache.stats()}
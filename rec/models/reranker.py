@@ -1,13 +1,30 @@
 from typing import List, Dict
-from rec.types.types import Recommendation, RecommendedItem 
+from rec.types.types import Recommendation, RecommendedItem, RecommendationBatch, CF as CF_ORIGIN, BR as BR_ORIGIN, RERANK
+from rec.models.cache import CandidateCache
+from rec.models.batch_reranker import rerank_batch
+from rec.utils.metrics import METRICS
+import numpy as np
+import pandas as pd
 import logging
 
 class Reranker:
-    def __init__(self, Bridges, CF, logger) -> None:
+    def __init__(self, Bridges, CF, logger, cache_size=None, K_max=100, vocabulary=None) -> None:
         self.logger = logger
         self.logger.name = "reranker"
         self.Bridges = Bridges
         self.CF = CF
+        # With a cache_size the top-K_max candidates of each user and item are cached and sliced for smaller K
+        self.cache_size = cache_size
+        self.K_max = K_max
+        self.cache = CandidateCache(CF, Bridges, max_size=cache_size, K_max=K_max) if cache_size else None
+        # The candidates of both models are coded in the item vocabulary they share, which the evaluator uses too
+        self.vocabulary = vocabulary if vocabulary is not None else CF.vocabulary
+        if CF.vocabulary is not self.vocabulary or Bridges.vocabulary is not self.vocabulary:
+            raise ValueError("CF and Bridges must code their items in the vocabulary of the reranker")
+        self.reset_counters()
+
+    def reset_counters(self):
+        # Requests skipped since the last reset, by reason. METRICS counts them too, without resets
         self.missing_bridge_count = 0
         self.missing_cf_count = 0
         self.not_enough_bridge_count = 0
@@ -34,49 +51,57 @@ class Reranker:
         recommended_items = self._rerank(userId, item_id, cf_recs, bridges, w1, w2, N)
         return recommended_items
     
+    @METRICS.timed('reranker_seconds', stage='get_recs')
     def _get_recs(self, user_id, item_id, N, K):
         # WE CONSIDER K
-        cf_recs = self.CF.recommend_standard(user_id, N=K)
+        cf_recs = self.cache.cf(user_id, K) if self.cache else self.CF.recommend_standard(user_id, N=K)
         if cf_recs is None:
             self.missing_cf_count += 1
+            METRICS.inc('reranker_skipped_total', reason='missing_cf')
             return None, None
         
         # WE CONSIDER K
-        bridges = self.Bridges.recommend_standard(item_id, N=K)
+        bridges = self.cache.bridges(item_id, K) if self.cache else self.Bridges.recommend_standard(item_id, N=K)
         if bridges is None:
             self.missing_bridge_count += 1
+            METRICS.inc('reranker_skipped_total', reason='missing_bridge')
             return None, None 
 
         if len(cf_recs.items) < K:
             self.not_enough_cf_count += 1
+            METRICS.inc('reranker_skipped_total', reason='not_enough_cf')
             return None, None
         if len(bridges.items) < K:
             self.not_enough_bridge_count += 1
+            METRICS.inc('reranker_skipped_total', reason='not_enough_bridge')
             return None, None
         return cf_recs, bridges
     
+    @METRICS.timed('reranker_seconds', stage='rerank')
     def _rerank(self, user_id: str, item_id: str, cf_recs: Recommendation, bridges: Recommendation, w1: float, w2: float, N: int) -> Recommendation:
         recs = Recommendation(user_id=user_id, item_id=item_id, items_map={}, items=[], item_ids=[]) 
         # we perform softmax on both the CF and bridge scores
         cf_recs.softmax_normalize_scores()
         bridges.softmax_normalize_scores()
         overlap = 0
-        # Score and add the items to the recs
+        # Score and add the items to the recs. Both models code their items in the shared vocabulary, so the
+        # items are matched by code
         for recommended_item in cf_recs.items:
             # Start by scoring the CF item:
             recommended_item.score = recommended_item.score * w1
             # check if the item is in the bridge recommendations
-            bridge_item = bridges.items_map.get(recommended_item.item_id, None)
+            bridge_item = bridges.items_map.get(recommended_item.code, None)
             if bridge_item is not None:
                 overlap += 1
                 # If the item is in the bridge recommendations, we add the bridge score to the CF score, weighted by w2
                 recommended_item.score = (recommended_item.score) + (w2 * bridge_item.score)
                 # We add it to the item map of our reranked recommendation, so that we are able to keep track of the bridge items,
                 # when we add the bridge items after, we dont want to add the same items twice
-                recs.items_map[recommended_item.item_id] = RecommendedItem(recommended_item.item_id, recommended_item.score, "RERANK")
+                reranked = RecommendedItem(recommended_item.item_id, recommended_item.score, "RERANK", recommended_item.code)
+                recs.items_map[recommended_item.code] = reranked
                 # We add the item to the list of items
                 recs.item_ids.append(recommended_item.item_id)
-                recs.items.append(RecommendedItem(recommended_item.item_id, recommended_item.score, "RERANK"))
+                recs.items.append(reranked)
             else:
                 # If the item is not in the bridge recommendations, we add it to the list of items, but not to the item map. 
                 recs.items.append(recommended_item)
@@ -86,7 +111,7 @@ class Reranker:
         # Add the bridge items that were not in the CF recommendations
         for bridge_item in bridges.items:
             #  We only add the bridge items that were not in the CF recommendations
-            if bridge_item.item_id not in recs.items_map:
+            if bridge_item.code not in recs.items_map:
                 # Score the bridge items with weight w2
                 bridge_item.score = bridge_item.score * w2
                 recs.items.append(bridge_item)
@@ -98,4 +123,106 @@ class Reranker:
             recs.item_ids = [item.item_id for item in recs.items]
             return recs
         self.logger.error("Reranked recommendations less than K.")
-        return None
\ No newline at end of file
+        return None
+
+    def recommend_batch(self, user_ids, item_ids, N=5, w1=0.5, w2=None, K=5, batch_size=1000):
+        """
+        Recommends for many (user, item) requests at once, with the same results and counters as calling
+        recommend for each request. The CF scores come from one matrix product per batch (CF.recommend_batch),
+        so they can differ from the per-user scores in the last float32 bits.
+
+        Parameters:
+        - user_ids (array-like): The user ID of each request.
+        - item_ids (array-like): The item ID each user just watched.
+        - N (int): The number of items to return per request.
+        - w1 (float or np.ndarray): The CF weight, or a vector of weights that are all scored in one pass.
+        - w2 (float or np.ndarray): The Bridges weight(s), defaults to 1 - w1.
+        - K (int): The number of candidates taken from each model.
+
+        Returns:
+        - item_ids (np.ndarray): (n, N) recommended item IDs, (W, n, N) when w1 is a vector.
+        - scores (np.ndarray): (n, N) scores, (W, n, N) when w1 is a vector.
+        - valid (np.ndarray): (n,) bool, False where recommend returns None.
+        """
+        cf_items, cf_scores, bridge_items, bridge_scores, found = self.candidates(user_ids, item_ids, K)
+        shape = (len(found), N) if np.ndim(w1) == 0 else (len(np.atleast_1d(w1)), len(found), N)
+        items = np.full(shape, -1, dtype=np.int64)
+        scores = np.full(shape, np.nan)
+        valid = np.zeros(len(found), dtype=bool)
+        rows = np.flatnonzero(found)
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            batch_items, batch_scores, batch_valid = rerank_batch(cf_items[batch], cf_scores[batch], bridge_items[batch],
+                                                                  bridge_scores[batch], N, w1, w2)
+            items[..., batch, :batch_items.shape[-1]] = batch_items
+            scores[..., batch, :batch_scores.shape[-1]] = batch_scores
+            valid[batch] = batch_valid
+        return self.item_ids(items), scores, valid
+
+    def recommend_many(self, user_ids, item_ids, N=5, w1=0.5, w2=None, K=5):
+        """
+        Same recommendations as recommend_batch, returned as a RecommendationBatch (item codes in
+        self.vocabulary, float32 scores and origins) instead of ID arrays or Recommendation objects. Rows
+        without a recommendation are all padding.
+        """
+        cf_items, cf_scores, bridge_items, bridge_scores, found = self.candidates(user_ids, item_ids, K)
+        items = np.full((len(found), N), -1, dtype=np.int32)
+        scores = np.full((len(found), N), np.nan, dtype=np.float32)
+        rows = np.flatnonzero(found)
+        if len(rows):
+            row_items, row_scores, row_valid = rerank_batch(cf_items[rows], cf_scores[rows], bridge_items[rows],
+                                                            bridge_scores[rows], N, w1, w2)
+            rows = rows[row_valid]
+            items[rows, :row_items.shape[-1]] = row_items[row_valid]
+            scores[rows, :row_scores.shape[-1]] = row_scores[row_valid]
+        # Items recommended by both models were reranked, the others keep the origin of their model
+        in_cf = (items[:, :, None] == cf_items[:, None, :]).any(axis=2) & (items >= 0)
+        in_bridges = (items[:, :, None] == bridge_items[:, None, :]).any(axis=2) & (items >= 0)
+        origins = np.where(in_cf & in_bridges, RERANK, np.where(in_cf, CF_ORIGIN, BR_ORIGIN)).astype(np.uint8)
+        return RecommendationBatch(items, scores, origins, self.vocabulary,
+                                   np.asarray(user_ids, dtype=object), np.asarray(item_ids, dtype=object))
+
+    def candidates(self, user_ids, item_ids, K):
+        """
+        Gathers the top K CF and Bridges candidates of many requests as aligned arrays of codes in
+        self.vocabulary. Updates the missing and not enough counters like _get_recs.
+
+        Returns:
+        - cf_items, cf_scores, bridge_items, bridge_scores (np.ndarray): (n, K) candidates, -1 codes for padding.
+        - found (np.ndarray): (n,) bool, False where _get_recs returns None.
+        """
+        cf_items, cf_scores, cf_found = self.CF.recommend_batch(user_ids, N=K)
+        cf_items = self.CF.item_map.to_shared(cf_items)
+
+        index = self.Bridges.model
+        bridges_codes = index.code_map.shared
+        codes = index.codes(item_ids).astype(np.int64)
+        start = np.where(codes >= 0, index.indptr[codes], 0)
+        length = np.where(codes >= 0, index.indptr[codes + 1] - start, 0)
+        positions = np.arange(K)
+        present = positions[None, :] < np.minimum(length, K)[:, None]
+        gather = np.where(present, start[:, None] + positions[None, :], 0)
+        next_items = index.next_items[self.Bridges.method]
+        bridge_items = np.where(present, bridges_codes[next_items[gather]], -1) if len(next_items) else np.full(present.shape, -1)
+        bridge_scores = np.where(present, index.scores[self.Bridges.method][gather], np.nan) if len(next_items) else np.full(present.shape, np.nan)
+        bridge_found = length > 0
+
+        cf_count = (cf_items >= 0).sum(axis=1)
+        bridge_count = present.sum(axis=1)
+        missing_bridge = cf_found & ~bridge_found
+        not_enough_cf = cf_found & bridge_found & (cf_count < K)
+        not_enough_bridge = cf_found & bridge_found & ~not_enough_cf & (bridge_count < K)
+        self.missing_cf_count += int((~cf_found).sum())
+        self.missing_bridge_count += int(missing_bridge.sum())
+        self.not_enough_cf_count += int(not_enough_cf.sum())
+        self.not_enough_bridge_count += int(not_enough_bridge.sum())
+        if METRICS.enabled:
+            for reason, skipped in [('missing_cf', ~cf_found), ('missing_bridge', missing_bridge),
+                                    ('not_enough_cf', not_enough_cf), ('not_enough_bridge', not_enough_bridge)]:
+                METRICS.inc('reranker_skipped_total', int(skipped.sum()), reason=reason)
+        found = cf_found & bridge_found & ~not_enough_cf & ~not_enough_bridge
+        return cf_items.astype(np.int64), cf_scores, bridge_items, bridge_scores, found
+
+    def item_ids(self, codes):
+        # Maps vocabulary codes back to item IDs, -1 becomes None
+        return self.vocabulary.ids(codes)
@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+
+SCORE_COLUMNS = {
+    'frequencyScore': [],
+    'frequencyScoreNormalized': [],
+    'frequencyScoreNormalizedLog2': ['log2'],
+    'frequencyScoreNormalizedLog10': ['log10'],
+    'rankScaledScoreLin': ['rank'],
+    'rankScaledScoreLog': ['rank'],
+}
+
+
+class SegmentScorer:
+    """
+    Single pass version of the Bridges scoring steps (calculate_frequency_score, log_transformation,
+    linear_normalization, log_normalization and rank_and_score).
+
+    The transitions are sorted by source item once, and every per item reduction is a NumPy segment
+    operation over the group boundaries. Only the score columns that are asked for are computed, and the
+    results are equal to the pandas steps.
+    """
+    def __init__(self, minScore=0.1, maxScore=1.0, bridgeThresholds=2):
+        self.minScore = minScore
+        self.maxScore = maxScore
+        self.bridgeThresholds = bridgeThresholds
+
+    def score(self, data: pd.DataFrame, methods, source_key='itemId', count_key='count') -> pd.DataFrame:
+        """
+        Parameters:
+        - data (pd.DataFrame): The aggregated transitions, one row per (itemId, nextItemId).
+        - methods (List[str]): The score columns to compute.
+
+        Returns:
+        - scored (pd.DataFrame): The rows of items with at least bridgeThresholds transitions, sorted by
+          source item (keeping the row order within an item), with one column per method.
+        """
+        for method in methods:
+            if method not in SCORE_COLUMNS:
+                raise ValueError(f"Unknown method {method}, accepted values are {list(SCORE_COLUMNS)}")
+
+        codes, _ = pd.factorize(data[source_key], sort=True)
+        if len(codes) and not np.all(codes[1:] >= codes[:-1]):
+            # The one sort, stable so rows keep their order within an item
+            order = np.argsort(codes, kind='stable')
+            data = data.iloc[order]
+            codes = codes[order]
+
+        starts, num_items = self._segments(codes)
+        keep = np.repeat(num_items >= self.bridgeThresholds, num_items)
+        data = data[keep].copy()
+        if len(data) == 0:
+            for method in methods:
+                data[method] = np.array([], dtype=np.float64)
+            return data
+        codes = codes[keep]
+        starts, num_items = self._segments(codes)
+
+        count = data[count_key].to_numpy()
+        needed = {column for method in methods for column in SCORE_COLUMNS[method]}
+
+        if 'frequencyScore' in methods or 'rank' in needed:
+            frequency_score = count / np.repeat(np.add.reduceat(count, starts), num_items)
+            if 'frequencyScore' in methods:
+                data['frequencyScore'] = frequency_score
+        if 'frequencyScoreNormalized' in methods:
+            max_count = np.repeat(np.maximum.reduceat(count, starts), num_items)
+            data['frequencyScoreNormalized'] = self.minScore + (count / max_count) * (self.maxScore - self.minScore)
+        for column, log in (('log2', np.log2), ('log10', np.log10)):
+            if column in needed:
+                transformed = log(count + 1)
+                low = np.repeat(np.minimum.reduceat(transformed, starts), num_items)
+                high = np.repeat(np.maximum.reduceat(transformed, starts), num_items)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    data['frequencyScoreNormalized' + column.capitalize()] = ((transformed - low) / (high - low) *
+                                                                              (self.maxScore - self.minScore)) + self.minScore
+        if 'rank' in needed:
+            rank = self._rank(codes, frequency_score, starts, num_items)
+            n = np.repeat(num_items, num_items)
+            if 'rankScaledScoreLin' in methods:
+                data['rankScaledScoreLin'] = (self.minScore +
+                                              ((n - rank) * (self.maxScore - self.minScore) / (n - 1)))
+            if 'rankScaledScoreLog' in methods:
+                data['rankScaledScoreLog'] = (self.minScore *
+                                              np.exp((n - rank) * np.log(self.maxScore / self.minScore) / (n - 1)))
+        return data
+
+    def _segments(self, codes):
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) else np.array([], dtype=np.int64)
+        num_items = np.diff(np.r_[starts, len(codes)])
+        return starts, num_items
+
+    def _rank(self, codes, score, starts, num_items):
+        # Descending rank within each item, ties ranked in row order like rank(method='first')
+        order = np.lexsort((-score, codes))
+        rank = np.empty(len(codes), dtype=np.float64)
+        rank[order] = np.arange(len(codes)) - np.repeat(starts, num_items) + 1
+        return rank
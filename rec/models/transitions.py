@@ -0,0 +1,179 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from rec.utils.data import read_ids, write_ids
+from rec.utils.vocabulary import ITEMS, CodeMap
+
+
+class TransitionIndex:
+    """
+    Compact (itemId -> nextItemId) transition index in CSR layout.
+
+    Items are stored as int32 codes into self.items. The transitions of source item c are found at
+    indptr[c]:indptr[c + 1], pre-sorted by score (descending) for every method, so a top-N lookup is a slice
+    and switching method costs nothing. Item IDs are looked up through the shared item vocabulary (see
+    code_map).
+    """
+    def __init__(self, items, indptr, next_items, scores, vocabulary=None):
+        self.items = items
+        self.indptr = indptr
+        # method -> int32 next item codes / float32 scores, sorted per source item by that method
+        self.next_items = next_items
+        self.scores = scores
+        self.vocabulary = vocabulary if vocabulary is not None else ITEMS
+        self._code_map = None
+
+    @classmethod
+    def from_frame(cls, data: pd.DataFrame, methods, max_k=None, source_key='itemId', target_key='nextItemId', vocabulary=None):
+        """
+        Builds the index from a scored transition table.
+
+        Parameters:
+        - data (pd.DataFrame): One row per (source, target) pair with one score column per method.
+        - methods (List[str]): The score columns to index.
+        - max_k (int): Keep at most max_k transitions per source item, None keeps all of them.
+        - vocabulary (ItemVocabulary): The vocabulary item IDs are looked up in, the shared ITEMS by default.
+
+        Returns:
+        - index (TransitionIndex): The index, ties keep the row order of data.
+        """
+        items = pd.Index(pd.unique(np.concatenate([data[source_key].to_numpy(), data[target_key].to_numpy()]))).sort_values()
+        source = items.get_indexer(data[source_key]).astype(np.int32)
+        target = items.get_indexer(data[target_key]).astype(np.int32)
+        return cls.from_codes(items.to_numpy(), source, target, {method: data[method].to_numpy() for method in methods}, max_k, vocabulary)
+
+    @classmethod
+    def from_codes(cls, items, source, target, scores, max_k=None, vocabulary=None):
+        return cls(items, *cls._layout(len(items), source, target, scores, max_k), vocabulary=vocabulary)
+
+    @staticmethod
+    def _layout(n_items, source, target, scores, max_k=None):
+        # The indptr and the per method sorted next item codes and scores of transitions given as codes
+        counts = np.bincount(source, minlength=n_items)
+        group_start = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        if max_k is not None:
+            counts = np.minimum(counts, max_k)
+        indptr = np.zeros(n_items + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+
+        next_items = {}
+        sorted_scores = {}
+        for method, score in scores.items():
+            # lexsort is stable, so equal scores keep their row order. NaN scores are sorted last.
+            order = np.lexsort((-score, source))
+            if max_k is not None:
+                order = order[np.arange(len(order)) - group_start[source[order]] < max_k]
+            next_items[method] = np.ascontiguousarray(target[order], dtype=np.int32)
+            sorted_scores[method] = np.ascontiguousarray(score[order], dtype=np.float32)
+        return indptr, next_items, sorted_scores
+
+    def splice(self, items, sources, data, max_k=None, source_key='itemId', target_key='nextItemId'):
+        """
+        Returns an index with the transitions of some source items replaced, equal to from_frame on the whole
+        updated table. Only the new rows are sorted. The transitions of the other items are copied over in one
+        gather per method (recoded when the vocabulary changed), so the cost is a copy of the arrays rather
+        than a rebuild.
+
+        Parameters:
+        - items (np.ndarray): The sorted vocabulary of the updated table, every item of a kept or new transition.
+        - sources (np.ndarray): The source items whose transitions are replaced.
+        - data (pd.DataFrame): The scored transitions of these source items, one score column per method.
+        - max_k (int): The max_k the index was built with.
+        """
+        items = pd.Index(items)
+        source = items.get_indexer(data[source_key]).astype(np.int32)
+        target = items.get_indexer(data[target_key]).astype(np.int32)
+        indptr, next_items, scores = self._layout(len(items), source, target,
+                                                  {method: data[method].to_numpy() for method in self.methods}, max_k)
+
+        # Old code of every new code (-1 for new items) and new code of every old code (-1 for dropped items)
+        remap = items.get_indexer(self.items)
+        recode = not (len(items) == len(self.items) and np.array_equal(remap, np.arange(len(remap))))
+        old_codes = np.full(len(items), -1, dtype=np.int64)
+        old_codes[remap[remap >= 0]] = np.flatnonzero(remap >= 0)
+        changed = np.zeros(len(items), dtype=bool)
+        codes = items.get_indexer(sources)
+        changed[codes[codes >= 0]] = True
+
+        known = old_codes >= 0
+        counts = np.zeros(len(items), dtype=np.int64)
+        counts[known] = np.diff(self.indptr)[old_codes[known]]
+        counts[changed] = np.diff(indptr)[changed]
+        spliced_indptr = np.zeros(len(items) + 1, dtype=np.int64)
+        np.cumsum(counts, out=spliced_indptr[1:])
+        # Where the transitions of every item start in the old arrays followed by the new ones
+        start = np.zeros(len(items), dtype=np.int64)
+        start[known] = self.indptr[old_codes[known]]
+        start[changed] = self.indptr[-1] + indptr[:-1][changed]
+        take = np.repeat(start - spliced_indptr[:-1], counts) + np.arange(spliced_indptr[-1])
+
+        spliced_next_items, spliced_scores = {}, {}
+        for method in self.methods:
+            old_next_items = remap[self.next_items[method]].astype(np.int32) if recode else self.next_items[method]
+            spliced_next_items[method] = np.concatenate([old_next_items, next_items[method]])[take]
+            spliced_scores[method] = np.concatenate([self.scores[method], scores[method]])[take]
+        return TransitionIndex(items.to_numpy(), spliced_indptr, spliced_next_items, spliced_scores, self.vocabulary)
+
+    @property
+    def methods(self):
+        return list(self.next_items.keys())
+
+    @property
+    def code_map(self):
+        # Maps the item codes of the index to the vocabulary and back, built on the first lookup
+        if self._code_map is None:
+            self._code_map = CodeMap(self.vocabulary, self.items)
+        return self._code_map
+
+    def code(self, item_id):
+        code = self.code_map.code(item_id)
+        return code if code >= 0 else None
+
+    def codes(self, item_ids):
+        # The codes of many item IDs, -1 for items that are not in the index
+        return self.code_map.codes(item_ids)
+
+    def has_item(self, item_id):
+        code = self.code(item_id)
+        return code is not None and self.indptr[code + 1] > self.indptr[code]
+
+    def top(self, item_id, method, N=-1):
+        """
+        Returns the next item codes and scores for item_id sorted by method, sliced with [:N] like a list.
+        Returns None if the item has no transitions.
+        """
+        code = self.code(item_id)
+        if code is None:
+            return None
+        start, end = self.indptr[code], self.indptr[code + 1]
+        if start == end:
+            return None
+        return self.next_items[method][start:end][:N], self.scores[method][start:end][:N]
+
+    def save(self, path):
+        """
+        Writes the index to a directory: the item vocabulary as an Arrow file, and indptr plus the next item
+        codes and scores of every method as .npy files that load can memory map.
+        """
+        os.makedirs(path, exist_ok=True)
+        write_ids(os.path.join(path, 'items.arrow'), self.items)
+        np.save(os.path.join(path, 'indptr.npy'), self.indptr)
+        for i, method in enumerate(self.methods):
+            np.save(os.path.join(path, f'next_items_{i}.npy'), self.next_items[method])
+            np.save(os.path.join(path, f'scores_{i}.npy'), self.scores[method])
+        with open(os.path.join(path, 'index.json'), 'w') as f:
+            json.dump({'methods': self.methods}, f)
+
+    @classmethod
+    def load(cls, path, mmap=True, vocabulary=None):
+        mmap_mode = 'r' if mmap else None
+        with open(os.path.join(path, 'index.json')) as f:
+            methods = json.load(f)['methods']
+        items = read_ids(os.path.join(path, 'items.arrow'), mmap)
+        indptr = np.load(os.path.join(path, 'indptr.npy'), mmap_mode=mmap_mode)
+        next_items = {method: np.load(os.path.join(path, f'next_items_{i}.npy'), mmap_mode=mmap_mode) for i, method in enumerate(methods)}
+        scores = {method: np.load(os.path.join(path, f'scores_{i}.npy'), mmap_mode=mmap_mode) for i, method in enumerate(methods)}
+        return cls(items, indptr, next_items, scores, vocabulary)
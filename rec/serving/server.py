@@ -0,0 +1,327 @@
+"""
+Asyncio HTTP service for the next-poster slot.
+
+Serves GET /recommend?user_id=...&item_id=...&N=5 with the reranked list of the saved CF and Bridges models,
+GET /stats with the latency and batch size histograms as JSON, and GET /metrics with the same histograms and
+the METRICS registry in the Prometheus text format. Concurrent requests are collected into
+micro-batches, so the CF candidates of a batch come from one matrix product (Reranker.recommend_batch).
+When --max-queue requests are already waiting for a batch, new requests are answered with 503.
+
+Usage:
+    python -m rec.serving.server --cf ./models/cf --bridges ./models/bridges --port 8080
+"""
+import argparse
+import asyncio
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+import threadpoolctl
+
+from rec.models.als import CFRecommender
+from rec.models.bridges import Bridges
+from rec.models.reranker import Reranker
+from rec.utils.metrics import LATENCY_BUCKETS, METRICS, Histogram, Metrics
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error',
+           503: 'Service Unavailable'}
+
+
+class Overloaded(Exception):
+    """
+    Raised by MicroBatcher.submit when max_queue requests are already waiting.
+    """
+
+
+class MicroBatcher:
+    """
+    Collects concurrent requests into batches of at most max_batch_size, waiting at most max_wait seconds
+    after the first request of a batch. The batches are reranked one at a time on a worker thread, so the
+    event loop keeps accepting requests (which form the next batch) while a batch is scored.
+
+    The matrix products of a micro-batch are small, so BLAS is limited to blas_threads: more threads than
+    cores make each batch tens of times slower.
+
+    At most max_queue requests wait for a batch. Past that submit raises Overloaded, so under overload
+    requests are shed right away instead of waiting behind a queue that keeps growing.
+    """
+    def __init__(self, reranker, w1=0.5, w2=None, K=20, max_batch_size=256, max_wait=0.002, blas_threads=1, max_queue=4096,
+                 logger=None):
+        self.reranker = reranker
+        self.w1 = w1
+        self.w2 = w2
+        self.K = K
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.blas_threads = blas_threads
+        self.max_queue = max_queue
+        # Requests refused because the queue was full
+        self.rejected = 0
+        self.logger = logger
+        self.queue = None
+        self.task = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.batch_sizes = Histogram([2 ** i for i in range(max(1, max_batch_size).bit_length() + 1)])
+
+    def start(self):
+        threadpoolctl.threadpool_limits(self.blas_threads, 'blas')
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.executor.shutdown(wait=True)
+
+    async def submit(self, user_id, item_id, N):
+        """
+        Queues one request and waits for its batch.
+
+        Returns:
+        - items (List[Tuple[str, float]]): The reranked (item ID, score) pairs, or None when the reranker has
+          no recommendation for the request.
+
+        Raises:
+        - Overloaded: When max_queue requests are already queued.
+        """
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((user_id, item_id, N, future))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise Overloaded(f"{self.max_queue} requests are already queued")
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.batch_sizes.observe(len(batch))
+            try:
+                results = await loop.run_in_executor(self.executor, self._recommend, batch)
+            except Exception as e:
+                self.logger.error(e, exc_info=True)
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (*_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def _recommend(self, batch):
+        # One Reranker.recommend_batch call per distinct N in the batch
+        results = [None] * len(batch)
+        by_n = {}
+        for i, (_, _, N, _) in enumerate(batch):
+            by_n.setdefault(N, []).append(i)
+        for N, rows in by_n.items():
+            items, scores, valid = self.reranker.recommend_batch([batch[i][0] for i in rows], [batch[i][1] for i in rows],
+                                                                 N=N, w1=self.w1, w2=self.w2, K=self.K)
+            for row, i in enumerate(rows):
+                if valid[row]:
+                    results[i] = [(item_id, float(score)) for item_id, score in zip(items[row], scores[row]) if item_id is not None]
+        return results
+
+
+class RecommendationServer:
+    """
+    Minimal HTTP/1.1 server (keep-alive, GET only) in front of a MicroBatcher.
+    """
+    def __init__(self, batcher, host='127.0.0.1', port=8080, logger=None):
+        self.batcher = batcher
+        self.host = host
+        self.port = port
+        self.logger = logger
+        self.logger.name = "recommendation_server"
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.status_counts = {}
+        self.server = None
+        # The user IDs of the CF model can be integers, query parameters are always strings
+        self.parse_user = self._parser(batcher.reranker.CF.user_index)
+
+    async def start(self):
+        self.batcher.start()
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.logger.info(f"Serving recommendations on http://{self.host}:{self.port}")
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.batcher.stop()
+
+    async def serve_forever(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    def stats(self):
+        return {
+            'requests': self.latency.count,
+            'status': self.status_counts,
+            'latency_p50': self.latency.percentile(50),
+            'latency_p99': self.latency.percentile(99),
+            'latency': self.latency.to_dict(),
+            'batch_size_p50': self.batcher.batch_sizes.percentile(50),
+            'batch_size_p99': self.batcher.batch_sizes.percentile(99),
+            'batch_size': self.batcher.batch_sizes.to_dict(),
+            'queued': self.batcher.queue.qsize() if self.batcher.queue is not None else 0,
+            'rejected': self.batcher.rejected,
+        }
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                start = time.perf_counter()
+                request_line, *header_lines = head.decode('latin-1').split('\r\n')
+                headers = dict(line.split(':', 1) for line in header_lines if ':' in line)
+                headers = {key.strip().lower(): value.strip() for key, value in headers.items()}
+                try:
+                    length = int(headers.get('content-length', 0))
+                    if length < 0:
+                        raise ValueError(length)
+                except ValueError:
+                    # Without a valid length the next request cannot be found, so the connection is closed
+                    status, body, keep_alive = 400, {'error': 'Malformed Content-Length header'}, False
+                else:
+                    if length:
+                        try:
+                            await reader.readexactly(length)
+                        except (asyncio.IncompleteReadError, ConnectionError):
+                            break
+                    try:
+                        status, body = await self._route(request_line)
+                    except Exception as e:
+                        self.logger.error(e, exc_info=True)
+                        status, body = 500, {'error': str(e)}
+                    keep_alive = headers.get('connection', '').lower() != 'close'
+                writer.write(self._response(status, body, keep_alive))
+                await writer.drain()
+                self.latency.observe(time.perf_counter() - start)
+                self.status_counts[status] = self.status_counts.get(status, 0) + 1
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+
+    async def _route(self, request_line):
+        try:
+            method, target, _ = request_line.split(' ', 2)
+        except ValueError:
+            return 400, {'error': 'Malformed request line'}
+        url = urlsplit(target)
+        if url.path not in ('/recommend', '/stats', '/metrics'):
+            return 404, {'error': f'Unknown path {url.path}'}
+        if method != 'GET':
+            return 405, {'error': f'Method {method} not allowed'}
+        if url.path == '/stats':
+            return 200, self.stats()
+        if url.path == '/metrics':
+            return 200, self.prometheus()
+
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if 'user_id' not in query or 'item_id' not in query:
+            return 400, {'error': 'user_id and item_id are required'}
+        try:
+            user_id = self.parse_user(query['user_id'])
+            N = int(query.get('N', 5))
+            if N < 1:
+                raise ValueError(f"N must be positive, got {N}")
+        except ValueError as e:
+            return 400, {'error': str(e)}
+        try:
+            items = await self.batcher.submit(user_id, query['item_id'], N)
+        except Overloaded as e:
+            return 503, {'error': str(e)}
+        except Exception as e:
+            return 500, {'error': str(e)}
+        if items is None:
+            return 404, {'user_id': query['user_id'], 'item_id': query['item_id'], 'error': 'No recommendations'}
+        return 200, {
+            'user_id': query['user_id'],
+            'item_id': query['item_id'],
+            'items': [{'item_id': item_id, 'score': score} for item_id, score in items],
+        }
+
+    def prometheus(self):
+        # The server histograms and the registry the models report to, in the Prometheus text format
+        metrics = Metrics(enabled=True)
+        metrics.register('server_request_seconds', self.latency)
+        metrics.register('server_batch_size', self.batcher.batch_sizes)
+        for status, count in self.status_counts.items():
+            metrics.inc('server_responses_total', count, status=status)
+        return metrics.to_prometheus() + METRICS.to_prometheus()
+
+    def _response(self, status, body, keep_alive):
+        if isinstance(body, str):
+            payload, content_type = body.encode(), 'text/plain; version=0.0.4'
+        else:
+            payload, content_type = json.dumps(body, default=str).encode(), 'application/json'
+        head = (f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        return head.encode() + payload
+
+    def _parser(self, index):
+        if pd.api.types.is_integer_dtype(index.dtype):
+            return int
+        return str
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cf', required=True, help='Directory of a CF model saved with CFRecommender.save')
+    parser.add_argument('--bridges', required=True, help='Directory of a Bridges model saved with Bridges.save')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--w1', type=float, default=0.5)
+    parser.add_argument('--K', type=int, default=20)
+    parser.add_argument('--max-batch-size', type=int, default=256)
+    parser.add_argument('--max-wait-ms', type=float, default=2.0)
+    parser.add_argument('--blas-threads', type=int, default=1)
+    parser.add_argument('--max-queue', type=int, default=4096, help='Requests allowed to wait for a batch, more are answered with 503')
+    parser.add_argument('--metrics', action='store_true', help='Record the model timers and counters for /metrics')
+    args = parser.parse_args()
+    if args.metrics:
+        METRICS.enable()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    CFR = CFRecommender.load(args.cf, logger=logging.getLogger())
+    B = Bridges.load(args.bridges, logger=logging.getLogger())
+    R = Reranker(B, CFR, logger=logging.getLogger())
+    batcher = MicroBatcher(R, w1=args.w1, K=args.K, max_batch_size=args.max_batch_size,
+                           max_wait=args.max_wait_ms / 1000, blas_threads=args.blas_threads, max_queue=args.max_queue,
+                           logger=logging.getLogger())
+    server = RecommendationServer(batcher, args.host, args.port, logger=logging.getLogger())
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
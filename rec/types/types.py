@@ -20,20 +20,25 @@ class EvaluationCase:
     def __hash__(self):
         return hash((self.model, self.method, self.w1, self.w2, self.K, self.N))
     
-@dataclass
+@dataclass(slots=True)
 class RecommendedItem:
+    # Slotted, a recommendation holds K of these. code is the item code in the shared item vocabulary
+    # (rec.utils.vocabulary.ITEMS), -1 when the item was not coded
     item_id: str
     score: float
     origin: str
+    code: int = -1
 
     def __repr__(self):
         return self.item_id
     
 @dataclass
 class Recommendation:
+    __slots__ = ('item_id', 'user_id', 'items_map', 'items', 'item_ids')
     item_id: str
     user_id: str
-    items_map: Dict[str, RecommendedItem]
+    # The items by their code in the shared item vocabulary
+    items_map: Dict[int, RecommendedItem]
     items: List[RecommendedItem]
     item_ids: List[str]
 
@@ -48,3 +53,156 @@ class Recommendation:
         # Update scores of RecommendedItem objects with normalized scores
         for item, softmax_score in zip(self.items, softmax_scores):
             item.score = softmax_score
+
+
+# Origins of recommended items in a RecommendationBatch, stored as uint8 codes
+ORIGINS = ['CF', 'BR', 'RERANK']
+CF, BR, RERANK = range(len(ORIGINS))
+
+
+class RecommendationBatch:
+    """
+    The recommendations of one or many requests as (requests, N) arrays instead of objects: int32 item codes
+    (-1 for padding), float32 scores (NaN for padding) and uint8 origins (CF, BR, RERANK). Item codes are
+    mapped to IDs with the vocabulary. Indexing a batch gives a RecommendationView, for code that needs the
+    per-item API.
+    """
+    __slots__ = ('items', 'scores', 'origins', 'vocabulary', 'user_ids', 'item_ids')
+
+    def __init__(self, items, scores, origins, vocabulary=None, user_ids=None, item_ids=None):
+        self.items = np.atleast_2d(np.asarray(items, dtype=np.int32))
+        self.scores = np.atleast_2d(np.asarray(scores, dtype=np.float32))
+        self.origins = np.broadcast_to(np.asarray(origins, dtype=np.uint8), self.items.shape).copy()
+        self.vocabulary = vocabulary
+        # The user and the item the user just watched of every request, if known
+        self.user_ids = user_ids
+        self.item_ids = item_ids
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, row):
+        return RecommendationView(self, row)
+
+    def __iter__(self):
+        return (RecommendationView(self, row) for row in range(len(self)))
+
+    @property
+    def valid(self):
+        # (requests, N) mask of the recommended (non padding) entries
+        return self.items >= 0
+
+    def softmax_normalize(self):
+        # Row-wise softmax over the recommended entries, in place, like Recommendation.softmax_normalize_scores
+        valid = self.valid
+        exp_scores = np.where(valid, np.exp(np.where(valid, self.scores, 0).astype(np.float64)), 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.scores = np.where(valid, exp_scores / exp_scores.sum(axis=1, keepdims=True), np.nan).astype(np.float32)
+        return self
+
+    def min_max_normalize(self):
+        # Row-wise min-max normalization over the recommended entries, in place, like CFRecommender.to_recommendation
+        valid = self.valid
+        low = np.min(self.scores, axis=1, keepdims=True, initial=np.inf, where=valid)
+        high = np.max(self.scores, axis=1, keepdims=True, initial=-np.inf, where=valid)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.scores = np.where(valid, (self.scores - low) / (high - low), np.nan).astype(np.float32)
+        return self
+
+    def ids(self, row=None):
+        # Item IDs of one row, or of the whole batch, None for padding
+        items = self.items if row is None else self.items[row]
+        return self.vocabulary.ids(items) if self.vocabulary is not None else items
+
+    @classmethod
+    def from_recommendations(cls, recommendations, N, vocabulary):
+        """
+        Packs Recommendation objects (None for requests without one) into a batch of width N, adding their
+        items to the vocabulary.
+        """
+        items = np.full((len(recommendations), N), -1, dtype=np.int32)
+        scores = np.full((len(recommendations), N), np.nan, dtype=np.float32)
+        origins = np.zeros((len(recommendations), N), dtype=np.uint8)
+        for row, recommendation in enumerate(recommendations):
+            if recommendation is None:
+                continue
+            recs = recommendation.items[:N]
+            items[row, :len(recs)] = vocabulary.add([rec.item_id for rec in recs])
+            scores[row, :len(recs)] = [rec.score for rec in recs]
+            origins[row, :len(recs)] = [ORIGINS.index(rec.origin) for rec in recs]
+        return cls(items, scores, origins, vocabulary)
+
+    def to_recommendations(self):
+        # Recommendation objects of every row, for code that still needs them
+        return [view.to_recommendation() for view in self]
+
+
+class RecommendationView:
+    """
+    Lightweight view of one row of a RecommendationBatch, with the attributes of a Recommendation.
+    """
+    __slots__ = ('batch', 'row')
+
+    def __init__(self, batch, row):
+        self.batch = batch
+        self.row = row
+
+    def __len__(self):
+        return int(self.batch.valid[self.row].sum())
+
+    @property
+    def user_id(self):
+        return self.batch.user_ids[self.row] if self.batch.user_ids is not None else None
+
+    @property
+    def item_id(self):
+        return self.batch.item_ids[self.row] if self.batch.item_ids is not None else None
+
+    @property
+    def item_ids(self):
+        return [item_id for item_id in self.batch.ids(self.row) if item_id is not None]
+
+    @property
+    def items(self):
+        return [RecommendedItemView(self.batch, self.row, column) for column in range(len(self))]
+
+    def to_recommendation(self):
+        # The row is decoded once, not once per item
+        valid = self.batch.valid[self.row]
+        items = [RecommendedItem(item_id, float(score), ORIGINS[origin], int(code)) for item_id, score, origin, code in
+                 zip(self.batch.ids(self.row)[valid], self.batch.scores[self.row][valid],
+                     self.batch.origins[self.row][valid], self.batch.items[self.row][valid])]
+        return Recommendation(self.item_id, self.user_id, {item.code: item for item in items}, items, [item.item_id for item in items])
+
+
+class RecommendedItemView:
+    """
+    Lightweight view of one entry of a RecommendationBatch, with the attributes of a RecommendedItem.
+    """
+    __slots__ = ('batch', 'row', 'column')
+
+    def __init__(self, batch, row, column):
+        self.batch = batch
+        self.row = row
+        self.column = column
+
+    @property
+    def item_id(self):
+        # Only this entry is decoded
+        code = self.batch.items[self.row, self.column]
+        return self.batch.vocabulary.ids(code) if self.batch.vocabulary is not None else int(code)
+
+    @property
+    def code(self):
+        return int(self.batch.items[self.row, self.column])
+
+    @property
+    def score(self):
+        return float(self.batch.scores[self.row, self.column])
+
+    @property
+    def origin(self):
+        return ORIGINS[self.batch.origins[self.row, self.column]]
+
+    def __repr__(self):
+        return str(self.item_id)
@@ -0,0 +1,202 @@
+import csv as python_csv
+import glob
+import os
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as csv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# Columns each model actually reads, everything else in the partitions is skipped by the reader
+CF_COLUMNS = ['profileId', 'itemId', 'durationSec']
+BRIDGES_COLUMNS = ['itemId', 'nextItemId', 'count']
+VIEWING_POPULARITY_COLUMNS = ['itemId', 'firstStart', 'contentType', 'durationSec']
+SESSION_POPULARITY_COLUMNS = ['itemId', 'nextItemId', 'count']
+# The strings pandas.read_csv reads as missing values by default
+CSV_NULL_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A',
+                   'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+
+
+def list_parquet_files(path, nested=False, limit=-1):
+    """
+    Lists the parquet files that make up a training directory.
+
+    The limit keeps the behaviour of the old per-model loaders, where limit=n reads the first n + 1 files.
+    """
+    if not nested:
+        return [path]
+    files = glob.glob(path + "/**/*.parquet", recursive=True)
+    if limit != -1:
+        files = files[:limit + 1]
+    return files
+
+
+def parquet_dataset(path, nested=False, limit=-1, dictionary_columns=None):
+    files = list_parquet_files(path, nested, limit)
+    if not files:
+        raise ValueError(f"No parquet files found in {path}")
+    # Dictionary columns are read straight into dictionary arrays (codes plus distinct values)
+    format = ds.ParquetFileFormat(read_options={'dictionary_columns': dictionary_columns}) if dictionary_columns else 'parquet'
+    if not nested:
+        # A single file or a plain directory of parquet files
+        return ds.dataset(path, format=format)
+    return ds.dataset(files, format=format)
+
+
+def load_table(path, columns=None, filter=None, nested=False, limit=-1, logger=None, dictionary_columns=None) -> pa.Table:
+    """
+    Loads parquet data as a single Arrow table.
+
+    Parameters:
+    - path (str): A parquet file, or a directory of parquet files when nested is set.
+    - columns (List[str]): The columns to read, None reads all of them.
+    - filter (pyarrow.compute.Expression): Row filter pushed down into the reader.
+    - nested (bool): Read every parquet file below path.
+    - limit (int): Limit the number of files read, -1 reads all of them.
+    - dictionary_columns (List[str]): String columns to read dictionary encoded, they become categoricals in pandas.
+
+    Returns:
+    - table (pyarrow.Table): The projected and filtered rows of every file, read in parallel.
+    """
+    dataset = parquet_dataset(path, nested, limit, dictionary_columns)
+    table = dataset.to_table(columns=columns, filter=filter, use_threads=True)
+    if logger is not None:
+        logger.debug(f"Loaded {len(dataset.files)} file(s) from {path} with shape: ({table.num_rows}, {table.num_columns})")
+    return table
+
+
+def latest_timestamp(path, column='firstStart', nested=False, limit=-1):
+    # Only the timestamp column is scanned to find the end of the window
+    dataset = parquet_dataset(path, nested, limit)
+    return pc.max(dataset.to_table(columns=[column], use_threads=True)[column])
+
+
+def window_filter(latest, days, column='firstStart'):
+    cutoff = pa.scalar(latest.as_py() - timedelta(days), type=latest.type)
+    return ds.field(column) >= cutoff
+
+
+def partition_date(name):
+    # The date of a hive style partition directory like date=2024-01-01
+    key, _, value = name.partition('=')
+    if not value:
+        raise ValueError(f"Partition {name} is not a key=value directory name")
+    return date.fromisoformat(value)
+
+
+def to_pandas(table: pa.Table):
+    # The table is released while converting, so only one copy of the data is alive at a time
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def release_arrow_memory():
+    # Returns the memory Arrow freed to the OS, its allocator otherwise keeps it for reuse
+    pa.default_memory_pool().release_unused()
+
+
+def iter_batches(path, columns=None, filter=None, nested=False, limit=-1, batch_size=1_000_000):
+    """
+    Streams parquet data as Arrow record batches, so only one batch per reader thread is held in memory.
+    """
+    dataset = parquet_dataset(path, nested, limit)
+    for batch in dataset.to_batches(columns=columns, filter=filter, batch_size=batch_size, use_threads=True):
+        if batch.num_rows:
+            yield batch
+
+
+def write_ids(path, ids):
+    # Stores an ID vocabulary (code -> ID) as a single column Arrow IPC file
+    if isinstance(ids, pd.Index) and isinstance(ids.dtype, pd.ArrowDtype):
+        # IDs read with read_ids are written from their Arrow column as they are
+        ids = pa.array(ids)
+    table = pa.table({'id': pa.array(list(ids)) if not isinstance(ids, (pa.Array, pa.ChunkedArray)) else ids})
+    with pa.OSFile(path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def read_ids(path, mmap=True):
+    # Reads an ID vocabulary written by write_ids as a pd.Index over the Arrow column, without converting the
+    # IDs to Python objects. With mmap the column is the mapped file, so processes share its pages, and the
+    # hash table of the index is only built on its first lookup
+    source = pa.memory_map(path, 'r') if mmap else pa.OSFile(path, 'rb')
+    return pd.Index(pd.arrays.ArrowExtensionArray(pa.ipc.open_file(source).read_all().column('id')))
+
+
+def cached_parquet(path, columns, int_columns=(), cache_path=None, block_size=64 << 20, logger=None):
+    """
+    Converts a CSV file once into a typed Parquet cache and returns the path of the cache.
+
+    The CSV is streamed in blocks, rows with a missing value in any column are dropped (like
+    DataFrame.dropna, with the missing value strings of pandas.read_csv), only columns are kept, and
+    int_columns are stored as int64, the other columns as strings. The cache is reused until the size or modification time of the CSV or
+    the columns change.
+
+    Parameters:
+    - path (str): The CSV file.
+    - columns (List[str]): The columns to keep.
+    - int_columns (List[str]): Columns stored as int64, they may be written as floats (like 12.0) in the CSV.
+    - cache_path (str): Where to write the cache, defaults to the CSV path with a .parquet suffix.
+    - block_size (int): The number of CSV bytes converted at a time.
+
+    Returns:
+    - cache_path (str): The Parquet file.
+    """
+    cache_path = cache_path or os.path.splitext(path)[0] + '.parquet'
+    stat = os.stat(path)
+    source = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}:{','.join(columns)}:{','.join(int_columns)}"
+    if os.path.exists(cache_path):
+        metadata = pq.read_schema(cache_path).metadata or {}
+        if metadata.get(b'source', b'').decode() == source:
+            return cache_path
+
+    if logger is not None:
+        logger.debug(f"Converting {path} to {cache_path}...")
+    # Every column gets an explicit type, types inferred from the first block can fail on a later one. Columns
+    # that are not int_columns stay strings, their missing values are read as nulls
+    with open(path, newline='') as f:
+        header = next(python_csv.reader(f), [])
+    column_types = {column: pa.float64() if column in int_columns else pa.string() for column in header}
+    reader = csv.open_csv(path, read_options=csv.ReadOptions(block_size=block_size),
+                          convert_options=csv.ConvertOptions(column_types=column_types, null_values=CSV_NULL_VALUES,
+                                                             strings_can_be_null=True))
+    temporary = cache_path + '.tmp'
+    writer = None
+    try:
+        for batch in reader:
+            valid = None
+            for column in batch.columns:
+                column_valid = pc.is_valid(column)
+                if pa.types.is_floating(column.type):
+                    column_valid = pc.and_(column_valid, pc.invert(pc.is_nan(column)))
+                valid = column_valid if valid is None else pc.and_(valid, column_valid)
+            table = pa.Table.from_batches([batch]).filter(valid).select(columns)
+            for column in int_columns:
+                table = table.set_column(table.schema.get_field_index(column), column, pc.cast(table[column], pa.int64()))
+            if writer is None:
+                writer = pq.ParquetWriter(temporary, table.schema.with_metadata({'source': source}))
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        raise ValueError(f"No rows found in {path}")
+    os.replace(temporary, cache_path)
+    return cache_path
+
+
+def sample_rows(path, n=None, seed=42, columns=None) -> pa.Table:
+    """
+    Reads n rows of a Parquet file picked by a seeded row index selection, only the picked rows are
+    converted. The rows and their order are the same as DataFrame.sample(n, random_state=seed) of the whole
+    file. n of None reads every row in file order.
+    """
+    dataset = ds.dataset(path, format='parquet')
+    if n is None:
+        return dataset.to_table(columns=columns)
+    rows = np.random.RandomState(seed).choice(dataset.count_rows(), size=n, replace=False)
+    return dataset.take(rows, columns=columns)
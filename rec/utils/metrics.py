@@ -0,0 +1,260 @@
+import bisect
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+# Geometric latency buckets from 50us to ~13s, in seconds
+LATENCY_BUCKETS = [50e-6 * 1.25 ** i for i in range(57)]
+
+
+class Histogram:
+    """
+    Counts observations in fixed buckets, each bucket counting the values up to its upper bound. Percentiles
+    are the upper bound of the bucket the percentile falls in, like a Prometheus histogram_quantile.
+    """
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value, n=1):
+        self.counts[bisect.bisect_left(self.bounds, value)] += n
+        self.count += n
+        self.sum += value * n
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+        rank = q / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.bounds + [float('inf')], self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': {str(bound): count for bound, count in zip(self.bounds + ['+Inf'], self.counts) if count},
+        }
+
+
+def rss():
+    # Resident memory of the process in bytes, from /proc where available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return peak_rss()
+
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class MemorySampler(threading.Thread):
+    """
+    Samples the resident memory every interval seconds, for the peak of a stage (ru_maxrss is the peak of the
+    whole process so far).
+    """
+    def __init__(self, interval=0.01):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.start_rss = rss()
+        self.peak = self.start_rss
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            self.peak = max(self.peak, rss())
+
+    def stop(self):
+        self.done.set()
+        self.join()
+        self.peak = max(self.peak, rss())
+        return self.peak
+
+
+class _Timer:
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+    """
+    Registry of counters, gauges and latency histograms, keyed by a metric name and its labels, exported as JSON or in
+    the Prometheus text format. While disabled, inc, observe and timer return right away, so the instrumented
+    code only pays for one attribute check.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def inc(self, name, n=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + n
+
+    def set(self, name, value, **labels):
+        if not self.enabled:
+            return
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def histogram(self, name, bounds=LATENCY_BUCKETS, **labels):
+        # The histogram of a name and labels, created with bounds on first use
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(bounds)
+        return histogram
+
+    def register(self, name, histogram, **labels):
+        # Exports a histogram that is kept elsewhere, like the latency histogram of the server
+        self.histograms[(name, tuple(sorted(labels.items())))] = histogram
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        self.histogram(name, **labels).observe(value)
+
+    def timer(self, name, **labels):
+        """
+        Context manager observing the duration of its block in seconds.
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, labels)
+
+    def timed(self, name, memory=False, **labels):
+        """
+        Decorator observing the duration of every call in seconds. With memory, the peak resident memory during
+        the call and the memory it retained are also set as the rss_peak_bytes and rss_retained_bytes gauges,
+        labeled with the timer name. Memory is sampled by a thread, so it is meant for coarse stages like a fit.
+        """
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                sampler = MemorySampler() if memory else None
+                if sampler is not None:
+                    sampler.start()
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - start, **labels)
+                    if sampler is not None:
+                        self.set('rss_peak_bytes', sampler.stop(), timer=name, **labels)
+                        self.set('rss_retained_bytes', rss() - sampler.start_rss, timer=name, **labels)
+            return wrapper
+        return decorator
+
+    def to_dict(self):
+        return {
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                         for (name, labels), value in sorted(self.counters.items())],
+            'histograms': [{'name': name, 'labels': dict(labels), 'p50': histogram.percentile(50),
+                            'p99': histogram.percentile(99), **histogram.to_dict()}
+                           for (name, labels), histogram in sorted(self.histograms.items())],
+            'gauges': [{'name': name, 'labels': dict(labels), 'value': value}
+                       for (name, labels), value in sorted(self.gauges.items())],
+        }
+
+    def to_prometheus(self):
+        lines = []
+        families = [*self._families(self.counters, 'counter'), *self._families(self.gauges, 'gauge'),
+                    *self._families(self.histograms, 'histogram')]
+        for name, type, series in families:
+            lines.append(f"# TYPE {name} {type}")
+            for labels, value in series:
+                if type != 'histogram':
+                    lines.append(f"{name}{_labels(labels)} {value}")
+                    continue
+                seen = 0
+                for bound, count in zip(value.bounds + [float('inf')], value.counts):
+                    seen += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {seen}")
+                lines.append(f"{name}_sum{_labels(labels)} {value.sum}")
+                lines.append(f"{name}_count{_labels(labels)} {value.count}")
+        return '\n'.join(lines) + '\n'
+
+    def _families(self, metrics, type):
+        families = {}
+        for (name, labels), value in sorted(metrics.items(), key=lambda item: item[0]):
+            families.setdefault(name, []).append((labels, value))
+        return [(name, type, series) for name, series in families.items()]
+
+    def save(self, path):
+        # JSON for .json paths, the Prometheus text format otherwise
+        with open(path, 'w') as f:
+            if path.endswith('.json'):
+                json.dump(self.to_dict(), f, indent=2)
+            else:
+                f.write(self.to_prometheus())
+
+
+def _labels(labels):
+    # {key="value",...} with the label values escaped for the Prometheus text format
+    if not labels:
+        return ''
+    values = [(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in values) + '}'
+
+
+# The registry the models and the evaluator report to, disabled unless enabled by the caller
+METRICS = Metrics()
@@ -1,8 +1,67 @@
+import numpy as np
 import pandas as pd
-import pyarrow.parquet as pq
-import glob
+import pyarrow.dataset as ds
 from datetime import datetime, timedelta
 import logging
+from rec.utils.data import SESSION_POPULARITY_COLUMNS, VIEWING_POPULARITY_COLUMNS, latest_timestamp, load_table, to_pandas, window_filter
+from rec.utils.vocabulary import ITEMS, CodeMap
+
+CONTENT_TYPES = ['SERIES', 'MOVIE']
+
+class PopularityArrays:
+    """
+    Popularity scores stored as float32 arrays indexed by item code, NaN for items without a score.
+    Scores are named like count_30d, duration_30d and session, see PopularityScore.calculate_popularity_windows.
+    The item codes are mapped to the shared item vocabulary with code_map.
+    """
+    def __init__(self, items, scores, vocabulary=None):
+        self.items = pd.Index(items)
+        self.scores = scores
+        self.vocabulary = vocabulary if vocabulary is not None else ITEMS
+        self._code_map = None
+
+    @property
+    def code_map(self):
+        # Maps the item codes of the arrays to the vocabulary and back, built on first use
+        if self._code_map is None:
+            self._code_map = CodeMap(self.vocabulary, self.items.to_numpy())
+        return self._code_map
+
+    def __contains__(self, name):
+        return name in self.scores
+
+    def codes(self, item_ids):
+        # Item codes of many item IDs at once, -1 for items without any score
+        return self.items.get_indexer(pd.Index(item_ids))
+
+    def lookup(self, name, codes):
+        """
+        Returns the scores of an array of item codes (like a whole recommendation matrix), NaN where the code is -1.
+        """
+        codes = np.asarray(codes)
+        scores = np.append(self.scores[name], np.float32(np.nan))
+        return scores[np.where(codes < 0, len(scores) - 1, codes)]
+
+    def catalog_size(self, name):
+        # The number of items with a score, the size of the catalog for coverage
+        return int((~np.isnan(self.scores[name])).sum())
+
+    def join(self, other):
+        # Both sets of scores over the union of the item vocabularies
+        items = self.items.append(other.items[~other.items.isin(self.items)])
+        scores = {}
+        for source in (self, other):
+            codes = source.codes(items)
+            for name in source.scores:
+                scores[name] = source.lookup(name, codes)
+        return PopularityArrays(items, scores, self.vocabulary)
+
+    def to_dict(self, days):
+        # The nested {item: {count_score, duration_score}} dict of calculate_popularity_scores(days)
+        count, duration = self.scores[f'count_{days}d'], self.scores[f'duration_{days}d']
+        present = np.flatnonzero(~np.isnan(count))
+        return {self.items[code]: {"count_score": float(count[code]), "duration_score": float(duration[code])} for code in present}
+
 
 class PopularityScore:
     def __init__(self, logger=None):
@@ -13,26 +72,29 @@ class PopularityScore:
         self.data = None
         self.popularity_scores = {}
         self.type = None
+        self.days = None
+        self.latest_date = None
 
-    def load_data(self, path, nested=False, limit=-1, type=None):
+    def load_data(self, path, nested=False, limit=-1, type=None, days=None):
         if type is None:
             raise ValueError("Type must be set before loading data, accepted values are 'viewing' and 'sessions'")
         if type not in ['viewing', 'sessions']:
             raise ValueError("Type must be either 'viewing' or 'sessions'")
         self.type = type
-        i = 0
-        if nested:
-            dfs = []
-            for file in glob.glob(path + "/**/*.parquet", recursive=True):
-                if i > limit and limit != -1:
-                    break
-                df = pq.read_table(file).to_pandas()
-                self.logger.debug("Loaded file: " + file + " with shape: " + str(df.shape))
-                dfs.append(df)
-                i += 1
-            self.data = pd.concat(dfs, ignore_index=True)
+        self.days = None
+        self.latest_date = None
+        if type == 'sessions':
+            table = load_table(path, columns=SESSION_POPULARITY_COLUMNS, nested=nested, limit=limit, logger=self.logger)
+        elif days is None:
+            table = load_table(path, columns=VIEWING_POPULARITY_COLUMNS, nested=nested, limit=limit, logger=self.logger)
         else:
-            self.data = pq.read_table(path).to_pandas()
+            # When the window is known up front we only read the rows inside it
+            latest = latest_timestamp(path, 'firstStart', nested, limit)
+            window = window_filter(latest, days, 'firstStart') & ds.field('contentType').isin(CONTENT_TYPES)
+            table = load_table(path, columns=VIEWING_POPULARITY_COLUMNS, filter=window, nested=nested, limit=limit, logger=self.logger)
+            self.days = days
+            self.latest_date = pd.Timestamp(latest.as_py())
+        self.data = to_pandas(table)
 
 
     def calculate_popularity_scores(self, days):
@@ -43,11 +105,15 @@ class PopularityScore:
         if self.data is None:
             raise ValueError("Data must be loaded before calculating popularity scores")
         
-        latest_date = self.data['firstStart'].max()
+        if self.days is not None and days > self.days:
+            raise ValueError(f"Data was loaded for a {self.days} day window, cannot calculate popularity for {days} days")
+
+        # The latest date is taken over all loaded content, when the window was pushed into the reader we kept it from the scan
+        latest_date = self.latest_date if self.latest_date is not None else self.data['firstStart'].max()
         cutoff_date = latest_date - timedelta(days)
 
         filtered_df = self.data[self.data['firstStart'] >= cutoff_date]
-        filtered_df = filtered_df[filtered_df['contentType'].isin(['SERIES', 'MOVIE'])]
+        filtered_df = filtered_df[filtered_df['contentType'].isin(CONTENT_TYPES)]
 
         # total_watch_time = filtered_df['durationSec'].sum()
         count = filtered_df['itemId'].value_counts().to_dict()
@@ -97,3 +163,74 @@ class PopularityScore:
             item: (count - min_count) / (max_count - min_count) if max_count != min_count else 0
             for item, count in combined_dict.items()
         }
+
+    def calculate_popularity_windows(self, windows):
+        """
+        Computes the count and duration popularity of several windows in one grouped pass over the viewing
+        data. Every row is put in the bucket of the shortest window it falls in, the counts and durations are
+        summed per (item, bucket) with one bincount each, and a cumulative sum over the buckets gives every
+        window. The scores are min-max normalized per window like calculate_popularity_scores.
+
+        Parameters:
+        - windows (List[int]): The window lengths in days.
+
+        Returns:
+        - popularity (PopularityArrays): count_{days}d and duration_{days}d for every window, NaN for items not
+          viewed in the window.
+        """
+        if self.type != 'viewing':
+            raise ValueError("This method is only supported for viewing data")
+        if self.data is None:
+            raise ValueError("Data must be loaded before calculating popularity scores")
+        windows = sorted(set(windows))
+        if self.days is not None and windows[-1] > self.days:
+            raise ValueError(f"Data was loaded for a {self.days} day window, cannot calculate popularity for {windows[-1]} days")
+
+        latest_date = self.latest_date if self.latest_date is not None else self.data['firstStart'].max()
+        data = self.data[self.data['contentType'].isin(CONTENT_TYPES)]
+        codes, items = pd.factorize(data['itemId'], sort=True)
+        # Index of the shortest window each row falls in, len(windows) for rows outside every window
+        bucket = np.full(len(data), len(windows), dtype=np.int64)
+        for i, days in reversed(list(enumerate(windows))):
+            bucket[(data['firstStart'] >= latest_date - timedelta(days)).to_numpy()] = i
+        inside = (bucket < len(windows)) & (codes >= 0)
+        keys = codes[inside] * len(windows) + bucket[inside]
+        shape = (len(items), len(windows))
+        count = np.cumsum(np.bincount(keys, minlength=shape[0] * shape[1]).reshape(shape), axis=1)
+        # Missing durations count as 0, like the pandas sum skips them
+        durations = np.nan_to_num(data['durationSec'].to_numpy(dtype=np.float64, na_value=np.nan)[inside], nan=0.0)
+        duration = np.cumsum(np.bincount(keys, weights=durations, minlength=shape[0] * shape[1]).reshape(shape), axis=1)
+
+        scores = {}
+        for i, days in enumerate(windows):
+            viewed = count[:, i] > 0
+            scores[f'count_{days}d'] = self._normalize(count[:, i], viewed)
+            scores[f'duration_{days}d'] = self._normalize(duration[:, i], viewed)
+        self.popularity_arrays = PopularityArrays(items, scores)
+        return self.popularity_arrays
+
+    def calculate_session_popularity_array(self):
+        """
+        Array version of calculate_popularity_scores_sessions, as a PopularityArrays with a session score.
+        """
+        if self.type != 'sessions':
+            raise ValueError("This method is only supported for session data")
+        if self.data is None:
+            raise ValueError("Data must be loaded before calculating popularity scores")
+        ids = pd.concat([self.data['itemId'], self.data['nextItemId']], ignore_index=True)
+        codes, items = pd.factorize(ids, sort=True)
+        weights = np.tile(np.nan_to_num(self.data['count'].to_numpy(dtype=np.float64, na_value=np.nan), nan=0.0), 2)
+        count = np.bincount(codes[codes >= 0], weights=weights[codes >= 0], minlength=len(items))
+        low, high = count.min(), count.max()
+        session = (count - low) / (high - low) if high != low else np.zeros(len(items))
+        self.popularity_arrays = PopularityArrays(items, {'session': session.astype(np.float32)})
+        return self.popularity_arrays
+
+    def _normalize(self, values, present):
+        # Min-max normalization over the present items, NaN for the others
+        scores = np.full(len(values), np.nan, dtype=np.float32)
+        if present.any():
+            low, high = values[present].min(), values[present].max()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                scores[present] = (values[present] - low) / (high - low)
+        return scores
@@ -1,29 +1,178 @@
+import atexit
+import json
+import logging
 import os
+import queue
+import threading
 import requests
 import traceback
 import time
 
 
+class NullSink():
+    """
+    Drops every payload, used when Slack is not configured.
+    """
+    def send(self, payload):
+        pass
+
+    def close(self):
+        pass
+
+
+class FileSink():
+    """
+    Appends every payload as a JSON line to a file, for runs without a webhook.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, payload):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(payload, default=str) + '\n')
+
+    def close(self):
+        pass
+
+
+class WebhookSink():
+    """
+    Posts payloads to a webhook over one pooled session, with a (connect, read) timeout so an unreachable or
+    slow webhook costs at most that long per post.
+    """
+    def __init__(self, url, timeout=(3.05, 10)):
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def send(self, payload):
+        response = self.session.post(self.url, json=payload, timeout=self.timeout)
+        response.raise_for_status()
+
+    def close(self):
+        self.session.close()
+
+
+class Notifier():
+    """
+    Sends payloads to a sink from a background thread, so the caller never waits on the network. Messages are
+    sent in order as they come, results are collected and sent as one digest every digest_interval seconds
+    (and on flush and close). The queue is bounded, when the sink falls behind new payloads are dropped and
+    counted instead of blocking the caller. Pending payloads are sent on exit.
+    """
+    def __init__(self, sink, digest_interval=60, max_queue=1000, defaults=None, logger=None):
+        self.sink = sink
+        self.digest_interval = digest_interval
+        # Fields added to every payload, like the channel
+        self.defaults = defaults or {}
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.queue = queue.Queue(max_queue)
+        self.results = []
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name='notifier', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def send(self, payload):
+        self._put(('send', payload))
+
+    def add_result(self, result):
+        # A result (an attachment of the digest), sent with the next digest
+        self._put(('result', result))
+
+    def flush(self, timeout=None):
+        """
+        Sends the pending digest and waits until everything queued before has been sent, or timeout seconds.
+        """
+        done = threading.Event()
+        if not self._put(('flush', done), timeout):
+            return False
+        return done.wait(timeout)
+
+    def close(self, timeout=30):
+        if self.closed:
+            return
+        self.flush(timeout)
+        self._put(('stop', None), timeout)
+        self.closed = True
+        self.thread.join(timeout)
+        self.sink.close()
+
+    def _put(self, item, timeout=0):
+        # Payloads never wait for room in the queue, flush and stop wait up to timeout
+        if self.closed:
+            return False
+        try:
+            self.queue.put(item, block=timeout != 0, timeout=timeout)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def _run(self):
+        next_digest = time.monotonic() + self.digest_interval
+        while True:
+            try:
+                kind, value = self.queue.get(timeout=max(0, next_digest - time.monotonic()))
+            except queue.Empty:
+                kind, value = 'digest', None
+            if kind == 'send':
+                self._send(value)
+            elif kind == 'result':
+                self.results.append(value)
+            if kind in ('digest', 'flush', 'stop') or time.monotonic() >= next_digest:
+                self._send_digest()
+                next_digest = time.monotonic() + self.digest_interval
+            if kind == 'flush':
+                value.set()
+            elif kind == 'stop':
+                return
+
+    def _send_digest(self, max_attachments=50):
+        results, self.results = self.results, []
+        # Slack takes at most 100 attachments per message
+        for start in range(0, len(results), max_attachments):
+            chunk = results[start:start + max_attachments]
+            self._send({'text': f"{len(chunk)} evaluation result(s)", 'attachments': chunk})
+
+    def _send(self, payload):
+        try:
+            self.sink.send({**self.defaults, **payload})
+            self.sent += 1
+        except Exception as e:
+            self.failed += 1
+            self.logger.warning(f"Could not send notification: {e}")
+
+
 class Slack():
-    def __init__(self) -> None:
-        self.slack_url = os.getenv('SLACK_URL')
-        if not self.slack_url:
-            raise ValueError('SLACK_URL environment variable not found.')
-        
-        self.slack_channel = os.getenv('SLACK_CHANNEL')
-        if not self.slack_channel:
-            raise ValueError('SLACK_CHANNEL environment variable not found.')
-        
-        self.slack_token = os.getenv('SLACK_TOKEN')
-        if not self.slack_token:
-            raise ValueError('SLACK_TOKEN environment variable not found.')
+    """
+    Slack notifications of a run, sent by a background Notifier. Results are batched into digests every
+    digest_interval seconds. Without the SLACK_URL and SLACK_CHANNEL environment variables (or arguments)
+    the notifications are written to the file at fallback_path, or dropped when it is not set.
+    """
+    def __init__(self, url=None, channel=None, token=None, digest_interval=60, timeout=(3.05, 10), fallback_path=None, logger=None) -> None:
+        self.slack_url = url or os.getenv('SLACK_URL')
+        self.slack_channel = channel or os.getenv('SLACK_CHANNEL')
+        self.slack_token = token or os.getenv('SLACK_TOKEN')
+        logger = logger if logger is not None else logging.getLogger(__name__)
+        if self.slack_url and self.slack_channel:
+            sink = WebhookSink(self.slack_url, timeout)
+        else:
+            logger.warning("SLACK_URL or SLACK_CHANNEL not set, " +
+                           (f"writing notifications to {fallback_path}" if fallback_path else "notifications are disabled"))
+            sink = FileSink(fallback_path) if fallback_path else NullSink()
+        self.notifier = Notifier(sink, digest_interval=digest_interval, defaults={'channel': self.slack_channel} if self.slack_channel else None,
+                                 logger=logger)
 
     def send_message(self, message):
         payload = {
             "channel": self.slack_channel,
             "text": message
         }
-        requests.post(self.slack_url, json=payload)
+        self.notifier.send(payload)
 
     def send_exception(self, exc_info):
         exc_type, exc_value, exc_traceback = exc_info
@@ -53,30 +202,31 @@ class Slack():
                 },
             ]
         }
-        requests.post(self.slack_url, json=payload)
+        self.notifier.send(payload)
+        # The run is usually about to exit, so the pending results go out with it
+        self.notifier.flush(timeout=30)
 
     def send_results(self, message, avg_ctr, mean_avg_precision, avg_popularity_score, avg_count_popularity_score, coverage):
-        payload = {
-            'text': message,
-            'attachments': [
-                {
-                    'fallback': 'Attachment fallback text',
-                    'color': '#36a64f',
-                    'pretext': 'Heres results for the evaluation:',
-                    'fields': [ 
-                        {'title': 'Average CTR', 'value': avg_ctr, 'short': True},
-                        {'title': 'Mean Average Precision', 'value': mean_avg_precision, 'short': True},
-                        {'title': 'Average Duration Popularity Score', 'value': avg_popularity_score, 'short': True},
-                        {'title': 'Average Count Popularity Score', 'value': avg_count_popularity_score, 'short': True},
-                        {'title': 'Coverage', 'value': coverage, 'short': True},
-                    ],
-                    'footer': 'Attachment Footer',
-                    'ts': int(time.time())
-                }
-            ]
-        }
+        # One attachment of the next results digest
+        self.notifier.add_result({
+            'fallback': message,
+            'color': '#36a64f',
+            'pretext': message,
+            'fields': [
+                {'title': 'Average CTR', 'value': avg_ctr, 'short': True},
+                {'title': 'Mean Average Precision', 'value': mean_avg_precision, 'short': True},
+                {'title': 'Average Duration Popularity Score', 'value': avg_popularity_score, 'short': True},
+                {'title': 'Average Count Popularity Score', 'value': avg_count_popularity_score, 'short': True},
+                {'title': 'Coverage', 'value': coverage, 'short': True},
+            ],
+            'ts': int(time.time())
+        })
+
+    def flush(self, timeout=None):
+        return self.notifier.flush(timeout)
 
-        requests.post(self.slack_url, json=payload)
+    def close(self, timeout=30):
+        self.notifier.close(timeout)
 
 
     # def upload_file(self, file_path, message=""):
@@ -0,0 +1,158 @@
+import numpy as np
+import pandas as pd
+
+from rec.utils.data import read_ids, write_ids
+
+
+class Vocabulary:
+    """
+    Append-only mapping from raw IDs to dense int32 codes, shared by the models, the Reranker and the
+    evaluator so that merges, overlap checks and metric comparisons are integer operations. Codes never change
+    once given, adding IDs only appends, so arrays indexed by code stay valid as the vocabulary grows.
+
+    Lookups are vectorized: the keys are held in a pd.Index, whose hash table is rebuilt on the first lookup
+    after new IDs were added, so adding the IDs of a model is one pass over an array.
+    """
+    def __init__(self, ids=()):
+        # code -> the ID as it was first added, and the normalized key of every code
+        self._ids = np.empty(0, dtype=object)
+        self._keys = np.empty(0, dtype=object)
+        # Lazily built vectorized lookups, reset when IDs are added
+        self._index = None
+        self._id_array = None
+        if len(ids):
+            self.add(ids)
+
+    def key(self, id):
+        # The form IDs are compared in, subclasses normalize IDs that appear with different types
+        return id
+
+    def normalize(self, ids):
+        # The keys of many IDs at once, as an object array
+        return np.asarray(ids, dtype=object)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, id):
+        return self.code(id) >= 0
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = pd.Index(self._keys)
+        return self._index
+
+    def add(self, ids):
+        """
+        Adds the IDs that are not in the vocabulary yet and returns the codes of all of them.
+        """
+        ids = np.asarray(ids, dtype=object) if not isinstance(ids, np.ndarray) else ids
+        keys = self.normalize(ids)
+        codes = self.index.get_indexer(keys).astype(np.int32) if len(self._keys) else np.full(len(keys), -1, dtype=np.int32)
+        new = np.flatnonzero(codes < 0)
+        if len(new):
+            # New keys get codes in order of first appearance
+            order, unique = pd.factorize(keys[new])
+            first = np.unique(order, return_index=True)[1]
+            codes[new] = len(self._keys) + order
+            self._keys = np.concatenate([self._keys, np.asarray(unique, dtype=object)])
+            self._ids = np.concatenate([self._ids, np.asarray(ids[new[first]], dtype=object)])
+            self._index = None
+            self._id_array = None
+        return codes
+
+    def code(self, id, default=-1):
+        try:
+            code = self.index.get_loc(self.key(id))
+        except (KeyError, TypeError):
+            return default
+        return code if isinstance(code, (int, np.integer)) else default
+
+    def codes(self, ids):
+        # Codes of many IDs at once, -1 for IDs that are not in the vocabulary
+        if not len(self._keys):
+            return np.full(len(ids), -1, dtype=np.int32)
+        return self.index.get_indexer(self.normalize(ids)).astype(np.int32)
+
+    @property
+    def keys(self):
+        # The normalized key of every code
+        return self._keys
+
+    def ids(self, codes):
+        # The IDs of an array of codes, -1 becomes None
+        if self._id_array is None:
+            self._id_array = np.append(self._ids, None)
+        codes = np.asarray(codes)
+        return self._id_array[np.where(codes < 0, len(self._ids), codes)]
+
+    def save(self, path):
+        write_ids(path, self._ids)
+
+    @classmethod
+    def load(cls, path):
+        return cls(read_ids(path, mmap=False))
+
+
+class ItemVocabulary(Vocabulary):
+    """
+    Vocabulary of item IDs. Items are strings in the session and viewing data and integers in the test set,
+    so they are compared by their string form.
+    """
+    def key(self, id):
+        return str(id)
+
+    def normalize(self, ids):
+        ids = np.asarray(ids, dtype=object) if not isinstance(ids, np.ndarray) else ids
+        # Arrays of strings, the common case, are used as they are
+        if ids.dtype == object and pd.api.types.infer_dtype(ids, skipna=False) == 'string':
+            return ids
+        return np.asarray(pd.Index(ids).astype(str), dtype=object)
+
+
+class UserVocabulary(Vocabulary):
+    """
+    Vocabulary of user (profile) IDs.
+    """
+
+
+class CodeMap:
+    """
+    Maps the codes a model keeps its arrays in (positions in its own ID array, like the columns of the
+    user-item matrix or the rows of the transition index) to the codes of a shared vocabulary and back.
+    Building the map adds the IDs of the model to the vocabulary, so every ID a model can return has a code.
+    """
+    def __init__(self, vocabulary, ids):
+        self.vocabulary = vocabulary
+        # model code -> vocabulary code
+        self.shared = vocabulary.add(ids)
+        # vocabulary code -> model code, -1 for IDs the model does not know. IDs added to the vocabulary
+        # later are past the end, and are not known to the model either
+        self.local = np.full(len(vocabulary), -1, dtype=np.int32)
+        self.local[self.shared] = np.arange(len(self.shared), dtype=np.int32)
+
+    def to_shared(self, codes):
+        codes = np.asarray(codes)
+        valid = codes >= 0
+        return np.where(valid, self.shared[np.where(valid, codes, 0)] if len(self.shared) else -1, -1).astype(np.int32)
+
+    def to_local(self, codes):
+        codes = np.asarray(codes)
+        valid = (codes >= 0) & (codes < len(self.local))
+        return np.where(valid, self.local[np.where(valid, codes, 0)] if len(self.local) else -1, -1).astype(np.int32)
+
+    def code(self, id):
+        # The model code of one ID, -1 if the model does not know it
+        code = self.vocabulary.code(id)
+        return int(self.local[code]) if 0 <= code < len(self.local) else -1
+
+    def codes(self, ids):
+        # The model codes of many IDs, -1 for IDs the model does not know
+        return self.to_local(self.vocabulary.codes(ids))
+
+
+# The vocabularies every model codes its IDs in unless it is given others, so the codes of CF, Bridges, the
+# popularity arrays and the evaluator are the same integers
+ITEMS = ItemVocabulary()
+USERS = UserVocabulary()
@@ -0,0 +1,36 @@
+import logging
+
+import pytest
+
+from rec.benchmarks.synthetic import generate
+from rec.models.als import CFRecommender
+from rec.models.bridges import Bridges
+
+
+@pytest.fixture(scope='session')
+def paths(tmp_path_factory):
+    # A small synthetic data set in the layout the loaders read
+    return generate(str(tmp_path_factory.mktemp('data')), users=500, items=200, days=4, views=3000, transitions=1500,
+                    test_cases=400, seed=7)
+
+
+@pytest.fixture
+def logger():
+    # The models rename the logger they are given
+    return logging.getLogger('tests')
+
+
+@pytest.fixture(scope='session')
+def cf(paths):
+    model = CFRecommender(factors=8, iterations=3, logger=logging.getLogger('tests'))
+    model.load_data(paths['cf'], nested=True)
+    model.preprocess()
+    model.fit()
+    return model
+
+
+@pytest.fixture(scope='session')
+def bridges(paths):
+    model = Bridges(logger=logging.getLogger('tests'))
+    model.fit(paths['bridges'], nested=True)
+    return model
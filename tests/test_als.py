@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from rec.models.als import CFRecommender
+
+
+def test_load_recommends_like_the_saved_model(cf, tmp_path, logger):
+    cf.save(str(tmp_path))
+    loaded = CFRecommender.load(str(tmp_path), logger=logger)
+    users = np.asarray(cf.user_index[:50], dtype=object)
+    for user in users:
+        expected, loaded_recs = cf.recommend_standard(user, N=10), loaded.recommend_standard(user, N=10)
+        assert [item.item_id for item in loaded_recs.items] == [item.item_id for item in expected.items]
+    np.testing.assert_array_equal(loaded.recommend_batch(users, N=10)[0], cf.recommend_batch(users, N=10)[0])
+    assert loaded.recommend_standard('unknown user') is None
+
+
+def test_fold_in_on_a_loaded_model(cf, tmp_path, logger):
+    cf.save(str(tmp_path))
+    loaded = CFRecommender.load(str(tmp_path), logger=logger)
+    items = np.asarray(cf.item_index[:3], dtype=object)
+    data = pd.DataFrame({'profileId': ['new user'] * 3 + [cf.user_index[0]],
+                         'itemId': list(items) + [items[0]], 'durationSec': [600, 1200, 300, 900]})
+    users = loaded.fold_in(data)
+
+    assert set(users) == {'new user', cf.user_index[0]}
+    assert loaded.user_code('new user') == len(cf.user_index)
+    recommendation = loaded.recommend_standard('new user', N=5)
+    assert len(recommendation.items) == 5
+    # Items the user watched are not recommended
+    assert not set(items) & {item.item_id for item in recommendation.items}
+    # The saved files are left as they were
+    np.testing.assert_array_equal(CFRecommender.load(str(tmp_path), logger=logger).model.user_factors,
+                                  cf.model.user_factors)
+
+
+def test_lean_fit_equals_the_default_fit(paths, logger):
+    models = []
+    for lean in [False, True]:
+        CF = CFRecommender(factors=8, iterations=3, logger=logger, lean=lean)
+        CF.load_data(paths['cf'], nested=True)
+        CF.preprocess()
+        CF.fit()
+        models.append(CF)
+    default, lean = models
+    assert lean.data is None and lean.sessions is None
+    np.testing.assert_array_equal(lean.user_index, default.user_index)
+    np.testing.assert_array_equal(lean.item_index, default.item_index)
+    assert (lean.uim != default.uim).nnz == 0
+    np.testing.assert_allclose(lean.model.item_factors, default.model.item_factors, rtol=1e-4, atol=1e-6)
+    users = np.asarray(default.user_index[:50], dtype=object)
+    np.testing.assert_array_equal(lean.recommend_batch(users, N=10)[0], default.recommend_batch(users, N=10)[0])
+
+
+def test_load_keeps_the_ids_in_the_mapped_file(cf, tmp_path, logger):
+    cf.save(str(tmp_path))
+    loaded = CFRecommender.load(str(tmp_path), logger=logger)
+    assert isinstance(loaded.user_index.dtype, pd.ArrowDtype) and isinstance(loaded.item_index.dtype, pd.ArrowDtype)
+    assert loaded._user_map is None and loaded._item_map is None
+    np.testing.assert_array_equal(loaded.item_ids([2, -1, 0]), cf.item_ids([2, -1, 0]))
+
+
+def test_drift_report(cf, tmp_path, logger):
+    cf.save(str(tmp_path))
+    loaded = CFRecommender.load(str(tmp_path), logger=logger)
+    users = np.asarray(cf.user_index[:20], dtype=object)
+    # The same factors give the same scores
+    report = loaded.drift_report(cf, user_ids=list(users) + ['unknown user'], N=5)
+    assert (report['users'], report['missing_users']) == (20, 1)
+    assert report['score_correlation_mean'] == pytest.approx(1, abs=1e-5)
+    assert report['top_5_overlap_mean'] == 1
+
+    items = np.asarray(cf.item_index[:3], dtype=object)
+    loaded.fold_in(pd.DataFrame({'profileId': [users[0]] * 3, 'itemId': items, 'durationSec': [600, 1200, 300]}))
+    report = loaded.drift_report(cf, N=5)
+    assert report['users'] == 1 and -1 <= report['score_correlation_mean'] <= 1
+    assert 0 <= report['top_5_overlap_mean'] <= 1
+
+    # No users to compare gives an empty report, no common items cannot be compared
+    assert loaded.drift_report(cf, user_ids=['unknown user'])['score_correlation_mean'] is None
+    other = CFRecommender.load(str(tmp_path), logger=logger)
+    other._set_vocabulary(other.user_index, pd.Index([f'other {item}' for item in other.item_index]))
+    with pytest.raises(ValueError):
+        loaded.drift_report(other, user_ids=users)
+
+
+@pytest.mark.parametrize('batch_size', [None, 7])
+def test_batch_recommends_like_recommend_standard(cf, batch_size):
+    users = list(cf.user_index[:100]) + ['unknown user']
+    codes, scores, found = cf.recommend_batch(users, N=10, batch_size=batch_size)
+    raw_codes, raw_scores, _ = cf.recommend_batch(users, N=10, batch_size=batch_size, normalize=False)
+    assert found.tolist() == [True] * 100 + [False]
+    assert (codes[-1] == -1).all() and np.isnan(scores[-1]).all()
+    np.testing.assert_array_equal(raw_codes, codes)
+    for row, user in enumerate(users[:-1]):
+        expected = cf.recommend_standard(user, N=10)
+        assert list(cf.item_ids(codes[row])) == [item.item_id for item in expected.items]
+        np.testing.assert_allclose(scores[row], [item.score for item in expected.items], rtol=1e-4, atol=1e-5)
+        expected_codes, expected_scores = cf.recommend_scores(user, N=10)
+        np.testing.assert_array_equal(raw_codes[row], expected_codes)
+        np.testing.assert_allclose(raw_scores[row], expected_scores, rtol=1e-5, atol=1e-6)
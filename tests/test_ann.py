@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+import scipy.sparse as sparse
+
+from rec.models.ann import IVFIndex
+
+
+@pytest.fixture
+def factors():
+    rng = np.random.default_rng(0)
+    return rng.normal(size=(2000, 16)).astype(np.float32), rng.normal(size=(50, 16)).astype(np.float32)
+
+
+@pytest.mark.parametrize('n_probe', [1, 4, 40])
+def test_search_leaves_out_excluded_items(factors, n_probe):
+    items, users = factors
+    index = IVFIndex(n_lists=40, n_probe=n_probe).fit(items)
+    for user in users:
+        lists = index.probe(user[None, :])[0]
+        # Items of the probed lists that the unrestricted search would return
+        top, _ = index.search(user, 10)
+        exclude = np.r_[top, np.flatnonzero(np.isin(index.lists, lists))[:5]].astype(np.int32)
+        found, scores = index.search(user, 10, exclude=exclude)
+        assert not np.isin(found, exclude).any()
+        assert len(found) == 10 and np.all(np.diff(scores) <= 0)
+
+
+def test_search_batch_leaves_out_liked_items(factors):
+    items, users = factors
+    index = IVFIndex(n_lists=40, n_probe=4).fit(items)
+    top, _ = index.search_batch(users, 20)
+    liked = sparse.csr_matrix((np.ones(top.size), top.ravel(), np.arange(0, top.size + 1, 20)), shape=(len(users), len(items)))
+    found, _ = index.search_batch(users, 20, liked=liked)
+    for row in range(len(users)):
+        assert not np.isin(found[row], top[row]).any()
+
+
+def test_all_lists_probed_is_exact(factors):
+    items, users = factors
+    index = IVFIndex(n_lists=40, n_probe=40).fit(items)
+    found, scores = index.search(users[0], 10, exclude=np.arange(5))
+    expected = np.argsort(-(items @ users[0]), kind='stable')
+    expected = expected[~np.isin(expected, np.arange(5))][:10]
+    np.testing.assert_array_equal(found, expected)
@@ -0,0 +1,37 @@
+import json
+import os
+import sys
+
+from rec.benchmarks import suite
+from rec.utils.metrics import METRICS
+
+STAGES = ['popularity_viewing', 'popularity_sessions', 'cf_load', 'cf_fit', 'bridges_fit', 'cf_recommend_standard',
+          'reranker_recommend', 'evaluate_reranker', 'evaluate_reranker_grid']
+
+
+def test_suite_runs_on_a_data_set(paths, tmp_path, monkeypatch, capsys):
+    data = os.path.dirname(os.path.dirname(paths['cf']))
+    out = tmp_path / 'benchmark.json'
+    # The suite enables the shared registry, it is disabled and emptied again after the test
+    monkeypatch.setattr(METRICS, 'enabled', False)
+    monkeypatch.setattr(METRICS, 'counters', {})
+    monkeypatch.setattr(METRICS, 'histograms', {})
+    monkeypatch.setattr(METRICS, 'gauges', {})
+    argv = ['suite', '--data', data, '--out', str(out), '--factors', '4', '--iterations', '2', '--requests', '20',
+            '--test-cases', '100', '--K', '10', '--w1s', '0.5', '--metrics']
+    monkeypatch.setattr(sys, 'argv', argv)
+    suite.main()
+
+    report = json.loads(out.read_text())
+    assert list(report['results']) == STAGES
+    assert report['results']['cf_recommend_standard']['calls'] == 20
+    assert report['results']['evaluate_reranker']['test_cases'] == 100
+    assert report['parameters']['data'] == data and report['generation_seconds'] is None
+    assert any(histogram['name'] == 'cf_fit_seconds' for histogram in report['metrics']['histograms'])
+
+    # Comparing with an earlier run prints the ratio of every stage
+    monkeypatch.setattr(sys, 'argv', argv[:4] + [str(tmp_path / 'after.json'), '--compare', str(out)] + argv[5:])
+    capsys.readouterr()
+    suite.main()
+    printed = capsys.readouterr().out
+    assert all(stage in printed for stage in STAGES)
@@ -0,0 +1,204 @@
+import os
+import shutil
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from rec.models.bridges import Bridges
+from rec.utils.data import partition_date
+
+
+def partition_dir(paths, tmp_path, days):
+    # A directory with links to some of the daily partitions
+    root = tmp_path / '_'.join(str(day) for day in days)
+    root.mkdir()
+    partitions = sorted(os.listdir(paths['bridges']))
+    for day in days:
+        os.symlink(os.path.join(paths['bridges'], partitions[day]), root / partitions[day])
+    return str(root)
+
+
+def assert_same_index(index, expected):
+    np.testing.assert_array_equal(index.items, expected.items)
+    np.testing.assert_array_equal(index.indptr, expected.indptr)
+    assert index.methods == expected.methods
+    for method in expected.methods:
+        np.testing.assert_array_equal(index.next_items[method], expected.next_items[method])
+        np.testing.assert_array_equal(index.scores[method], expected.scores[method])
+
+
+@pytest.mark.parametrize('max_k', [None, 3])
+def test_update_equals_a_refit(paths, tmp_path, logger, max_k):
+    partitions = sorted(os.listdir(paths['bridges']))
+    B = Bridges(logger=logger, max_k=max_k)
+    B.fit_partitions(partition_dir(paths, tmp_path, [0, 1, 2]))
+    version = B.version
+    B.update(os.path.join(paths['bridges'], partitions[3]), expire=[partitions[0]])
+    assert B.version > version
+    assert sorted(B.partitions) == partitions[1:]
+
+    expected = Bridges(logger=logger, max_k=max_k)
+    expected.fit_partitions(partition_dir(paths, tmp_path, [1, 2, 3]))
+    assert_same_index(B.model, expected.model)
+
+    # Replacing a stored day with other data and expiring without new data
+    B.update(os.path.join(paths['bridges'], partitions[0]), partition=partitions[1])
+    B.update(expire=[partitions[2]])
+    expected = Bridges(logger=logger, max_k=max_k)
+    expected.fit_partitions(partition_dir(paths, tmp_path, [0, 3]))
+    assert_same_index(B.model, expected.model)
+
+
+def write_partition(root, day, pairs):
+    os.makedirs(root / f'date={day}')
+    pd.DataFrame(pairs, columns=['itemId', 'nextItemId', 'count']).to_parquet(root / f'date={day}' / 'part-0.parquet', index=False)
+
+
+def test_update_adds_and_drops_items(tmp_path, logger):
+    write_partition(tmp_path / 'fit', '2024-01-01', [('1', '2', 3), ('1', '3', 1), ('2', '3', 2), ('2', '1', 1), ('5', '1', 2), ('5', '2', 1)])
+    write_partition(tmp_path / 'fit', '2024-01-02', [('1', '2', 1), ('1', '4', 5), ('2', '4', 1), ('3', '1', 1), ('3', '2', 1)])
+    write_partition(tmp_path / 'new', '2024-01-03', [('6', '7', 1), ('6', '1', 4), ('3', '1', 2), ('1', '6', 1)])
+    B = Bridges(logger=logger, bridgeThresholds=2)
+    B.fit_partitions(str(tmp_path / 'fit'))
+    assert list(B.model.items) == ['1', '2', '3', '4', '5']
+    B.update(str(tmp_path / 'new' / 'date=2024-01-03'), expire=['date=2024-01-01'])
+    assert list(B.model.items) == ['1', '2', '3', '4', '6', '7']
+
+    os.symlink(tmp_path / 'new' / 'date=2024-01-03', tmp_path / 'fit' / 'date=2024-01-03')
+    shutil.rmtree(tmp_path / 'fit' / 'date=2024-01-01')
+    expected = Bridges(logger=logger, bridgeThresholds=2)
+    expected.fit_partitions(str(tmp_path / 'fit'))
+    assert_same_index(B.model, expected.model)
+    assert B.recommend_standard('6', N=2) is not None and B.recommend_standard('5') is None
+
+
+def test_streaming_fit_equals_the_in_memory_fit(paths, logger):
+    streamed, in_memory = Bridges(logger=logger), Bridges(logger=logger)
+    streamed.fit(paths['bridges'], nested=True, streaming=True, batch_size=500)
+    in_memory.fit(paths['bridges'], nested=True)
+    assert_same_index(streamed.model, in_memory.model)
+
+
+def dict_model(data, method):
+    # The dict of sorted (nextItemId, score) lists the index replaced
+    model = {}
+    for row in data.to_dict(orient='records'):
+        model.setdefault(row['itemId'], []).append((row['nextItemId'], row[method]))
+    return {item: sorted(rows, key=lambda row: row[1], reverse=True) for item, rows in model.items()}
+
+
+@pytest.mark.parametrize('N', [-1, 5])
+def test_index_recommends_like_the_dict_model(paths, logger, N):
+    B = Bridges(logger=logger)
+    B.fit(paths['bridges'], nested=True)
+    for method in B.methods:
+        B.change_method(method)
+        expected = dict_model(B.data, method)
+        for item, rows in expected.items():
+            recs = B.recommend_standard(item, N)
+            assert [r.item_id for r in recs.items] == [next_item for next_item, _ in rows[:N]]
+            np.testing.assert_allclose([r.score for r in recs.items], [score for _, score in rows[:N]], rtol=1e-6)
+        assert B.recommend_standard('unknown', N) is None
+
+
+def test_segment_scores_equal_the_pandas_scores(paths, logger):
+    segments, pandas = Bridges(logger=logger), Bridges(logger=logger)
+    segments.fit(paths['bridges'], nested=True, engine='segments')
+    pandas.fit(paths['bridges'], nested=True, engine='pandas')
+    columns = ['itemId', 'nextItemId'] + segments.methods
+    expected = pandas.data[columns].sort_values(['itemId', 'nextItemId'], ignore_index=True)
+    result = segments.data[columns].sort_values(['itemId', 'nextItemId'], ignore_index=True)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False, rtol=1e-9)
+    assert_same_index(segments.model, pandas.model)
+
+
+@pytest.mark.parametrize('days, partitions', [(1, [3]), (2, [2, 3]), (None, [0, 1, 2, 3])])
+def test_window_equals_a_fit_on_its_days(paths, tmp_path, logger, days, partitions):
+    B = Bridges(logger=logger)
+    B.fit_partitions(paths['bridges'])
+    window = B.window(days)
+    assert sorted(window.partitions) == [sorted(os.listdir(paths['bridges']))[day] for day in partitions]
+
+    expected = Bridges(logger=logger)
+    expected.fit(partition_dir(paths, tmp_path, partitions), nested=True)
+    assert_same_index(window.model, expected.model)
+
+
+def test_windows_of_an_earlier_day(paths, tmp_path, logger):
+    B = Bridges(logger=logger)
+    B.fit_partitions(paths['bridges'])
+    latest = B.window_partitions()[2]
+    windows = B.windows([2, None], latest=partition_date(latest))
+    for days, partitions in [(2, [1, 2]), (None, [0, 1, 2])]:
+        expected = Bridges(logger=logger)
+        expected.fit(partition_dir(paths, tmp_path, partitions), nested=True)
+        assert_same_index(windows[days].model, expected.model)
+
+
+def test_window_of_a_window_updates_like_a_refit(paths, tmp_path, logger):
+    partitions = sorted(os.listdir(paths['bridges']))
+    B = Bridges(logger=logger)
+    B.fit_partitions(paths['bridges'])
+    window = B.window(2, latest=partition_date(partitions[2]))
+    assert sorted(window.partitions) == partitions[1:3] and sorted(B.partitions) == partitions
+    assert_same_index(window.window(1).model, B.window(1, latest=partition_date(partitions[2])).model)
+
+    # A window is updated like a model fitted with fit_partitions, the model it came from is left as it was
+    window.update(os.path.join(paths['bridges'], partitions[3]), expire=[partitions[1]])
+    expected = Bridges(logger=logger)
+    expected.fit(partition_dir(paths, tmp_path, [2, 3]), nested=True)
+    assert_same_index(window.model, expected.model)
+    assert_same_index(B.window(2).model, expected.model)
+    assert sorted(B.partitions) == partitions
+
+
+def test_window_and_partition_errors(paths, tmp_path, logger):
+    partitions = sorted(os.listdir(paths['bridges']))
+    B = Bridges(logger=logger)
+    with pytest.raises(ValueError):
+        B.window_partitions()
+    with pytest.raises(ValueError):
+        B.update(expire=[partitions[0]])
+    with pytest.raises(ValueError):
+        B.fit_partitions(str(tmp_path))
+
+    B.fit_partitions(paths['bridges'])
+    assert B.window_partitions(0) == []
+    with pytest.raises(ValueError):
+        B.window(1, latest=partition_date(partitions[0]) - timedelta(1))
+    with pytest.raises(ValueError):
+        B.update(expire=['date=1999-01-01'])
+    # Nothing to apply leaves the model as it was
+    version = B.version
+    B.update()
+    assert B.version == version
+
+
+def test_lean_fit_equals_the_default_fit(paths, logger):
+    lean, default = Bridges(logger=logger, lean=True), Bridges(logger=logger)
+    lean.fit(paths['bridges'], nested=True)
+    default.fit(paths['bridges'], nested=True)
+    assert lean.data is None
+    assert_same_index(lean.model, default.model)
+
+    lean.fit_partitions(paths['bridges'])
+    default.fit_partitions(paths['bridges'])
+    assert_same_index(lean.window(2).model, default.window(2).model)
+
+
+def test_load_keeps_the_ids_in_the_mapped_file(bridges, tmp_path, logger):
+    bridges.save(str(tmp_path))
+    loaded = Bridges.load(str(tmp_path), logger=logger)
+    assert isinstance(loaded.model.items.dtype, pd.ArrowDtype)
+    assert loaded.model._code_map is None
+    assert_same_index(loaded.model, bridges.model)
+    for item in bridges.model.items[:50]:
+        expected, result = bridges.recommend_standard(item, N=10), loaded.recommend_standard(item, N=10)
+        assert (result is None) == (expected is None)
+        if expected is not None:
+            assert [(r.item_id, r.score, r.code) for r in result.items] == [(r.item_id, r.score, r.code) for r in expected.items]
+    # Saving a loaded model writes the same IDs
+    loaded.save(str(tmp_path / 'again'))
+    assert_same_index(Bridges.load(str(tmp_path / 'again'), logger=logger).model, bridges.model)
@@ -0,0 +1,23 @@
+import tracemalloc
+
+import numpy as np
+
+from rec.models.cache import CandidateCache, cache_size_for_memory
+
+
+def test_cache_size_keeps_the_cache_within_memory(cf, bridges):
+    memory, K_max = 1 << 20, 100
+    size = cache_size_for_memory(memory, K_max)
+    cache = CandidateCache(cf, bridges, max_size=size, K_max=K_max)
+    entry = cf.recommend_scores(cf.user_index[0], N=K_max)
+    tracemalloc.start()
+    for user in range(size):
+        # Copies like the ones recommend_scores returns, for users with full top K_max lists
+        cache.cf_cache.put(f'{user:036x}', (K_max, (entry[0].copy(), entry[1].copy())))
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert len(entry[0]) == K_max and entry[0].dtype == np.int32 and entry[1].dtype == np.float32
+    assert len(cache.cf_cache) == size
+    # The CF half of the budget
+    assert used <= memory / 2
+    assert cache_size_for_memory(1 << 30, 100) > cache_size_for_memory(1 << 30, 200) > 0
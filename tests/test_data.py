@@ -0,0 +1,90 @@
+import glob
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from rec.utils.data import (cached_parquet, iter_batches, latest_timestamp, list_parquet_files, load_table, sample_rows,
+                            window_filter)
+
+CSV = """profile_id,item_id,next_item_id,measure_date
+a,12.0,13.0,2024-01-08
+,14.0,15.0,2024-01-08
+b,16.0,,2024-01-08
+c,17.0,18.0,NA
+d,19.0,20.0,2024-01-08
+"""
+
+
+def test_cached_parquet_drops_rows_like_pandas(tmp_path):
+    path = tmp_path / 'test.csv'
+    path.write_text(CSV)
+    cache = cached_parquet(str(path), ['profile_id', 'item_id'], int_columns=['item_id'])
+    expected = pd.read_csv(path).dropna()
+    table = pq.read_table(cache)
+    assert table['profile_id'].to_pylist() == expected['profile_id'].tolist()
+    assert table['item_id'].to_pylist() == expected['item_id'].astype(int).tolist()
+
+
+def test_cached_parquet_rebuilds_for_other_columns(tmp_path):
+    path = tmp_path / 'test.csv'
+    path.write_text(CSV)
+    cached_parquet(str(path), ['profile_id', 'item_id'], int_columns=['item_id'])
+    cache = cached_parquet(str(path), ['profile_id', 'next_item_id'], int_columns=['next_item_id'])
+    assert pq.read_schema(cache).names == ['profile_id', 'next_item_id']
+
+
+def test_sample_rows_matches_dataframe_sample(paths):
+    cache = cached_parquet(paths['test'], ['profile_id', 'item_id', 'next_item_id'],
+                           int_columns=['item_id', 'next_item_id'], cache_path=paths['test'] + '.sample.parquet')
+    expected = pd.read_csv(paths['test']).dropna().sample(n=50, random_state=42)
+    table = sample_rows(cache, 50, seed=42)
+    assert table['profile_id'].to_pylist() == expected['profile_id'].tolist()
+    assert table['item_id'].to_pylist() == expected['item_id'].astype(int).tolist()
+
+
+def test_cached_parquet_reads_blocks_with_other_types(tmp_path):
+    # The first blocks only have numeric profile IDs and dates that are missing, a later block has others
+    rows = [f'{n},{n}.0,{n + 1}.0,' for n in range(200)] + [f'user {n},{n}.0,{n + 1}.0,2024-01-08' for n in range(200)]
+    path = tmp_path / 'test.csv'
+    path.write_text('profile_id,item_id,next_item_id,measure_date\n' + '\n'.join(rows) + '\n')
+    cache = cached_parquet(str(path), ['profile_id', 'item_id', 'next_item_id'], int_columns=['item_id', 'next_item_id'],
+                           block_size=1 << 10)
+    expected = pd.read_csv(path, dtype={'profile_id': str}).dropna()
+    table = pq.read_table(cache)
+    assert table.schema.field('profile_id').type == 'string'
+    assert table['profile_id'].to_pylist() == expected['profile_id'].tolist()
+    assert table['next_item_id'].to_pylist() == expected['next_item_id'].astype(int).tolist()
+
+
+def read_files(files):
+    # Every row of the files, read one file at a time with pandas
+    return pd.concat([pd.read_parquet(file) for file in files], ignore_index=True)
+
+
+@pytest.mark.parametrize('limit', [-1, 1])
+def test_projection_and_pushdown_equal_pandas(paths, limit):
+    files = list_parquet_files(paths['cf'], nested=True, limit=limit)
+    assert len(files) == (len(glob.glob(paths['cf'] + '/**/*.parquet', recursive=True)) if limit == -1 else limit + 1)
+    rows = read_files(files)
+    columns = ['itemId', 'durationSec']
+    latest = latest_timestamp(paths['cf'], nested=True, limit=limit)
+    assert latest.as_py() == rows['firstStart'].max()
+
+    expected = rows[rows['firstStart'] >= rows['firstStart'].max() - pd.Timedelta(days=1)][columns]
+    expected = expected.sort_values(columns).reset_index(drop=True)
+    table = load_table(paths['cf'], columns=columns, filter=window_filter(latest, 1), nested=True, limit=limit)
+    assert table.column_names == columns
+    pd.testing.assert_frame_equal(table.to_pandas().sort_values(columns).reset_index(drop=True), expected)
+    batches = pa.Table.from_batches(list(iter_batches(paths['cf'], columns=columns, filter=window_filter(latest, 1),
+                                                      nested=True, limit=limit, batch_size=100)))
+    pd.testing.assert_frame_equal(batches.to_pandas().sort_values(columns).reset_index(drop=True), expected)
+
+
+def test_dictionary_columns_keep_the_values(paths):
+    table = load_table(paths['cf'], columns=['profileId', 'itemId'], nested=True, dictionary_columns=['itemId'])
+    assert pa.types.is_dictionary(table.schema.field('itemId').type)
+    assert not pa.types.is_dictionary(table.schema.field('profileId').type)
+    expected = read_files(list_parquet_files(paths['cf'], nested=True))
+    assert sorted(table['itemId'].to_pylist()) == sorted(expected['itemId'])
@@ -0,0 +1,138 @@
+import multiprocessing
+import os
+
+import pandas as pd
+import pytest
+
+from rec.evaluator import evaluator
+from rec.evaluator.evaluator import Evaluation
+from rec.evaluator.results import ResultsStore
+from rec.models.als import CFRecommender
+from rec.models.reranker import Reranker
+from rec.utils.popularity import PopularityScore
+
+
+def evaluation(cf, bridges, paths, out_path, logger, store=None):
+    E = Evaluation(out_path=str(out_path) + '/', logger=logger, store=store)
+    E.progress = False
+    E.setup(cf, bridges, Reranker(bridges, cf, logger=logger, cache_size=1000, K_max=50), paths['test'])
+    E.prepare_reranker_evaluations(['reranker', 'bridges', 'cf'], [bridges.method], [0.25, 0.5, 0.75], [10], [1, 3, 5])
+    E.evaluation_cases.sort(key=lambda case: (case.model, case.w1, case.K, case.N))
+    return E
+
+
+def read_results(path):
+    return pd.read_csv(path).sort_values(['model', 'w1', 'N']).reset_index(drop=True)
+
+
+def _killed_run(cf, bridges, paths, out_path, logger, kill_after):
+    # Runs the evaluation and exits the process without cleanup in the report of case kill_after, like a SIGKILL
+    store = ResultsStore(str(out_path / 'results.sqlite'))
+    E = evaluation(cf, bridges, paths, out_path, logger, store)
+    report = E._report
+    reported = []
+
+    def killing_report(*args):
+        report(*args)
+        reported.append(args)
+        if len(reported) == kill_after:
+            os._exit(1)
+
+    E._report = killing_report
+    E.evaluate_reranker('experiment')
+
+
+@pytest.mark.parametrize('grid', [False, True])
+def test_killed_run_resumes_with_the_missing_cases(cf, bridges, paths, tmp_path, logger, grid):
+    expected = evaluation(cf, bridges, paths, tmp_path / 'expected', logger)
+    os.makedirs(tmp_path / 'expected')
+    expected.evaluate_reranker('experiment', grid=grid)
+
+    os.makedirs(tmp_path / 'resumed')
+    process = multiprocessing.get_context('fork').Process(
+        target=_killed_run, args=(cf, bridges, paths, tmp_path / 'resumed', logger, 5))
+    process.start()
+    process.join()
+    assert process.exitcode == 1
+
+    store = ResultsStore(str(tmp_path / 'resumed' / 'results.sqlite'))
+    E = evaluation(cf, bridges, paths, tmp_path / 'resumed', logger, store)
+    pending = E._pending_cases('experiment')
+    assert 0 < len(pending) < len(E.evaluation_cases)
+    written = pd.read_csv(tmp_path / 'resumed' / 'experiment.csv')
+    assert len(written) == len(E.evaluation_cases) - len(pending)
+
+    E.evaluate_reranker('experiment', grid=grid)
+    resumed = read_results(tmp_path / 'resumed' / 'experiment.csv')
+    pd.testing.assert_frame_equal(resumed, read_results(tmp_path / 'expected' / 'experiment.csv'))
+    assert len(store.read('experiment')) == len(E.evaluation_cases)
+    store.close()
+
+
+def test_serial_evaluation_prepares_the_codes_once(cf, bridges, paths, tmp_path, logger, monkeypatch):
+    E = evaluation(cf, bridges, paths, tmp_path, logger)
+    prepare_codes = E._prepare_codes
+    calls = []
+    monkeypatch.setattr(E, '_prepare_codes', lambda: calls.append(1) or prepare_codes())
+    E.evaluate_reranker('serial')
+    assert len(calls) == 1
+    assert len(pd.read_csv(tmp_path / 'serial.csv')) == len(E.evaluation_cases)
+
+
+@pytest.mark.parametrize('grid', [False, True])
+def test_workers_give_the_serial_results(cf, bridges, paths, tmp_path, logger, grid):
+    evaluation(cf, bridges, paths, tmp_path, logger).evaluate_reranker('serial', grid=grid)
+    evaluation(cf, bridges, paths, tmp_path, logger).evaluate_reranker('workers', grid=grid, workers=3)
+    pd.testing.assert_frame_equal(read_results(tmp_path / 'workers.csv'), read_results(tmp_path / 'serial.csv'))
+
+
+def test_workers_split_the_candidate_cache(cf, bridges, paths, tmp_path, logger, monkeypatch):
+    E = evaluation(cf, bridges, paths, tmp_path, logger)
+    monkeypatch.setattr(evaluator.threadpoolctl, 'threadpool_limits', lambda *args: None)
+    monkeypatch.setattr(evaluator, '_EVALUATION', E)
+    evaluator._init_worker(4)
+    assert E.R.cache.stats()['cf']['max_size'] == E.R.cache.stats()['bridges']['max_size'] == 250
+    assert 1 <= evaluator.default_workers() <= 4
+    assert evaluator.default_workers(1) == 1
+
+
+class FlushedSlack:
+    def __init__(self):
+        self.calls = []
+
+    def flush(self, timeout=None):
+        self.calls.append('flush')
+
+    def send_results(self, *args, **kwargs):
+        self.calls.append('results')
+
+
+def test_workers_fork_after_the_notifications_are_sent(cf, bridges, paths, tmp_path, logger):
+    E = evaluation(cf, bridges, paths, tmp_path, logger)
+    E.slack = FlushedSlack()
+    E.evaluate_reranker('workers', grid=True, workers=2)
+    assert E.slack.calls[0] == 'flush' and 'results' in E.slack.calls
+
+
+def fitted_cf(paths, logger, random_state):
+    CF = CFRecommender(factors=8, iterations=3, logger=logger, random_state=random_state)
+    CF.load_data(paths['cf'], nested=True)
+    CF.preprocess()
+    CF.fit()
+    return CF
+
+
+def test_fingerprint_depends_on_the_factors_and_the_popularity(cf, bridges, paths, tmp_path, logger):
+    fingerprint = evaluation(cf, bridges, paths, tmp_path, logger).data_fingerprint()
+    # A refit with the same seed resumes, a refit with another seed does not
+    assert evaluation(fitted_cf(paths, logger, 42), bridges, paths, tmp_path, logger).data_fingerprint() == fingerprint
+    assert evaluation(fitted_cf(paths, logger, 7), bridges, paths, tmp_path, logger).data_fingerprint() != fingerprint
+
+    P = PopularityScore(logger=logger)
+    P.load_data(paths['cf'], nested=True, type='viewing')
+    E = evaluation(cf, bridges, paths, tmp_path, logger)
+    E.popularity_arrays, E.popularity_window = P.calculate_popularity_windows([30]), 30
+    with_popularity = E.data_fingerprint()
+    assert with_popularity != fingerprint
+    E.popularity_arrays.scores['duration_30d'][0] += 1
+    assert E.data_fingerprint() != with_popularity
@@ -0,0 +1,81 @@
+from rec.utils.metrics import Histogram, Metrics
+
+
+def test_histogram_buckets():
+    histogram = Histogram([1, 2, 5])
+    for value in [0.5, 1, 1.5, 2, 4, 7]:
+        histogram.observe(value)
+    # A bucket counts the values up to and including its upper bound, the last one everything above
+    assert histogram.counts == [2, 2, 1, 1]
+    assert (histogram.count, histogram.sum) == (6, 16)
+    assert [histogram.percentile(q) for q in [10, 50, 80, 100]] == [1, 2, 5, float('inf')]
+    assert Histogram([1]).percentile(50) is None
+
+    other = Histogram([1, 2, 5])
+    other.observe(3, n=2)
+    histogram.merge(other)
+    assert histogram.counts == [2, 2, 3, 1] and histogram.count == 8
+    assert histogram.to_dict()['buckets'] == {'1': 2, '2': 2, '5': 3, '+Inf': 1}
+
+
+def test_prometheus_text():
+    metrics = Metrics(enabled=True)
+    metrics.inc('requests_total', route='/recommend')
+    metrics.inc('requests_total', 2, route='/stats')
+    metrics.set('queue_size', 3)
+    metrics.histogram('latency_seconds', bounds=[0.1, 1], stage='rank')
+    metrics.observe('latency_seconds', 0.05, stage='rank')
+    metrics.observe('latency_seconds', 0.5, stage='rank')
+    metrics.inc('errors_total', reason='say "no"\\')
+    assert metrics.to_prometheus() == '\n'.join([
+        '# TYPE errors_total counter',
+        'errors_total{reason="say \\"no\\"\\\\"} 1',
+        '# TYPE requests_total counter',
+        'requests_total{route="/recommend"} 1',
+        'requests_total{route="/stats"} 2',
+        '# TYPE queue_size gauge',
+        'queue_size 3',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{stage="rank",le="0.1"} 1',
+        'latency_seconds_bucket{stage="rank",le="1"} 2',
+        'latency_seconds_bucket{stage="rank",le="+Inf"} 2',
+        'latency_seconds_sum{stage="rank"} 0.55',
+        'latency_seconds_count{stage="rank"} 2',
+    ]) + '\n'
+
+
+def test_save(tmp_path):
+    metrics = Metrics(enabled=True)
+    metrics.inc('requests_total')
+    metrics.save(str(tmp_path / 'metrics.prom'))
+    metrics.save(str(tmp_path / 'metrics.json'))
+    assert (tmp_path / 'metrics.prom').read_text() == metrics.to_prometheus()
+    assert '"requests_total"' in (tmp_path / 'metrics.json').read_text()
+
+
+def test_disabled_metrics_record_nothing():
+    metrics = Metrics()
+    calls = []
+
+    @metrics.timed('call_seconds', memory=True)
+    def call(value):
+        calls.append(value)
+        return value
+
+    metrics.inc('requests_total')
+    metrics.set('queue_size', 3)
+    metrics.observe('latency_seconds', 0.5)
+    with metrics.timer('block_seconds'):
+        pass
+    assert call(1) == 1 and calls == [1]
+    assert (metrics.counters, metrics.gauges, metrics.histograms) == ({}, {}, {})
+    assert metrics.to_prometheus() == '\n'
+
+    metrics.enable()
+    assert call(2) == 2
+    assert metrics.histogram('call_seconds').count == 1
+    assert {name for name, labels in metrics.gauges} == {'rss_peak_bytes', 'rss_retained_bytes'}
+
+    metrics.disable()
+    metrics.inc('requests_total')
+    assert call(3) == 3 and metrics.histogram('call_seconds').count == 1 and not metrics.counters
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from rec.utils.popularity import PopularityScore
+
+
+def assert_same_scores(result, expected):
+    assert result.keys() == expected.keys()
+    items = sorted(expected)
+    np.testing.assert_allclose([result[item] for item in items], [expected[item] for item in items], rtol=1e-6, atol=1e-7)
+
+
+@pytest.mark.parametrize('missing', [False, True])
+def test_window_arrays_equal_the_dicts(paths, logger, missing):
+    P = PopularityScore(logger=logger)
+    P.load_data(paths['cf'], nested=True, type='viewing')
+    if missing:
+        P.data['durationSec'] = P.data['durationSec'].astype(float)
+        P.data.loc[::7, 'durationSec'] = np.nan
+    arrays = P.calculate_popularity_windows([1, 2, 30])
+    for days in [1, 2, 30]:
+        P.calculate_popularity_scores(days)
+        result = arrays.to_dict(days)
+        for score in ['count_score', 'duration_score']:
+            assert_same_scores({item: scores[score] for item, scores in result.items()},
+                               {item: scores[score] for item, scores in P.popularity_scores.items()})
+
+
+@pytest.mark.parametrize('missing', [False, True])
+def test_session_array_equals_the_dict(paths, logger, missing):
+    P = PopularityScore(logger=logger)
+    P.load_data(paths['bridges'], nested=True, type='sessions')
+    if missing:
+        P.data['count'] = P.data['count'].astype(float)
+        P.data.loc[::5, 'count'] = np.nan
+    arrays = P.calculate_session_popularity_array()
+    P.calculate_popularity_scores_sessions()
+    assert_same_scores(dict(zip(arrays.items, arrays.scores['session'].tolist())), P.popularity_scores)
@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from rec.models.reranker import Reranker
+from rec.types.types import RecommendationBatch
+
+COUNTERS = ['missing_bridge_count', 'missing_cf_count', 'not_enough_bridge_count', 'not_enough_cf_count']
+
+
+@pytest.fixture(scope='module')
+def requests(paths):
+    test = pd.read_csv(paths['test']).dropna().head(300)
+    return test['profile_id'].to_numpy(), test['item_id'].to_numpy().astype(np.int64).astype(str)
+
+
+@pytest.mark.parametrize('K, N', [(10, 5), (20, 3)])
+def test_batch_recommends_like_recommend(cf, bridges, logger, requests, K, N):
+    user_ids, item_ids = requests
+    w1s = np.array([0.25, 0.5, 0.75])
+    batch = Reranker(bridges, cf, logger)
+    items, scores, valid = batch.recommend_batch(user_ids, item_ids, N=N, w1=w1s, K=K)
+    assert valid.any() and not valid.all()
+
+    for w, w1 in enumerate(w1s):
+        R = Reranker(bridges, cf, logger)
+        for i, (user_id, item_id) in enumerate(zip(user_ids, item_ids)):
+            recs = R.recommend(user_id, item_id, N=N, w1=w1, w2=1 - w1, K=K)
+            assert valid[i] == (recs is not None)
+            if recs is not None:
+                assert list(items[w, i, :len(recs.items)]) == [r.item_id for r in recs.items]
+                np.testing.assert_allclose(scores[w, i, :len(recs.items)], [r.score for r in recs.items], rtol=1e-4)
+        if w == 0:
+            assert [getattr(batch, counter) for counter in COUNTERS] == [getattr(R, counter) for counter in COUNTERS]
+
+
+def test_many_recommends_like_recommend(cf, bridges, logger, requests):
+    user_ids, item_ids = requests
+    batch = Reranker(bridges, cf, logger).recommend_many(user_ids, item_ids, N=5, w1=0.5, K=10)
+    assert len(batch) == len(user_ids)
+
+    R = Reranker(bridges, cf, logger)
+    for i, (user_id, item_id) in enumerate(zip(user_ids, item_ids)):
+        recs = R.recommend(user_id, item_id, N=5, w1=0.5, w2=0.5, K=10)
+        view = batch[i]
+        assert (view.user_id, view.item_id) == (user_id, item_id)
+        if recs is None:
+            assert len(view) == 0 and view.item_ids == []
+            continue
+        expected = [(r.item_id, r.origin, r.code) for r in recs.items]
+        assert [(item.item_id, item.origin, item.code) for item in view.items] == expected
+        recommendation = view.to_recommendation()
+        assert [(r.item_id, r.origin, r.code) for r in recommendation.items] == expected
+        assert recommendation.item_ids == view.item_ids == [r.item_id for r in recs.items]
+        assert set(recommendation.items_map) == {r.code for r in recs.items}
+        np.testing.assert_allclose([item.score for item in view.items], [r.score for r in recs.items], rtol=1e-4)
+
+
+def test_batch_round_trips_recommendations(cf, bridges, logger, requests):
+    user_ids, item_ids = requests
+    R = Reranker(bridges, cf, logger)
+    recommendations = [R.recommend(user_id, item_id, N=5, K=10) for user_id, item_id in zip(user_ids[:50], item_ids[:50])]
+    batch = RecommendationBatch.from_recommendations(recommendations, 5, R.vocabulary)
+    for recs, recommendation in zip(recommendations, batch.to_recommendations()):
+        if recs is None:
+            assert recommendation.items == []
+            continue
+        assert [(r.item_id, r.origin, r.code) for r in recommendation.items] == [(r.item_id, r.origin, r.code) for r in recs.items]
+        np.testing.assert_allclose([r.score for r in recommendation.items], [r.score for r in recs.items], rtol=1e-6)
@@ -0,0 +1,152 @@
+import asyncio
+import json
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from rec.benchmarks.serving_load import request
+from rec.models.reranker import Reranker
+from rec.serving.server import MicroBatcher, RecommendationServer
+
+
+def serve(reranker, logger, client, **batcher_args):
+    # Runs client(server) against a server on a free local port
+    async def main():
+        server = RecommendationServer(MicroBatcher(reranker, logger=logger, **batcher_args), port=0, logger=logger)
+        await server.start()
+        try:
+            return await client(server)
+        finally:
+            await server.stop()
+    return asyncio.run(main())
+
+
+async def get(server, path, raw=None):
+    reader, writer = await asyncio.open_connection(server.host, server.port)
+    try:
+        if raw is not None:
+            writer.write(raw)
+            await writer.drain()
+            head = await reader.readuntil(b'\r\n\r\n')
+            length = int(head.split(b'Content-Length: ')[1].split(b'\r\n')[0])
+            return int(head.split(b' ', 2)[1]), await reader.readexactly(length)
+        return await request(reader, writer, server.host, path)
+    finally:
+        writer.close()
+
+
+@pytest.fixture
+def reranker(cf, bridges, logger):
+    return Reranker(bridges, cf, logger)
+
+
+@pytest.fixture(scope='module')
+def requests(paths):
+    test = pd.read_csv(paths['test']).dropna().head(100)
+    return list(zip(test['profile_id'], test['item_id'].astype(np.int64).astype(str)))
+
+
+def test_recommendations_equal_the_reranker(reranker, logger, requests):
+    async def client(server):
+        return await asyncio.gather(*[get(server, f'/recommend?user_id={user}&item_id={item}&N=5') for user, item in requests])
+
+    responses = serve(reranker, logger, client, K=10, max_wait=0.01)
+    items, scores, valid = reranker.recommend_batch([user for user, _ in requests], [item for _, item in requests], N=5, w1=0.5, K=10)
+    for i, (status, body) in enumerate(responses):
+        assert status == (200 if valid[i] else 404)
+        if valid[i]:
+            body = json.loads(body)
+            assert [item['item_id'] for item in body['items']] == [item for item in items[i] if item is not None]
+            np.testing.assert_allclose([item['score'] for item in body['items']], scores[i][:len(body['items'])], rtol=1e-6)
+
+
+def test_stats_and_metrics(reranker, logger, requests):
+    user, item = requests[0]
+
+    async def client(server):
+        for _ in range(3):
+            await get(server, f'/recommend?user_id={user}&item_id={item}')
+        stats = await get(server, '/stats')
+        return stats, await get(server, '/metrics')
+
+    (status, stats), (metrics_status, metrics) = serve(reranker, logger, client)
+    stats = json.loads(stats)
+    assert status == 200 and stats['requests'] == 3 and stats['rejected'] == 0
+    assert stats['batch_size']['count'] == 3
+    assert metrics_status == 200
+    metrics = metrics.decode()
+    assert '# TYPE server_request_seconds histogram' in metrics
+    assert 'server_request_seconds_count 4' in metrics
+    assert 'server_batch_size_bucket{le="+Inf"} 3' in metrics
+
+
+@pytest.mark.parametrize('path, status', [
+    ('/recommend?user_id=profile_1', 400),
+    ('/recommend?user_id=profile_1&item_id=100000&N=0', 400),
+    ('/recommend?user_id=profile_1&item_id=100000&N=x', 400),
+    ('/recommend?user_id=unknown&item_id=100000', 404),
+    ('/unknown', 404),
+])
+def test_bad_requests(reranker, logger, path, status):
+    async def client(server):
+        return await get(server, path)
+
+    assert serve(reranker, logger, client)[0] == status
+
+
+@pytest.mark.parametrize('raw, status', [
+    (b'POST /recommend HTTP/1.1\r\nContent-Length: 2\r\n\r\n{}', 405),
+    (b'GET /stats HTTP/1.1\r\nContent-Length: abc\r\n\r\n', 400),
+    (b'GET /stats HTTP/1.1\r\nContent-Length: -1\r\n\r\n', 400),
+    (b'GARBAGE\r\n\r\n', 400),
+])
+def test_malformed_requests(reranker, logger, raw, status):
+    async def client(server):
+        return await get(server, None, raw=raw)
+
+    assert serve(reranker, logger, client)[0] == status
+
+
+def test_route_errors_are_answered(reranker, logger, monkeypatch):
+    async def client(server):
+        monkeypatch.setattr(server, 'stats', lambda: 1 / 0)
+        first = await get(server, '/stats')
+        # The server keeps serving other connections
+        return first, await get(server, '/metrics')
+
+    (status, body), (next_status, _) = serve(reranker, logger, client)
+    assert status == 500 and 'division by zero' in json.loads(body)['error']
+    assert next_status == 200
+
+
+class BlockedReranker:
+    # Stand-in reranker whose batches wait until released
+    def __init__(self, reranker):
+        self.CF = reranker.CF
+        self.release = threading.Event()
+
+    def recommend_batch(self, user_ids, item_ids, N=5, w1=0.5, w2=None, K=5):
+        self.release.wait(10)
+        return np.full((len(user_ids), N), 'item', dtype=object), np.ones((len(user_ids), N)), np.ones(len(user_ids), dtype=bool)
+
+
+def test_full_queue_is_answered_with_503(reranker, logger):
+    blocked = BlockedReranker(reranker)
+
+    async def client(server):
+        # The first request is taken into a batch that blocks, the next two fill the queue
+        first = asyncio.ensure_future(get(server, '/recommend?user_id=profile_1&item_id=100000'))
+        await asyncio.sleep(0.2)
+        queued = [asyncio.ensure_future(get(server, '/recommend?user_id=profile_1&item_id=100000')) for _ in range(2)]
+        await asyncio.sleep(0.2)
+        rejected = await asyncio.gather(*[get(server, '/recommend?user_id=profile_1&item_id=100000') for _ in range(3)])
+        stats = json.loads((await get(server, '/stats'))[1])
+        blocked.release.set()
+        return await first, await asyncio.gather(*queued), rejected, stats
+
+    first, queued, rejected, stats = serve(blocked, logger, client, max_batch_size=1, max_queue=2)
+    assert first[0] == 200 and [status for status, _ in queued] == [200, 200]
+    assert [status for status, _ in rejected] == [503] * 3
+    assert stats['rejected'] == 3 and stats['status']['503'] == 3
@@ -0,0 +1,141 @@
+import json
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from rec.utils.slack import Notifier, Slack
+
+
+class Webhook(ThreadingHTTPServer):
+    """
+    Local stand-in for the Slack webhook, keeping every JSON payload it receives.
+    """
+    def __init__(self, delay=0):
+        self.payloads = []
+        self.delay = delay
+        super().__init__(('127.0.0.1', 0), WebhookHandler)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/hook'
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        time.sleep(self.server.delay)
+        self.server.payloads.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def webhook():
+    server = Webhook()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def send_results(slack, n):
+    for i in range(n):
+        slack.send_results(f'case {i}', avg_ctr=0.1, mean_avg_precision=0.2, avg_popularity_score=0.3,
+                           avg_count_popularity_score=0.4, coverage=0.5)
+
+
+def test_results_are_sent_as_one_digest(webhook):
+    slack = Slack(url=webhook.url, channel='#evaluations', digest_interval=60)
+    slack.send_message('Starting')
+    send_results(slack, 3)
+    # Nothing but the message before the digest is due
+    time.sleep(0.2)
+    assert [payload['text'] for payload in webhook.payloads] == ['Starting']
+    assert slack.flush(timeout=5)
+    assert len(webhook.payloads) == 2
+    digest = webhook.payloads[1]
+    assert digest['channel'] == '#evaluations'
+    assert [attachment['pretext'] for attachment in digest['attachments']] == ['case 0', 'case 1', 'case 2']
+    slack.close()
+
+
+def test_digest_is_sent_every_interval(webhook):
+    slack = Slack(url=webhook.url, channel='#evaluations', digest_interval=0.2)
+    send_results(slack, 2)
+    deadline = time.monotonic() + 5
+    while not webhook.payloads and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert len(webhook.payloads) == 1 and len(webhook.payloads[0]['attachments']) == 2
+    slack.close()
+
+
+def test_pending_results_are_sent_on_exit(webhook):
+    script = f"""
+from rec.utils.slack import Slack
+slack = Slack(url={webhook.url!r}, channel='#evaluations', digest_interval=60)
+slack.send_results('case', avg_ctr=0.1, mean_avg_precision=0.2, avg_popularity_score=0.3, avg_count_popularity_score=0.4, coverage=0.5)
+"""
+    subprocess.run([sys.executable, '-c', script], check=True, timeout=30)
+    assert len(webhook.payloads) == 1 and webhook.payloads[0]['attachments'][0]['pretext'] == 'case'
+
+
+class BlockingSink:
+    def __init__(self):
+        self.release = threading.Event()
+        self.payloads = []
+
+    def send(self, payload):
+        self.release.wait(5)
+        self.payloads.append(payload)
+
+    def close(self):
+        pass
+
+
+def test_full_queue_drops_payloads_without_blocking():
+    sink = BlockingSink()
+    notifier = Notifier(sink, digest_interval=60, max_queue=2)
+    notifier.send({'text': 'first'})
+    # Wait until the worker is blocked in the sink with the first payload
+    deadline = time.monotonic() + 5
+    while not notifier.queue.empty() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    start = time.monotonic()
+    for i in range(10):
+        notifier.send({'text': str(i)})
+    assert time.monotonic() - start < 0.5
+    assert notifier.dropped == 8
+    sink.release.set()
+    notifier.close(timeout=5)
+    assert [payload['text'] for payload in sink.payloads] == ['first', '0', '1']
+
+
+def test_slow_webhook_times_out():
+    server = Webhook(delay=2)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    slack = Slack(url=server.url, channel='#evaluations', timeout=(0.5, 0.2))
+    start = time.monotonic()
+    slack.send_message('slow')
+    assert slack.flush(timeout=5)
+    assert time.monotonic() - start < 1.5
+    assert slack.notifier.failed == 1 and slack.notifier.sent == 0
+    slack.close()
+    server.shutdown()
+    server.server_close()
+
+
+def test_missing_configuration_writes_to_the_fallback_file(tmp_path, monkeypatch):
+    monkeypatch.delenv('SLACK_URL', raising=False)
+    monkeypatch.delenv('SLACK_CHANNEL', raising=False)
+    slack = Slack(fallback_path=str(tmp_path / 'slack.jsonl'))
+    slack.send_message('Starting')
+    slack.close()
+    assert [json.loads(line)['text'] for line in (tmp_path / 'slack.jsonl').read_text().splitlines()] == ['Starting']
@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+
+from rec.models.reranker import Reranker
+from rec.utils.vocabulary import ITEMS, USERS, CodeMap, ItemVocabulary, UserVocabulary
+
+
+def test_codes_are_given_in_order_of_first_appearance():
+    vocabulary = ItemVocabulary(['b', 'a'])
+    codes = vocabulary.add(np.array(['c', 'a', 'c', 'd'], dtype=object))
+    np.testing.assert_array_equal(codes, [2, 1, 2, 3])
+    assert len(vocabulary) == 4
+    np.testing.assert_array_equal(vocabulary.ids([3, -1, 0]), np.array(['d', None, 'b'], dtype=object))
+
+
+def test_items_are_compared_by_their_string_form():
+    vocabulary = ItemVocabulary(np.array(['100', '101'], dtype=object))
+    np.testing.assert_array_equal(vocabulary.codes(np.array([101, 100, 102])), [1, 0, -1])
+    np.testing.assert_array_equal(vocabulary.codes([100, '101']), [0, 1])
+    assert vocabulary.code(101) == 1 and vocabulary.code('102') == -1
+    assert 100 in vocabulary and 102 not in vocabulary
+
+
+def test_users_keep_their_type():
+    vocabulary = UserVocabulary([1, 2])
+    assert vocabulary.code(1) == 0 and vocabulary.code('1') == -1
+
+
+def test_code_map():
+    vocabulary = ItemVocabulary(['x'])
+    code_map = CodeMap(vocabulary, np.array(['b', 'a', 'x'], dtype=object))
+    np.testing.assert_array_equal(code_map.shared, [1, 2, 0])
+    np.testing.assert_array_equal(code_map.to_shared([2, -1, 0]), [0, -1, 1])
+    vocabulary.add(['later'])
+    np.testing.assert_array_equal(code_map.to_local([0, 1, 3, -1]), [2, 0, -1, -1])
+    assert code_map.code('a') == 1 and code_map.code('later') == -1
+
+
+def test_models_share_the_item_codes(cf, bridges, paths):
+    users = cf.user_index[:20]
+    for user in users:
+        recs = cf.recommend_standard(user, N=10)
+        assert [item.code for item in recs.items] == list(ITEMS.codes([item.item_id for item in recs.items]))
+    assert cf.user_code(users[3]) == 3 and USERS.code(users[3]) == cf.user_map.shared[3]
+    for item in bridges.model.items[:20]:
+        recs = bridges.recommend_standard(item, N=10)
+        if recs is not None:
+            assert [item.code for item in recs.items] == list(ITEMS.codes([item.item_id for item in recs.items]))
+            assert set(recs.items_map) == {item.code for item in recs.items}
+    # Test set items are floats, they are found by their integer form
+    test = pd.read_csv(paths['test']).dropna()
+    item = test['item_id'].astype(np.int64).iloc[0]
+    assert bridges.model.code(item) == bridges.model.code(str(item))
+
+
+def test_rerank_merges_the_candidates_by_code(cf, bridges, logger, paths):
+    R = Reranker(bridges, cf, logger)
+    test = pd.read_csv(paths['test']).dropna()
+    merged = 0
+    for user, item in zip(test['profile_id'], test['item_id'].astype(np.int64)):
+        recs = R.recommend(user, item, N=5, K=10)
+        if recs is None:
+            continue
+        cf_recs, bridge_recs = cf.recommend_standard(user, N=10), bridges.recommend_standard(item, N=10)
+        both = {rec.code for rec in cf_recs.items} & {rec.code for rec in bridge_recs.items}
+        assert {rec.code for rec in recs.items if rec.origin == 'RERANK'} <= both
+        assert len({rec.code for rec in recs.items}) == len(recs.items)
+        merged += len(recs.items_map)
+    assert merged > 0